@@ -11,6 +11,7 @@ from datetime import timedelta
 
 import shutil
 import glob
+import threading
 from flask import Flask, request, render_template, send_file, session
 from flask_apscheduler import APScheduler
 import fiona
@@ -24,6 +25,7 @@ from .controller import PipelineController
 from .line_builder import line_builder
 from .report_builder.report_builder import report_builder
 from .extra_utils import resource_path
+from .mc_agent import warm_up
 
 api = Flask(__name__, 
             static_url_path='', 
@@ -39,6 +41,18 @@ scheduler = APScheduler()
 scheduler.init_app(api)
 scheduler.start()
 
+# Process the cost surfaces once at server start so the first requests don't pay for it
+def warm_up_surfaces():
+    """ Load the cost surface of every routing mode into the process-wide cache
+    """
+    try:
+        warm_up()
+        api.logger.info("Cost surfaces loaded")
+    except Exception as e:
+        api.logger.error(f"Error loading cost surfaces: {e}")
+
+threading.Thread(target=warm_up_surfaces, daemon=True).start()
+
 # Differences between bundled (exported as .exe) and webtool mode
 if getattr(sys, 'frozen', False):
     APP_ROOT = os.path.dirname(sys.executable)
@@ -84,7 +98,18 @@ def a():
             f"End: {end}"
         )
         mode = request.json.get("mode", None)
-        route = generate_line_ml(start, end, mode)    # calculate line with ML
+        try:
+            time_budget = parse_time_budget(request.json.get("time_budget", None))
+            exclusions = parse_exclusions(request.json.get("exclusions", None))    # polygons to avoid, as lists of points like s and e
+        except ValueError as e:
+            api.logger.error(f"Invalid request: {e}")
+            return str(e), 400
+        segments = []
+        try:
+            route = generate_line_ml(start, end, mode, time_budget, segments, exclusions)    # calculate line with ML
+        except ValueError as e:
+            api.logger.error(f"Unable to generate pipeline: {e}")
+            return str(e), 400
         api.logger.info("Pipeline generated")
 
         first_point = route[0]
@@ -110,7 +135,7 @@ def a():
         for coord in route:
             route_correct_swap.append((coord[1], coord[0]))
             
-        return {'route': route_correct_swap, 'zip':zip_path}
+        return {'route': route_correct_swap, 'zip':zip_path, 'segments': segments}
 
 @api.route('/download_report', methods=['POST'])
 def send_report():
@@ -321,6 +346,54 @@ def send_id():
     return {'uid': uid}
 
 
+def parse_time_budget(time_budget):
+    """
+    Validates the time budget of a route request
+    Parameters:
+        time_budget - seconds the search may run, as sent by the client, or None
+    returns:
+        the time budget as a float, or None if none was sent
+    raises:
+        ValueError if the time budget is not a number of seconds >= 0
+    """
+    if time_budget is None:
+        return None
+    try:
+        time_budget = float(time_budget)
+    except (TypeError, ValueError):
+        raise ValueError(f"time_budget must be a number of seconds, got {time_budget!r}")
+    if not time_budget >= 0:
+        raise ValueError(f"time_budget must be at least 0 seconds, got {time_budget}")
+    return time_budget
+
+def parse_exclusions(exclusions):
+    """
+    Validates the excluded areas of a route request
+    Parameters:
+        exclusions - list of polygons as sent by the client, each a list of at least 3 [longitude, latitude] points, or None
+    returns:
+        the polygons as lists of (longitude, latitude) tuples of floats, or None if none were sent
+    raises:
+        ValueError if the exclusions are not a list of such polygons
+    """
+    if exclusions is None:
+        return None
+    if not isinstance(exclusions, list):
+        raise ValueError("exclusions must be a list of polygons")
+    polygons = []
+    for polygon in exclusions:
+        if not isinstance(polygon, list) or len(polygon) < 3:
+            raise ValueError("each exclusion must be a list of at least 3 points")
+        points = []
+        for point in polygon:
+            if not isinstance(point, (list, tuple)) or len(point) != 2 \
+                    or not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in point) \
+                    or not np.isfinite(point).all():
+                raise ValueError(f"exclusion points must be [longitude, latitude] pairs of numbers, got {point!r}")
+            points.append((float(point[0]), float(point[1])))
+        polygons.append(points)
+    return polygons
+
 def CoordinatesToIndices(raster, coordinates):
     """
     Converts spatial coordinates to indexed raster locations
@@ -399,9 +472,12 @@ def translateLine(raster, routelist):
         routelist[i] = (wgs84_coordinates[1], wgs84_coordinates[0])
     return routelist
 
-def generate_line_ml(start, dest, mode):
+def generate_line_ml(start, dest, mode, time_budget=None, segments=None, exclusions=None):
     """ Call machine learning functions to generate line between parameter points
        Paramters: start, dest: tuple, the start and end points of the line that will be generated, passed in as WGS84 coords
+                  time_budget: float, seconds the search may run before the line is completed by the exact fallback
+                  segments: list, filled with the (engine, first, last) indices of the line produced by each engine
+                  exclusions: list, polygons the line must avoid, each a list of WGS84 coords like start and dest
        Returns: route: list, the list of coordinates that composes the line
        """
 
@@ -412,9 +488,14 @@ def generate_line_ml(start, dest, mode):
     startlocal = CoordinatesToIndices(raspath, start)  # translate WGS84 coords into local raster index coords for ML processing
     destlocal = CoordinatesToIndices(raspath, dest)
 
-    pipecontrol = PipelineController(startlocal, destlocal, mode)
+    # translate the vertices of the excluded areas the same way
+    exclusionslocal = [[CoordinatesToIndices(raspath, point) for point in polygon] for polygon in exclusions or []]
+
+    pipecontrol = PipelineController(startlocal, destlocal, mode, time_budget, exclusionslocal)
 
     route_local = pipecontrol.ml_run()
+    if segments is not None:
+        segments.extend(pipecontrol.report.get('segments', []))
     route_wgs = translateLine(raspath, route_local)
 
     return route_wgs
@@ -11,12 +11,15 @@ from .mc_agent import least_cost_path_ml
 class PipelineController():
     """ Passes line data between processing modules and the api module
     """
-    def __init__(self, x,y, mode):
+    def __init__(self, x,y, mode, time_budget=None, exclusions=None):
         self.start = x
         self.dest = y
         self.mode = mode
+        self.time_budget = time_budget
+        self.exclusions = exclusions
+        self.report = {}
 
     def ml_run(self):
         """Machine-learning informed routing logic
         """
-        return least_cost_path_ml(self.start, self.dest, self.mode)
+        return least_cost_path_ml(self.start, self.dest, self.mode, time_budget=self.time_budget, report=self.report, exclusions=self.exclusions)
@@ -2,9 +2,21 @@
 mc_agent
 Contains all the machine learning code, used to generate a prospective pipeline given a start and endpoint from the user
 """
+from collections import OrderedDict
+import copy
+import hashlib
+import heapq
+import json
 import multiprocessing as mp
-from multiprocessing import Pool
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import wait
 from pathlib import Path
+import shutil
+import sys
+import threading
+import time
+import warnings
+import weakref
 
 import rasterio
 import cv2 as cv
@@ -12,10 +24,67 @@ import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 from IPython import display
+from skimage.graph import MCP_Geometric
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 from .extra_utils import resource_path
 
-def least_cost_path_ml(start, dest, mode):
+# Direction vectors for the eight actions, starting with up and going clockwise
+ACTION_DIRECTIONS = np.array([
+    [-1, 0],   # Up
+    [-1, 1],   # Up/Right
+    [0, 1],    # Right
+    [1, 1],    # Down/Right
+    [1, 0],    # Down
+    [1, -1],   # Down/Left
+    [0, -1],   # Left
+    [-1, -1],  # Up/Left
+])
+
+# Raster, cost degree and distance factor of each MLWrapper mode
+ROUTING_MODES = {
+    'route': ('cost_surfaces/raw_cost_10km_aea/cost_10km_aea.tif', 2, 0.2),
+    'rail': ('cost_surfaces/10km_RAIL/cost_10km_aea_RAIL_ready.tif', 1, 0.5),
+}
+
+# Directory of the preprocessed surfaces written by build_surfaces, relative to
+# resource_path. SURFACE_FORMAT is part of every surface version, bump it when
+# process_raster changes what it produces.
+SURFACE_DIR = 'cost_surfaces/processed'
+SURFACE_FORMAT = 2
+
+# Processed cost surfaces shared by every request of the process, see load_surface.
+# Each key has its own lock held while its surface is built, _surface_lock only
+# guards the two dictionaries
+_surface_cache = {}
+_surface_locks = {}
+_surface_lock = threading.Lock()
+
+# Overlays rasterized by polygon_overlay, most recently used last
+OVERLAY_CACHE_SIZE = 256
+
+# Initial search window margin of routes with exclusions when MLWrapper has no
+# window_margin, so the exclusions are applied to windows of the shared surface
+EXCLUSION_WINDOW_MARGIN = 32
+
+# Targets whose search data MLWrapper._route_chunk keeps for later chunks
+TARGET_CACHE_SIZE = 4
+
+# Share of the rows of a PoolTree's NodePool that released nodes may fill
+# before the pool is compacted
+COMPACT_FRACTION = 0.5
+
+# Most cells of a search window assembled from the tiles of a TiledSurface,
+# the search holds several dense arrays of the window's size
+TILED_WINDOW_CELLS = 2048*2048
+_overlay_cache = OrderedDict()
+_overlay_lock = threading.Lock()
+
+def least_cost_path_ml(start, dest, mode, time_budget=None, report=None, exclusions=None):
     """
     Simple wrapper function to return just the list that composes the 
     ML-generated line.
@@ -24,21 +93,38 @@ def least_cost_path_ml(start, dest, mode):
         start (tuple): The starting location.
         dest (tuple): The destination location.
         mode (str): The mode of the MLWrapper.
+        time_budget (float, optional): Seconds the search may run before the
+            line is completed by the exact fallback, see MCAgent.route.
+            Defaults to None (no deadline).
+        report (dict, optional): Updated with the agent's report of the route,
+            including which engine produced each segment of the line.
+        exclusions (list, optional): Polygons of (y, x) raster indices the
+            line must avoid, see polygon_overlay. Defaults to None.
 
     Returns:
         list: The list that composes the ML-generated line.
+
+    Raises:
+        FileNotFoundError: If the raster of the mode does not exist.
     """
     # error checking .tifs
     try:
         wrapper = MLWrapper(mode=mode)
     except FileNotFoundError as e:
         print(e.args)
+        raise
 
     # Get route and only return the optimized path
-    res = wrapper.route(start, dest)
+    try:
+        overlay = polygon_overlay(wrapper.cost_surface.cost.shape, exclusions) if exclusions else None
+        res = wrapper.route(start, dest, time_budget=time_budget, exclusions=overlay)
+        if report is not None:
+            report.update(wrapper.agent.report)
+    finally:
+        wrapper.close()
     return res[0]
 
-def normalize(arr, high=1, low=0):
+def normalize(arr, high=1, low=0, out=None):
     """
     Normalizes the input array to a specified range.
 
@@ -46,31 +132,124 @@ def normalize(arr, high=1, low=0):
         arr (np.ndarray): The input array to normalize.
         high (float): The maximum value of the output array.
         low (float): The minimum value of the output array.
+        out (np.ndarray, optional): Array to write the result to, which may be
+            arr itself. Defaults to None, allocating a new array.
 
     Returns:
         np.ndarray: The normalized array. If all values in the input array are the same,
             returns an array of the same shape filled with the average of high and low.
     """
+    arr_min, arr_max = arr.min(), arr.max()
+
     # Check if all values are the same
-    if arr.max() == arr.min():
-        return np.full_like(arr, (high + low) / 2)
+    if arr_max == arr_min:
+        if out is None:
+            return np.full_like(arr, (high + low) / 2)
+        out[...] = (high + low) / 2
+        return out
     
     # Normalize the array
-    norm = (high-low)*(arr - arr.min())/(arr.max() - arr.min()) + low
-    return norm
+    if out is None:
+        return (high-low)*(arr - arr_min)/(arr_max - arr_min) + low
 
-def exponential(x, degree):
+    # The same operations one at a time, so they can be done in place
+    np.subtract(arr, arr_min, out=out)
+    out *= high - low
+    out /= arr_max - arr_min
+    out += low
+    return out
+
+def exponential(x, degree, out=None):
     """
     Applies an exponential transformation to the input array.
 
     Args:
         x (np.ndarray): The input array to transform.
         degree (float): The exponent to raise the input array to.
+        out (np.ndarray, optional): Array to write the result to, which may be
+            x itself. Defaults to None, allocating a new array.
 
     Returns:
         np.ndarray: The transformed array.
     """
-    return x**degree
+    if out is None:
+        return x**degree
+
+    # The power operators take numpy's exact fast paths for degrees like 1 and 2
+    if out is not x:
+        out[...] = x
+    out **= degree
+    return out
+
+def quantize(arr, dtype=np.uint16, chunk=1024):
+    """
+    Quantizes a float array to unsigned integers spanning its range.
+
+    The array is converted a block of rows at a time, so no full-size float
+    temporaries are allocated.
+
+    Args:
+        arr (np.ndarray): The array to quantize.
+        dtype (np.dtype, optional): The unsigned integer type to quantize to.
+            Defaults to np.uint16.
+        chunk (int, optional): The number of rows converted at a time.
+            Defaults to 1024.
+
+    Returns:
+        tuple: The quantized array and the (low, high) range it spans, see
+            dequantize.
+    """
+    levels = np.iinfo(dtype).max
+    low, high = float(arr.min()), float(arr.max())
+    span = high - low if high > low else 1.0
+
+    quantized = np.empty(arr.shape, dtype=dtype)
+    for row in range(0, arr.shape[0], chunk):
+        block = arr[row:row+chunk] - low
+        block *= levels/span
+        quantized[row:row+chunk] = np.rint(block, out=block)
+    return quantized, (low, high)
+
+def dequantize(quantized, value_range, dtype=np.float32):
+    """
+    Restores a float array quantized by quantize.
+
+    The ends of the range are restored exactly, other values to within half
+    a quantization step.
+
+    Args:
+        quantized (np.ndarray): The quantized array.
+        value_range (tuple): The (low, high) range returned by quantize.
+        dtype (np.dtype, optional): The floating point type to restore to.
+            Defaults to np.float32.
+
+    Returns:
+        np.ndarray: The restored array.
+    """
+    low, high = value_range
+    arr = np.array(quantized, dtype=dtype)
+    arr /= np.iinfo(quantized.dtype).max
+    arr *= high - low
+    arr += low
+    return arr
+
+def block_mean(arr, factor, fill=1):
+    """
+    Averages an array over square blocks to a coarser resolution.
+
+    Args:
+        arr (np.ndarray): The 2D input array.
+        factor (int): The side length of each block in cells.
+        fill (float, optional): Value used to pad the array to a multiple of
+            factor. Defaults to 1 (maximum cost).
+
+    Returns:
+        np.ndarray: The array of block means, with ceil(shape/factor) cells.
+    """
+    height, width = -(-arr.shape[0]//factor), -(-arr.shape[1]//factor)
+    padded = np.full((height*factor, width*factor), fill, dtype=arr.dtype)
+    padded[:arr.shape[0], :arr.shape[1]] = arr
+    return padded.reshape(height, factor, width, factor).mean(axis=(1, 3))
 
 def draw_circle(img, center, radius):
     """
@@ -174,21 +353,16 @@ def get_contiguous_area(bool_raster, min_size):
             considered a contiguous portion of US or AL.
 
     Returns:
-        tuple: A tuple containing the contiguous areas and the output array.
+        tuple: A tuple containing the boolean mask of the contiguous areas and
+            the int32 component labels.
     """
     assert bool_raster.dtype == np.uint8, 'Array must have numpy.uint8 data type'
-    contiguous = np.zeros(bool_raster.shape)
     number_components, output, stats, _ = cv.connectedComponentsWithStats(bool_raster, connectivity=4)
 
-    labels = []
-    for i in range(1, number_components):
-        size = stats[i, -1]
-        if size > min_size:
-            # Labels start at value of 1
-            labels.append(i)
-    
-    for value in labels:
-        contiguous[output==value] = 1
+    # Look up whether each component is large enough, labels start at value of 1
+    large = stats[:, cv.CC_STAT_AREA] > min_size
+    large[0] = False
+    contiguous = large[output]
 
     return contiguous, output
 
@@ -214,6 +388,208 @@ def find_transitions(arr):
     x1, x2 = transition_indices[1][0], transition_indices[1][-1]
     return (y1+1, x1+1), (y2+1, x2+1)
 
+def surface_version(path, degree=2, no_go_cost=None):
+    """
+    Get the version of the surface processed from a raster.
+
+    The version digests the raster contents, the processing parameters and
+    SURFACE_FORMAT, so it changes whenever the processed arrays would.
+
+    Args:
+        path (str or Path): Path to the raw raster file.
+        degree (float, optional): See CostSurface.process_raster. Defaults to 2.
+        no_go_cost (float, optional): See CostSurface.process_raster. Defaults
+            to None.
+
+    Returns:
+        str: A 12 character hexadecimal version.
+    """
+    digest = hashlib.sha1(Path(path).read_bytes())
+    digest.update(repr((SURFACE_FORMAT, degree, no_go_cost)).encode())
+    return digest.hexdigest()[:12]
+
+def build_surfaces(out_dir, modes=tuple(ROUTING_MODES), dtype=None, compact=False):
+    """
+    Preprocess the cost surfaces of the routing modes into .npy files.
+
+    Each mode is written to '<mode>-<version>' under out_dir, replacing the
+    mode's previous build, and recorded in out_dir/manifest.json.
+
+    Args:
+        out_dir (str or Path): Directory to write the surfaces to.
+        modes (tuple, optional): Keys of ROUTING_MODES to build. Defaults to
+            every mode.
+        dtype (np.dtype, optional): See CostSurface.process_raster. Defaults
+            to None.
+        compact (bool, optional): See CostSurface.save_rasters. Defaults to
+            False.
+
+    Returns:
+        dict: The manifest, mapping each built mode to its 'version',
+            'directory', 'raster', 'degree', 'no_go_cost', 'shape', 'dtype'
+            and 'compact'.
+
+    Raises:
+        KeyError: If a mode is not in ROUTING_MODES.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = out_dir.joinpath('manifest.json')
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    for mode in modes:
+        if mode not in ROUTING_MODES:
+            raise KeyError("Unknown routing mode: {}".format(mode))
+        raster, degree, _ = ROUTING_MODES[mode]
+        raster_path = resource_path(raster)
+
+        version = surface_version(raster_path, degree=degree)
+        directory = '{}-{}'.format(mode, version)
+        surface = CostSurface()
+        surface.process_raster(raster_path, degree=degree, dtype=dtype)
+        surface.save_rasters(out_dir.joinpath(directory), compact=compact)
+
+        previous = manifest.get(mode, {}).get('directory')
+        if previous is not None and previous != directory:
+            shutil.rmtree(out_dir.joinpath(previous), ignore_errors=True)
+        manifest[mode] = {
+            'version': version,
+            'directory': directory,
+            'raster': raster,
+            'degree': degree,
+            'no_go_cost': None,
+            'shape': list(surface.cost.shape),
+            'dtype': surface.cost.dtype.name,
+            'compact': compact,
+            }
+
+    manifest_path.write_text(json.dumps(manifest, indent=4))
+    return manifest
+
+def load_built_surface(path, degree=2, no_go_cost=None, surface_dir=None):
+    """
+    Memory map the preprocessed surface of a raster written by build_surfaces.
+
+    Args:
+        path (str or Path): Path to the raw raster file.
+        degree (float, optional): See CostSurface.process_raster. Defaults to 2.
+        no_go_cost (float, optional): See CostSurface.process_raster. Defaults
+            to None.
+        surface_dir (str or Path, optional): Directory holding the manifest.
+            Defaults to SURFACE_DIR.
+
+    Returns:
+        CostSurface: The surface with read-only memory mapped arrays, or None
+            if no surface was built for this version of the raster.
+    """
+    surface_dir = Path(resource_path(SURFACE_DIR) if surface_dir is None else surface_dir)
+    manifest_path = surface_dir.joinpath('manifest.json')
+    if not manifest_path.exists():
+        return None
+
+    version = surface_version(path, degree=degree, no_go_cost=no_go_cost)
+    for entry in json.loads(manifest_path.read_text()).values():
+        if entry['version'] == version:
+            surface = CostSurface()
+            surface.load_rasters(surface_dir.joinpath(entry['directory']), mmap_mode='r')
+            return surface
+    return None
+
+def load_surface(path, degree=2, no_go_cost=None, surface_dir=None, tile_size=None, levels=False):
+    """
+    Get the processed cost surface of a raster, processing it once per process.
+
+    Surfaces are cached by raster path, modification time and size, degree
+    and no_go_cost, so a raster that changes on disk is processed again. The
+    cached arrays are read-only and shared: each caller gets its own shallow
+    copy of the CostSurface, whose attributes it may replace but whose arrays
+    it must not modify. A surface built for the raster by build_surfaces is
+    memory mapped instead of processing the raster. With a tile_size, the
+    raster is read lazily as a TiledSurface, whose tile cache is shared the
+    same way. The levels of hierarchical routing are built once on the cached
+    surface the first time they are asked for, and shared read-only like the
+    other arrays. Rasters that cannot be stat'ed are processed without caching.
+
+    Only callers asking for the same surface wait for it to be built, callers
+    asking for surfaces already cached never wait.
+
+    Args:
+        path (str or Path): Path to the raw raster file.
+        degree (float, optional): See CostSurface.process_raster. Defaults to 2.
+        no_go_cost (float, optional): See CostSurface.process_raster. Defaults
+            to None.
+        surface_dir (str or Path, optional): See load_built_surface. Defaults
+            to SURFACE_DIR.
+        tile_size (int, optional): Read the raster in tiles of this size, see
+            TiledSurface. Defaults to None, processing the whole raster.
+        levels (bool, optional): Build the levels of hierarchical routing, see
+            CostSurface.build_levels. Defaults to False.
+
+    Returns:
+        CostSurface or TiledSurface: The processed cost surface.
+
+    Raises:
+        AssertionError: If the raw raster file does not exist.
+    """
+    path = Path(path)
+    try:
+        stat = path.stat()
+    except OSError:
+        surface = CostSurface()
+        surface.process_raster(path, degree=degree, no_go_cost=no_go_cost)
+        if levels:
+            surface.build_levels()
+        return surface
+
+    key = (str(path.resolve()), stat.st_mtime_ns, stat.st_size, degree, no_go_cost, tile_size)
+    with _surface_lock:
+        surface = _surface_cache.get(key)
+        if surface is not None and (not levels or surface.levels is not None):
+            return copy.copy(surface)
+        key_lock = _surface_locks.setdefault(key, threading.Lock())
+
+    with key_lock:
+        with _surface_lock:
+            surface = _surface_cache.get(key)
+        if surface is None and tile_size is not None:
+            surface = TiledSurface(path, degree=degree, no_go_cost=no_go_cost, tile_size=tile_size)
+        elif surface is None:
+            surface = load_built_surface(path, degree=degree, no_go_cost=no_go_cost, surface_dir=surface_dir)
+            if surface is None:
+                surface = CostSurface()
+                surface.process_raster(path, degree=degree, no_go_cost=no_go_cost)
+            for array in (surface.cost, surface.no_go, surface.labels):
+                array.flags.writeable = False
+
+        with _surface_lock:
+            # Forget earlier versions of the same raster
+            for stale in [cached for cached in _surface_cache if cached[0] == key[0] and cached[1:3] != key[1:3]]:
+                del _surface_cache[stale]
+                _surface_locks.pop(stale, None)
+            _surface_cache[key] = surface
+
+        if levels and surface.levels is None:
+            # Other callers copy the cached surface at any time, so its levels
+            # are only attached once they are read-only
+            built = copy.copy(surface)
+            built.build_levels()
+            for level in built.levels:
+                level.flags.writeable = False
+            surface.levels = built.levels
+    return copy.copy(surface)
+
+def warm_up(modes=tuple(ROUTING_MODES)):
+    """
+    Process the cost surfaces of the routing modes ahead of the first request.
+
+    Args:
+        modes (tuple, optional): Keys of ROUTING_MODES to load. Defaults to
+            every mode.
+    """
+    for mode in modes:
+        raster_path, cost_degree, _ = ROUTING_MODES[mode]
+        load_surface(resource_path(raster_path), degree=cost_degree)
+
 class CostSurface:
     """
     A class for manipulating cost surfaces in both coordinate systems.
@@ -228,6 +604,11 @@ class CostSurface:
             from 0 (lowest cost) to 1 (highest cost/no-go areas).
         no_go (np.ndarray): Boolean array where True indicates areas that should
             not be traversed (out of bounds or otherwise prohibited).
+        levels (list): Cost surfaces of increasing resolution used for
+            hierarchical routing, from the national to the local grid, or None.
+        labels (np.ndarray): Region label of each cell, see label_regions,
+            0 for the no-go areas joined to the edge of the surface. Cells
+            sharing a label can be joined by a route.
     """
 
     def __init__(self):
@@ -237,8 +618,10 @@ class CostSurface:
         
         self.cost = None
         self.no_go = None
+        self.levels = None
+        self.labels = None
 
-    def load_rasters(self, raster_dir):
+    def load_rasters(self, raster_dir, mmap_mode=None):
         """
         Loads processed raster arrays from disk.
 
@@ -247,7 +630,12 @@ class CostSurface:
 
         Args:
             raster_dir (str or Path): Directory containing the preprocessed 
-                raster files. Must contain 'cost.npy' and 'no_go.npy' files.
+                raster files. Must contain 'cost.npy' and 'no_go.npy' files,
+                or their compact forms written by save_rasters, and may contain
+                the region labels in 'labels.npy'.
+            mmap_mode (str, optional): Passed to np.load, 'r' memory maps the
+                arrays read-only. Compact cost and no-go arrays are decoded
+                into memory instead. Defaults to None.
 
         Raises:
             AssertionError: If raster_dir is None.
@@ -257,10 +645,111 @@ class CostSurface:
         assert raster_dir is not None, 'Must provide raster directory'
         raster_dir = Path(raster_dir)
 
-        self.cost = np.load(raster_dir.joinpath('cost.npy'))
-        self.no_go = np.load(raster_dir.joinpath('no_go.npy'))
+        if raster_dir.joinpath('cost_uint16.npy').exists():
+            self.cost = dequantize(np.load(raster_dir.joinpath('cost_uint16.npy'), mmap_mode=mmap_mode),
+                                   tuple(np.load(raster_dir.joinpath('cost_range.npy'))))
+            self.no_go = np.unpackbits(np.load(raster_dir.joinpath('no_go_bits.npy'), mmap_mode=mmap_mode),
+                                       axis=1, count=self.cost.shape[1]).view(bool)
+        else:
+            self.cost = np.load(raster_dir.joinpath('cost.npy'), mmap_mode=mmap_mode)
+            self.no_go = np.load(raster_dir.joinpath('no_go.npy'), mmap_mode=mmap_mode)
+        if raster_dir.joinpath('labels.npy').exists():
+            self.labels = np.load(raster_dir.joinpath('labels.npy'), mmap_mode=mmap_mode)
+        else:
+            self.label_regions()
+
+    def save_rasters(self, raster_dir, compact=False):
+        """
+        Saves the processed raster arrays to disk for load_rasters.
+
+        Args:
+            raster_dir (str or Path): Directory to write 'cost.npy', 'no_go.npy'
+                and 'labels.npy' to, created if missing.
+            compact (bool, optional): If True, the cost is quantized to 16 bits
+                in 'cost_uint16.npy' and 'cost_range.npy', the no-go mask is
+                bit-packed in 'no_go_bits.npy' and the labels use the smallest
+                integer type that holds them. Defaults to False.
+        """
+        raster_dir = Path(raster_dir)
+        raster_dir.mkdir(parents=True, exist_ok=True)
+
+        if compact:
+            quantized, value_range = quantize(self.cost)
+            np.save(raster_dir.joinpath('cost_uint16.npy'), quantized)
+            np.save(raster_dir.joinpath('cost_range.npy'), np.array(value_range))
+            np.save(raster_dir.joinpath('no_go_bits.npy'), np.packbits(self.no_go, axis=1))
+            np.save(raster_dir.joinpath('labels.npy'), self.labels.astype(np.min_scalar_type(self.labels.max())))
+        else:
+            np.save(raster_dir.joinpath('cost.npy'), self.cost)
+            np.save(raster_dir.joinpath('no_go.npy'), self.no_go)
+            np.save(raster_dir.joinpath('labels.npy'), self.labels)
+
+    def label_regions(self):
+        """
+        Labels the regions a route can move through.
+
+        Routes move to any of the 8 neighbouring cells and may cross no-go
+        cells at maximum cost, so regions are only separated by the no-go
+        areas joined to the edge of the surface, such as the sea and the land
+        beyond the border. No-go pockets enclosed by a region, such as lakes
+        or protected areas, belong to it. The no-go areas are 4-connected,
+        since an 8-connected route slips between diagonal neighbours.
+        """
+        no_go = np.asarray(self.no_go)
+        height, width = no_go.shape
+        _, areas, stats, _ = cv.connectedComponentsWithStats(no_go.astype(np.uint8), connectivity=4)
+        left, top = stats[:, cv.CC_STAT_LEFT], stats[:, cv.CC_STAT_TOP]
+        outside = (left == 0) | (top == 0) | (left + stats[:, cv.CC_STAT_WIDTH] == width) \
+            | (top + stats[:, cv.CC_STAT_HEIGHT] == height)
+        outside[0] = False
+        _, self.labels = cv.connectedComponents(np.invert(outside[areas]).astype(np.uint8), connectivity=8)
+
+    def region(self, location):
+        """
+        Get the connected region of a location.
+
+        Args:
+            location (array_like): The (y, x) location.
+
+        Returns:
+            int: The label of the region, 0 if no route can enter the location.
+        """
+        return int(self.labels[location[0], location[1]])
+
+    def reachable(self, start, target):
+        """
+        Check in constant time whether a route can join two locations.
+
+        Args:
+            start (array_like): The (y, x) location of the start.
+            target (array_like): The (y, x) location of the target.
+
+        Returns:
+            bool: True if both locations lie in the same region, see
+                label_regions.
+        """
+        region = self.region(start)
+        return region != 0 and region == self.region(target)
+
+    def build_levels(self, factors=(3, 2)):
+        """
+        Builds coarser copies of the processed cost surface for hierarchical routing.
+
+        Each level averages the one below it over blocks of the given size, so
+        the default factors give the national, regional and local layout of
+        the shipped multi-resolution surfaces (each national cell covers 6x6
+        local cells).
+
+        Args:
+            factors (tuple, optional): Block size between consecutive levels,
+                from the coarsest level down. Defaults to (3, 2).
+        """
+        levels = [self.cost]
+        for factor in reversed(factors):
+            levels.insert(0, block_mean(levels[0], factor))
+        self.levels = levels
 
-    def process_raster(self, path, degree=2, no_go_cost=None, visualize=False):
+    def process_raster(self, path, degree=2, no_go_cost=None, dtype=None, visualize=False):
         """
         Process a raw raster file into a normalized cost surface and no-go areas.
 
@@ -272,12 +761,19 @@ class CostSurface:
         4. Normalizes the values to 0-1 range
         5. Sets no-go areas to maximum cost or specified cost
 
+        The steps work in place on a single cost array, with boolean and
+        integer masks alongside it, to keep the peak memory of large rasters
+        down.
+
         Args:
             path (str or Path): Path to the raw raster file to process.
             degree (float, optional): Exponent used to increase weighting of high 
                 cost areas. Defaults to 2.
             no_go_cost (float, optional): Cost value to assign to no-go areas. 
                 If None, uses 1 (maximum cost). Defaults to None.
+            dtype (np.dtype, optional): Floating point type to read the raster
+                as and store the cost in, e.g. np.float32 to halve its memory.
+                Defaults to None, keeping the type of the raster.
             visualize (bool, optional): If True, displays visualizations of the 
                 processing steps. Defaults to False.
 
@@ -289,10 +785,10 @@ class CostSurface:
         assert path.exists(), f'The raw raster file path does not exist at path ${path}'
 
         ds = rasterio.open(path)
-        arr = ds.read(1)
+        raster = ds.read(1) if dtype is None else ds.read(1, out_dtype=dtype)
 
-        # Make a copy of the raw raster array to modify
-        raster = arr.copy()
+        # Keep a copy of the raw raster array to display
+        arr = raster.copy() if visualize else None
 
         # Set all values less than -1 to -1 to represent out of bounds/no-go
         raster[raster<-1]=-1
@@ -301,45 +797,40 @@ class CostSurface:
         if raster[0,0] != -1.0:
             # Find boundaries of valid data area
             (y1, x1), (y2, x2) = find_transitions(raster)
-            raster = raster[y1:y2, x1:x2]
+            raster = np.ascontiguousarray(raster[y1:y2, x1:x2])
 
         else:
             (y1, x1), (y2, x2) = (0, 0), (-1, -1)
 
         # Reset invalid values to -1 (no-go)
-        raster[raster==np.inf] = -1
-        raster[raster==-np.inf] = -1
+        raster[np.isinf(raster)] = -1
         
         # Special handling for visualization - set negative values to -inf for better display
-        if arr.min() < -1 and visualize:
+        if visualize and arr.min() < -1:
             arr[arr<-1] = -np.inf
 
         # Binary raster where 1=land (valid), 0=water/out-of-bounds (invalid)
-        check_bounds = raster.copy()
-        check_bounds[check_bounds>=0] = 1.0
-        check_bounds[check_bounds<0] = 0.0
+        check_bounds = (raster>=0).astype(np.uint8)
 
         # Use connected component analysis to identify islands not connected to mainland
-        contiguous, _ = get_contiguous_area(check_bounds.astype(np.uint8), min_size=1000)
+        contiguous = get_contiguous_area(check_bounds, min_size=1000)[0]
+        del check_bounds
 
         # Set isolated areas to no-go
-        raster[contiguous==0] = -1
+        raster[~contiguous] = -1
 
         # Create boolean mask for no-go areas (True where value < 0)
-        no_go = raster.copy()
-        no_go[no_go>=0] = 1
-        no_go[no_go<0] = 0
-        no_go = np.invert(no_go.astype(bool))
+        no_go = np.invert(raster>=0)
 
         # Temporarily set no-go areas to 0 for normalization
         # (This ensures they don't affect the min/max value calculations)
         raster[raster==-1] = 0
 
         # Apply exponential weighting to emphasize high-cost areas
-        raster = exponential(raster, degree)
+        exponential(raster, degree, out=raster)
 
         # Normalize all valid areas to 0-1 range
-        raster = normalize(raster)
+        normalize(raster, out=raster)
 
         # Reset no-go areas to maximum cost or user-specified value
         if no_go_cost is None:
@@ -351,6 +842,9 @@ class CostSurface:
         self.cost = raster
         self.no_go = no_go
 
+        # Label the regions for reachability checks
+        self.label_regions()
+
         if visualize:
             fig, ax = plt.subplots(nrows=2, ncols=2, figsize=(15,12))
             ax[0,0].imshow(arr[y1:y2, x1:x2], cmap='gray')
@@ -367,397 +861,3348 @@ class CostSurface:
 
             plt.show()
 
-class Node:
+class TiledArray:
     """
-    Node class for the Monte Carlo Tree Search algorithm.
-    
-    Each node represents a possible location in the pipeline route. Nodes form a 
-    tree structure with parent-child relationships, allowing for backtracking and
-    exploration of different possible routes.
-    
+    A read-only 2D view of one array of a TiledSurface.
+
+    Indexing with a (y, x) location returns a single value and indexing with
+    a pair of slices returns a new array assembled from the tiles they
+    overlap, so only the tiles a search window touches are ever processed.
+
     Attributes:
-        location (np.ndarray): The (y, x) coordinates of this node on the cost surface.
-        parent (Node): The parent node in the tree (None for root).
-        children (list): List of child nodes.
-        selections (int): Number of times this node has been selected during search.
-        reward (float): The immediate reward received for selecting this node.
-        value (float): The expected discounted returns from this state.
-        path (dict): Dictionary of visited locations using hash keys.
-        distance_factor (float): Weight for the euclidean distance component of rewards.
-        is_no_go (bool): Flag indicating whether this node is marked as no-go.
-        action_to_direction (dict): Mapping from action indices to direction vectors.
+        shape (tuple): The (height, width) of the whole surface.
+        dtype (np.dtype): The type of the values.
     """
 
-    def __init__(self, location, parent, reward, path, distance_factor=1.0):
+    ndim = 2
+
+    def __init__(self, surface, name, dtype):
         """
-        Initialize a Node object.
-        
         Args:
-            location (np.ndarray): The (y, x) coordinates of this node.
-            parent (Node): The parent node (None for root).
-            reward (float): The immediate reward for selecting this node.
-            path (dict): Dictionary of locations already visited in this path.
-            distance_factor (float, optional): Weight for euclidean distance in reward 
-                calculation. Defaults to 1.0.
+            surface (TiledSurface): The surface whose tiles hold the array.
+            name (str): The array of each tile, 'cost', 'no_go' or 'labels'.
+            dtype (np.dtype): The type of the values.
         """
-        self.location = location
-        self.parent = parent
-        self.children = []
-        self.selections = 0
-        self.reward = reward # Reward for the parent node selecting this node
-        self.value = 0       # Expected discounted returns when in this state
-        self.path = path
-        self.distance_factor=distance_factor
-        self.is_no_go = False  # New flag to mark nodes as no-go
-        self.action_to_direction = {
-            0: np.array([-1, 0]),  # Up
-            1: np.array([-1, 1]),  # Up/Right
-            2: np.array([0, 1]),   # Right
-            3: np.array([1, 1]),   # Down/Right
-            4: np.array([1, 0]),   # Down
-            5: np.array([1, -1]),  # Down/Left
-            6: np.array([0, -1]),  # Left
-            7: np.array([-1, -1]), # Up/Left
-        }
+        self.surface = surface
+        self.name = name
+        self.shape = surface.shape
+        self.dtype = np.dtype(dtype)
+
+    def __getitem__(self, key):
+        rows, cols = key
+        if not isinstance(rows, slice) and not isinstance(cols, slice):
+            y, x = int(rows), int(cols)
+            size = self.surface.tile_size
+            return self.surface.tile(y // size, x // size)[self.name][y % size, x % size]
+
+        rows = rows if isinstance(rows, slice) else slice(rows, rows + 1)
+        cols = cols if isinstance(cols, slice) else slice(cols, cols + 1)
+        top, bottom, row_step = rows.indices(self.shape[0])
+        left, right, col_step = cols.indices(self.shape[1])
+        assert row_step == 1 and col_step == 1, 'Tiled arrays only support contiguous slices'
+
+        size = self.surface.tile_size
+        out = np.empty((max(bottom - top, 0), max(right - left, 0)), dtype=self.dtype)
+        for ty in range(top // size, (bottom - 1) // size + 1 if bottom > top else 0):
+            for tx in range(left // size, (right - 1) // size + 1 if right > left else 0):
+                tile = self.surface.tile(ty, tx)[self.name]
+                y1, y2 = max(top, ty*size), min(bottom, (ty + 1)*size)
+                x1, x2 = max(left, tx*size), min(right, (tx + 1)*size)
+                out[y1 - top:y2 - top, x1 - left:x2 - left] = tile[y1 - ty*size:y2 - ty*size, x1 - tx*size:x2 - tx*size]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        # Reads every tile, only meant for small surfaces and tests
+        arr = self[:, :]
+        return arr if dtype is None else arr.astype(dtype)
+
+class TiledSurface:
+    """
+    A cost surface read lazily from a raster in fixed-size tiles.
+
+    Produces the same cost, no-go areas and regions as
+    CostSurface.process_raster without holding the whole raster in memory.
+    A first pass streams the raster once, one tile at a time, to find the
+    crop, label the contiguous land (merging the labels of neighbouring
+    tiles with a union-find) and collect the range used for normalization,
+    and a second pass labels the regions the same way.
+    Tiles are then processed on first use and kept in a least recently used
+    cache of at most cache_bytes. The arrays are exposed as TiledArray views,
+    so a search window can be sliced out of the cost and no-go areas like the
+    arrays of a CostSurface.
 
-    def mark_as_no_go(self):
-        """
-        Mark this node as no-go to prevent revisiting.
-        
-        This is used when a node is determined to be a dead end or otherwise
-        unsuitable for inclusion in the optimal path.
+    Attributes:
+        path (Path): The raw raster file.
+        shape (tuple): The (height, width) of the processed surface.
+        tile_size (int): The height and width of the tiles.
+        cache_bytes (int): The most bytes of processed tiles kept in memory.
+        cost (TiledArray): The normalized cost, see CostSurface.
+        no_go (TiledArray): The no-go areas, see CostSurface.
+        labels (TiledArray): The connected regions, see CostSurface. The
+            label numbers differ from CostSurface.labels but partition the
+            surface into the same regions.
+    """
+
+    def __init__(self, path, degree=2, no_go_cost=None, dtype=None, tile_size=512,
+                 cache_bytes=256*2**20, min_size=1000):
         """
-        self.is_no_go = True
+        Args:
+            path (str or Path): Path to the raw raster file to process.
+            degree (float, optional): See CostSurface.process_raster. Defaults to 2.
+            no_go_cost (float, optional): See CostSurface.process_raster.
+                Defaults to None.
+            dtype (np.dtype, optional): See CostSurface.process_raster.
+                Defaults to None.
+            tile_size (int, optional): Height and width of the tiles. Defaults
+                to 512.
+            cache_bytes (int, optional): Most bytes of processed tiles kept in
+                memory. Defaults to 256 MiB.
+            min_size (int, optional): Smallest number of cells a connected land
+                area needs to be routable, as in process_raster. Defaults to 1000.
 
-    def calculate_euclidean_reward(self, new_location, target_location):
+        Raises:
+            AssertionError: If the raw raster file does not exist.
+            ValueError: If tile_size or cache_bytes is smaller than 1.
         """
-        Calculate the euclidean reward component for a potential new location.
-        
-        The reward is based on how much closer the new location is to the target
-        compared to the current location. A small constant is subtracted to 
-        prevent purely distance-based movement.
-        
+        self.path = Path(path)
+        assert self.path.exists(), f'The raw raster file path does not exist at path ${self.path}'
+        if tile_size < 1 or cache_bytes < 1:
+            raise ValueError('tile_size and cache_bytes must be at least 1, got {} and {}'.format(
+                tile_size, cache_bytes))
+
+        self.degree = degree
+        self.no_go_cost = no_go_cost
+        self.tile_size = tile_size
+        self.cache_bytes = cache_bytes
+        self.levels = None
+        self._tiles = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+        with rasterio.open(self.path) as ds:
+            self._dtype = np.dtype(ds.dtypes[0] if dtype is None else dtype)
+            self._origin, self.shape = self._find_crop(ds)
+            self._label_tiles(ds, min_size)
+            self._label_regions(ds)
+
+        self.cost = TiledArray(self, 'cost', self._dtype)
+        self.no_go = TiledArray(self, 'no_go', bool)
+        self.labels = TiledArray(self, 'labels', np.int32)
+
+    def _read(self, ds, top, left, bottom, right):
+        """
+        Read a window of the raster with invalid values set to -1.
+
         Args:
-            new_location (np.ndarray): The potential new location to evaluate.
-            target_location (np.ndarray): The target destination location.
-            
+            ds (rasterio.DatasetReader): The open raster.
+            top, left, bottom, right (int): The window in raster indices.
+
         Returns:
-            float: The calculated euclidean reward component.
+            np.ndarray: The window of the raster.
         """
+        raster = ds.read(1, window=((top, bottom), (left, right)), out_dtype=self._dtype)
+        raster[raster<-1] = -1
+        return raster
 
-        ay = new_location[0]
-        ax = new_location[1]
-        py = self.location[0]
-        px = self.location[1]
-        ty = target_location[0]
-        tx = target_location[1]
+    def _find_crop(self, ds):
+        """
+        Find the valid area of the raster like find_transitions does.
 
-        # Calculate distance to target
-        distance_to_target = np.sqrt((ax-tx)**2 + (ay-ty)**2)
-        previous_distance = np.sqrt((px-tx)**2 + (py-ty)**2)
+        Args:
+            ds (rasterio.DatasetReader): The open raster.
 
-        # Subtract constant 1.42 to penalize lateral movement that doesn't make sufficient progress toward target
-        # This encourages more direct paths and discourages wandering behavior
-        euclidean_reward = self.distance_factor*(previous_distance - distance_to_target - 1.42)
+        Returns:
+            tuple: The (y, x) origin of the valid area in the raster and its
+                (height, width).
+        """
+        height, width = ds.height, ds.width
+        if self._read(ds, 0, 0, 1, 1)[0, 0] == -1.0:
+            return (0, 0), (height, width)
+
+        # Stream full-width strips, keeping the first and last rows with a
+        # horizontal transition and the first and last transition in them
+        first = last = None
+        for top in range(0, height, self.tile_size):
+            strip = self._read(ds, top, 0, min(top + self.tile_size, height), width)
+            rows, cols = np.nonzero(np.diff(strip))
+            if rows.size:
+                if first is None:
+                    first = (top + rows[0], cols[0])
+                last = (top + rows[-1], cols[-1])
+
+        (y1, x1), (y2, x2) = (int(first[0]) + 1, int(first[1]) + 1), (int(last[0]) + 1, int(last[1]) + 1)
+        return (y1, x1), (y2 - y1, x2 - x1)
+
+    def _read_tile(self, ds, ty, tx):
+        """
+        Read a tile of the cropped raster with invalid values set to -1.
 
-        return euclidean_reward
+        Args:
+            ds (rasterio.DatasetReader): The open raster.
+            ty, tx (int): The row and column of the tile.
 
-    def select(self, c=np.sqrt(2)):
+        Returns:
+            np.ndarray: The tile, smaller at the bottom and right edges.
         """
-        Select a child node to investigate using Upper Confidence Bound (UCB).
-        
-        This implements the UCB formula for balancing exploration and exploitation:
-        UCB = reward + value + c * sqrt(ln(parent_visits) / (child_visits + ε))
-        
+        y0, x0 = self._origin
+        top, left = ty*self.tile_size, tx*self.tile_size
+        bottom = min(top + self.tile_size, self.shape[0])
+        right = min(left + self.tile_size, self.shape[1])
+        raster = self._read(ds, y0 + top, x0 + left, y0 + bottom, x0 + right)
+        raster[np.isinf(raster)] = -1
+        return raster
+
+    def _label_tiles(self, ds, min_size):
+        """
+        Stream the raster once to find its contiguous land and cost range.
+
+        Land components of each tile get provisional ids, which are merged
+        with the components they touch in the tiles above and to the left.
+        Merged components larger than min_size are the contiguous land, the
+        rest is no-go.
+
         Args:
-            c (float, optional): Exploration parameter. Higher values encourage
-                more exploration. Defaults to sqrt(2).
-                
-        Returns:
-            Node or None: The selected child node with highest UCB score, or None
-                if no valid children exist.
+            ds (rasterio.DatasetReader): The open raster.
+            min_size (int): See __init__.
         """
-        high_score = -np.inf
-        selected_child = None
-        for child in self.children:
-            # Skip nodes marked as no-go (dead ends)
-            if child.is_no_go:
-                continue
-                
-            # UCB formula: balances exploitation (first terms) and exploration (last term)
-            ucb = child.reward + child.value + c*np.sqrt(np.log(self.selections)/(child.selections + 0.001))
+        size = self.tile_size
+        rows, cols = -(-self.shape[0] // size), -(-self.shape[1] // size)
+        parent, sizes, lows, highs, spans = [], [], [], [], {}
+        outside = []
+        above = np.full(self.shape[1], -1, dtype=np.int64)
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        def union(pairs):
+            for a, b in np.unique(pairs, axis=0):
+                a, b = find(a), find(b)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+
+        for ty in range(rows):
+            left_col = None
+            for tx in range(cols):
+                raster = self._read_tile(ds, ty, tx)
+                land = raster>=0
+                count, local, stats, _ = cv.connectedComponentsWithStats(land.astype(np.uint8), connectivity=4)
+
+                # Provisional ids of this tile's components, -1 outside the land
+                offset = len(parent)
+                spans[ty, tx] = (offset, offset + count - 1)
+                ids = np.where(land, local + offset - 1, -1)
+                parent.extend(range(offset, offset + count - 1))
+                sizes.extend(stats[1:, cv.CC_STAT_AREA])
+
+                # The range of the exponentiated cost: no-go cells count as 0,
+                # except values between -1 and 0 which keep their own
+                raster[raster==-1] = 0
+                raster **= self.degree
+                if not land.all():
+                    outside.append((raster[~land].min(), raster[~land].max()))
+                low = np.full(count, np.inf)
+                high = np.full(count, -np.inf)
+                np.minimum.at(low, local[land], raster[land])
+                np.maximum.at(high, local[land], raster[land])
+                lows.extend(low[1:])
+                highs.extend(high[1:])
+
+                # Merge with the components touching this tile from above and the left
+                x1 = tx*size
+                edge = ids[0]
+                top = above[x1:x1 + edge.size]
+                union(np.column_stack((top, edge))[(top >= 0) & (edge >= 0)])
+                if left_col is not None:
+                    edge = ids[:, 0]
+                    union(np.column_stack((left_col, edge))[(left_col >= 0) & (edge >= 0)])
+                above[x1:x1 + ids.shape[1]] = ids[-1]
+                left_col = ids[:, -1]
+
+        # Number the large enough merged components in order of appearance
+        roots = np.array([find(i) for i in range(len(parent))], dtype=np.int64)
+        merged = np.bincount(roots, weights=sizes, minlength=len(parent)) if len(parent) else np.zeros(0)
+        keep = merged > min_size
+        numbers = np.zeros(len(parent), dtype=np.int32)
+        numbers[keep] = np.arange(1, keep.sum() + 1)
+        labels = numbers[roots]
+        self._tile_land = {key: np.concatenate(([False], labels[a:b] > 0)) for key, (a, b) in spans.items()}
+
+        # Islands are no-go, so they count as 0 like the other no-go cells
+        ranges = outside + [(0, 0)]*bool((~keep).any())
+        contiguous = labels > 0
+        if contiguous.any():
+            ranges.append((np.array(lows)[contiguous].min(), np.array(highs)[contiguous].max()))
+        self._low = self._dtype.type(min(low for low, _ in ranges))
+        self._high = self._dtype.type(max(high for _, high in ranges))
+
+    def _tile_no_go(self, raster, key):
+        """
+        Find the no-go areas of a tile with the land labelled by _label_tiles.
 
-            if ucb > high_score:
-                high_score = ucb
-                selected_child = child
+        Args:
+            raster (np.ndarray): The tile, as read by _read_tile.
+            key (tuple): The (row, column) of the tile.
 
-        return selected_child
+        Returns:
+            tuple: The boolean no-go areas and land of the tile.
+        """
+        land = raster>=0
+        _, local = cv.connectedComponents(land.astype(np.uint8), connectivity=4)
+        return ~self._tile_land[key][local], land
 
-    def expand(self, cost_surface, target_location):
+    def _tile_components(self, no_go):
         """
-        Expand the current node by generating all valid child nodes.
-        
-        This method creates child nodes for all possible actions from the current
-        location, checking for validity (not in path, not out of bounds, etc.).
-        
+        Label the components regions are made of inside a tile.
+
         Args:
-            cost_surface (np.ndarray): The cost surface to use for cost rewards.
-            target_location (np.ndarray): The target destination.
-            
+            no_go (np.ndarray): The no-go areas of the tile.
+
         Returns:
-            self: Returns the node itself after expansion.
+            tuple: The number and labels of the 8-connected components
+                outside the no-go areas, and the number, labels and stats of
+                the 4-connected no-go components, see CostSurface.label_regions.
         """
-        rewards = []
-        for a in self.action_to_direction.values():
-            child_location = a + self.location
-            location_hash_key = str(child_location[0]).zfill(3) \
-                                + ',' + str(child_location[1]).zfill(3)
+        land_count, land = cv.connectedComponents(np.invert(no_go).astype(np.uint8), connectivity=8)
+        no_go_count, areas, stats, _ = cv.connectedComponentsWithStats(no_go.astype(np.uint8), connectivity=4)
+        return land_count, land, no_go_count, areas, stats
 
-            # Do not allow path to cross with itself
-            if location_hash_key in self.path:
-                continue
+    def _label_regions(self, ds):
+        """
+        Stream the raster a second time to label the regions like
+        CostSurface.label_regions.
 
-            cost_reward = -cost_surface[child_location[0], child_location[1]]
+        The 8-connected components outside the no-go areas and the
+        4-connected no-go components of each tile get provisional ids, and
+        are merged with the components of the same kind they touch in the
+        tiles above and to the left. Merged no-go components reaching the
+        edge of the surface are outside every region, the others then join
+        the regions they touch.
 
-            # Do not allow out of bounds moves or moves into no-go areas
-            if cost_reward == 1:
-                continue
+        Args:
+            ds (rasterio.DatasetReader): The open raster.
+        """
+        size = self.tile_size
+        height, width = self.shape
+        rows, cols = -(-height // size), -(-width // size)
+        parent, edge, spans, contacts = [], [], {}, []
+        above = np.full(width + 1, -1, dtype=np.int64)
+        above_no_go = np.zeros(width + 1, dtype=bool)
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        def union(pairs):
+            for a, b in np.unique(pairs, axis=0):
+                a, b = find(a), find(b)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+
+        def touch(first, second, first_no_go, second_no_go, diagonal=False):
+            # Merge neighbours of the same kind and keep the (other, no-go)
+            # contacts, diagonal neighbours only join cells outside no-go areas
+            valid = (first >= 0) & (second >= 0)
+            pairs = np.column_stack((first, second))
+            if diagonal:
+                union(pairs[valid & ~first_no_go & ~second_no_go])
+                return
+            union(pairs[valid & (first_no_go == second_no_go)])
+            mixed = valid & (first_no_go != second_no_go)
+            contacts.append(np.column_stack((np.where(first_no_go, second, first)[mixed],
+                                             np.where(first_no_go, first, second)[mixed])))
+
+        for ty in range(rows):
+            corner, corner_no_go = -1, False
+            left_col = left_no_go = None
+            for tx in range(cols):
+                no_go = self._tile_no_go(self._read_tile(ds, ty, tx), (ty, tx))[0]
+                land_count, land, no_go_count, areas, stats = self._tile_components(no_go)
+
+                # Provisional ids of this tile's components, the land first
+                offset = len(parent)
+                spans[ty, tx] = (offset, land_count - 1, no_go_count - 1)
+                ids = np.where(no_go, areas + offset + land_count - 2, land + offset - 1).astype(np.int64)
+                parent.extend(range(offset, offset + land_count + no_go_count - 2))
+
+                # No-go components reaching the edge of the surface
+                y1, x1 = ty*size, tx*size
+                left, top = stats[1:, cv.CC_STAT_LEFT] + x1, stats[1:, cv.CC_STAT_TOP] + y1
+                edge.extend([False]*(land_count - 1))
+                edge.extend((left == 0) | (top == 0) | (left + stats[1:, cv.CC_STAT_WIDTH] == width)
+                            | (top + stats[1:, cv.CC_STAT_HEIGHT] == height))
+
+                # Contacts between no-go and other cells inside the tile
+                for first, second, first_no_go, second_no_go in (
+                        (ids[:, :-1], ids[:, 1:], no_go[:, :-1], no_go[:, 1:]),
+                        (ids[:-1], ids[1:], no_go[:-1], no_go[1:])):
+                    mixed = first_no_go != second_no_go
+                    contacts.append(np.column_stack((np.where(first_no_go, second, first)[mixed],
+                                                     np.where(first_no_go, first, second)[mixed])))
+
+                # Merge with the tile above, the row above padded with the
+                # corner cells of the tiles to its left and right
+                x2 = x1 + ids.shape[1]
+                row = np.concatenate(([corner], above[x1:x2 + 1]))
+                row_no_go = np.concatenate(([corner_no_go], above_no_go[x1:x2 + 1]))
+                touch(row[1:-1], ids[0], row_no_go[1:-1], no_go[0])
+                touch(row[:-2], ids[0], row_no_go[:-2], no_go[0], diagonal=True)
+                touch(row[2:], ids[0], row_no_go[2:], no_go[0], diagonal=True)
+
+                # Merge with the tile to the left, whose corners are covered
+                # by the rows above
+                if left_col is not None:
+                    touch(left_col, ids[:, 0], left_no_go, no_go[:, 0])
+                    touch(left_col[:-1], ids[1:, 0], left_no_go[:-1], no_go[1:, 0], diagonal=True)
+                    touch(left_col[1:], ids[:-1, 0], left_no_go[1:], no_go[:-1, 0], diagonal=True)
+
+                corner, corner_no_go = above[x2 - 1], above_no_go[x2 - 1]
+                above[x1:x2] = ids[-1]
+                above_no_go[x1:x2] = no_go[-1]
+                left_col, left_no_go = ids[:, -1], no_go[:, -1]
+
+        # Find the merged no-go components outside the regions and join the
+        # others to the regions they touch
+        outside = np.zeros(len(parent), dtype=bool)
+        for i in np.flatnonzero(edge):
+            outside[find(i)] = True
+        contacts = np.unique(np.concatenate(contacts), axis=0) if contacts else np.zeros((0, 2), dtype=np.int64)
+        roots = np.array([find(i) for i in contacts[:, 1]], dtype=np.int64)
+        union(contacts[~outside[roots]])
+
+        # Number the regions in order of appearance
+        roots = np.array([find(i) for i in range(len(parent))], dtype=np.int64)
+        outside = outside[roots]
+        numbers = np.zeros(len(parent), dtype=np.int32)
+        first = np.unique(roots[~outside])
+        numbers[first] = np.arange(1, first.size + 1)
+        labels = np.where(outside, 0, numbers[roots])
+        self._tile_labels = {}
+        for key, (offset, land_count, no_go_count) in spans.items():
+            middle = offset + land_count
+            self._tile_labels[key] = (np.concatenate(([0], labels[offset:middle])).astype(np.int32),
+                                      np.concatenate(([0], labels[middle:middle + no_go_count])).astype(np.int32))
+
+    def tile(self, ty, tx):
+        """
+        Get a processed tile, processing it on first use.
 
-            if np.array_equal(child_location, target_location):
-                reward = 100
-            else:
-                euclidean_reward = self.calculate_euclidean_reward(child_location, target_location)
-                reward = euclidean_reward + cost_reward*2
-            
-            path = self.path.copy()
-            path[location_hash_key] = True
-            child = Node(child_location, self, reward, path, self.distance_factor)
-            self.children.append(child)
-            rewards.append(reward)
-            
-        self.value = np.mean(rewards)
-    
-    def backpropagate(self, discount=0.98):
+        Args:
+            ty, tx (int): The row and column of the tile.
+
+        Returns:
+            dict: The 'cost', 'no_go' and 'labels' arrays of the tile.
         """
-        Backpropagate values up the tree to update parent nodes.
-        
-        This recursively updates the value estimates of parent nodes based on 
-        the discounted value of this node.
-        
+        key = (ty, tx)
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                return tile
+
+        # Open the raster per tile, datasets can't be shared between threads
+        with rasterio.open(self.path) as ds:
+            raster = self._read_tile(ds, ty, tx)
+        no_go, land = self._tile_no_go(raster, key)
+        _, regions, _, areas, _ = self._tile_components(no_go)
+        region_labels, no_go_labels = self._tile_labels[key]
+        labels = np.where(no_go, no_go_labels[areas], region_labels[regions])
+        del regions, areas
+
+        # The steps of process_raster, normalized with the range of the whole raster
+        raster[land & no_go] = -1
+        raster[raster==-1] = 0
+        raster **= self.degree
+        if self._high == self._low:
+            raster[...] = 0.5
+        else:
+            raster -= self._low
+            raster /= self._high - self._low
+        raster[no_go] = 1 if self.no_go_cost is None else self.no_go_cost
+
+        tile = {'cost': raster, 'no_go': no_go, 'labels': labels}
+        with self._lock:
+            if key not in self._tiles:
+                self._tiles[key] = tile
+                self._cached_bytes += sum(arr.nbytes for arr in tile.values())
+                while self._cached_bytes > self.cache_bytes and len(self._tiles) > 1:
+                    _, evicted = self._tiles.popitem(last=False)
+                    self._cached_bytes -= sum(arr.nbytes for arr in evicted.values())
+            return self._tiles[key]
+
+    def region(self, location):
+        """
+        Get the connected region of a location, see CostSurface.region.
+
         Args:
-            discount (float, optional): Discount factor for future values.
-                Defaults to 0.98.
+            location (array_like): The (y, x) location.
+
+        Returns:
+            int: The label of the region, 0 if no route can enter the location.
         """
-        self.parent.value += (self.value*discount - self.parent.value)/self.parent.selections
-        if self.parent.parent is not None:
-            self.parent.backpropagate()
-            self.parent.selections += 1
+        return int(self.labels[location[0], location[1]])
 
-    # def rollout(self, num_moves=100):
-    #     for move in num_moves:
+    def reachable(self, start, target):
+        """
+        Check whether a route can join two locations, see CostSurface.reachable.
+
+        Args:
+            start (array_like): The (y, x) location of the start.
+            target (array_like): The (y, x) location of the target.
+
+        Returns:
+            bool: True if both locations lie in the same region.
+        """
+        region = self.region(start)
+        return region != 0 and region == self.region(target)
+
+class Overlay:
+    """
+    Sparse cost changes applied on top of a shared cost surface.
+
+    An overlay holds the changed cells rather than a changed copy of the
+    surface, so it can be built once and applied to any window of the
+    surface. Applying it copies only the array it is applied to, and only
+    when some of its cells fall inside, leaving the shared surface untouched.
 
-class MCTree:
-    """
-    Monte Carlo Tree Search implementation for pipeline routing.
-    
-    This class represents a search tree where each node corresponds to a location on the 
-    cost surface. The tree is used to find the optimal path from a starting location to a 
-    target location by exploring the state space using Monte Carlo Tree Search principles.
-    
     Attributes:
-        cost_surface (np.ndarray): The cost surface used for calculating move costs.
-        target (np.ndarray): The target destination coordinates.
-        distance_factor (float): Weight factor for distance in reward calculations.
-        root (Node): The root node of the tree representing the starting location.
+        shape (tuple): The (height, width) of the surface the cells index.
+        rows (np.ndarray): The rows of the changed cells, sorted.
+        cols (np.ndarray): The columns of the changed cells.
+        cost (float): The cost the cells are set to, -1 to exclude them.
+        key (str): Hash of the shape, cells and cost, equal for overlays
+            making the same changes.
     """
 
-    def __init__(self, cost_surface, start, target, distance_factor=1.0):
+    def __init__(self, shape, rows, cols, cost=-1):
         """
-        Initialize a Monte Carlo Tree.
-        
         Args:
-            cost_surface (np.ndarray): The cost surface used for calculating move costs.
-            start (np.ndarray): The starting location coordinates.
-            target (np.ndarray): The target destination coordinates.
-            distance_factor (float, optional): Weight for euclidean distance in reward 
-                calculation. Defaults to 1.0.
+            shape (tuple): The (height, width) of the surface.
+            rows (array_like): The rows of the changed cells.
+            cols (array_like): The columns of the changed cells.
+            cost (float, optional): The cost the cells are set to. Defaults
+                to -1, excluding them from routes.
         """
-        self.cost_surface = cost_surface
-        self.target = target
-        self.distance_factor = distance_factor
-        path = {str(start[0]).zfill(3) + ',' + str(start[1]).zfill(3): True}
-        self.root = Node(location=start, parent=None, reward=None, path=path, distance_factor=distance_factor)
+        cells = np.unique(np.ravel_multi_index((np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)), shape))
+        self.shape = tuple(shape)
+        self.rows, self.cols = np.unravel_index(cells, shape)
+        self.cost = cost
+        self.key = hashlib.sha1(repr((self.shape, cost)).encode() + cells.astype(np.int64).tobytes()).hexdigest()
+
+    @classmethod
+    def from_mask(cls, mask, top=0, left=0, shape=None, cost=-1):
+        """
+        Build an overlay from a boolean mask of cells.
 
-    def traverse(self, node):
+        Args:
+            mask (np.ndarray): Boolean array of the cells to change.
+            top (int, optional): Row of the surface the mask starts at.
+                Defaults to 0.
+            left (int, optional): Column of the surface the mask starts at.
+                Defaults to 0.
+            shape (tuple, optional): The (height, width) of the surface.
+                Defaults to None, the shape of the mask.
+            cost (float, optional): See __init__. Defaults to -1.
+
+        Returns:
+            Overlay: The overlay of the masked cells.
         """
-        Traverse the tree starting from the given node and return all locations.
-        
-        This method recursively collects all locations in the subtree rooted at 
-        the specified node.
-        
+        rows, cols = np.nonzero(mask)
+        return cls(mask.shape if shape is None else shape, rows + top, cols + left, cost=cost)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def cells_in(self, top, left, bottom, right):
+        """
+        Get the changed cells inside a window of the surface.
+
         Args:
-            node (Node): The node to start traversal from.
-            
+            top, left, bottom, right (int): The window, see search_window.
+
         Returns:
-            list: A list of all location coordinates in the subtree.
+            tuple: The rows and columns of the cells, relative to the window.
         """
-        # Traverse the tree and return the path
-        locations = [node.location.tolist()]
-        for child in node.children:
-            locations.extend(self.traverse(child))
-        return locations   
+        first, last = np.searchsorted(self.rows, (top, bottom))
+        rows, cols = self.rows[first:last], self.cols[first:last]
+        inside = (cols >= left) & (cols < right)
+        return rows[inside] - top, cols[inside] - left
 
-    def select_root(self, new_root):
+    def apply(self, surface, top=0, left=0):
         """
-        Select a new root node without deleting parent connections.
-        
-        This method allows for re-rooting the tree at a different node, which is useful
-        when committing to a particular path segment during search.
-        
+        Apply the overlay to a cost surface or a window of it.
+
         Args:
-            new_root (str or Node): Either a string representation of the location
-                (format: "y,x" with 3-digit zero padding) or a Node object to become
-                the new root.
-                
-        Raises:
-            ValueError: If the specified node cannot be found or if trying to set
-                the root to the target node.
-            AssertionError: If new_root is not a string or Node, or if it equals the target.
+            surface (np.ndarray): The cost surface, or the window of it
+                starting at (top, left).
+            top (int, optional): Row of the surface the window starts at.
+                Defaults to 0.
+            left (int, optional): Column of the surface the window starts at.
+                Defaults to 0.
+
+        Returns:
+            np.ndarray: A copy of the array with the overlay's cells changed,
+                or the array itself if none of them fall inside it.
         """
-        if isinstance(new_root, str):
-            next_root_found = False
-            for child in self.root.children:
-                location = str(child.location[0]).zfill(3) + ',' + str(child.location[1]).zfill(3)
+        rows, cols = self.cells_in(top, left, top + surface.shape[0], left + surface.shape[1])
+        if not len(rows):
+            return surface
+        surface = surface.copy()
+        surface[rows, cols] = self.cost
+        return surface
+
+    def coarsen(self, factor, keep=()):
+        """
+        Map the overlay to a grid factor times coarser, see block_mean.
 
-                if new_root == location:
-                    new_root = child
-                    next_root_found = True
-                    break
-            if not next_root_found:
-                child_locations = [child.location for child in self.root.children]
-                raise ValueError('Unable to find the child node at {} from following locations: {}'.format(new_root, child_locations))
+        A coarse cell is changed when any of the cells it covers is, the
+        block max of the changed cells, so routes on the coarse grid keep
+        clear of every excluded cell.
+
+        Args:
+            factor (int): The side length of the blocks of the coarse grid.
+            keep (iterable, optional): (y, x) locations of the coarse grid
+                left unchanged, such as the start and target of a route.
+                Defaults to ().
+
+        Returns:
+            Overlay: The overlay of the coarse grid.
+        """
+        shape = (-(-self.shape[0]//factor), -(-self.shape[1]//factor))
+        rows, cols = self.rows//factor, self.cols//factor
+        for y, x in keep:
+            kept = (rows != y) | (cols != x)
+            rows, cols = rows[kept], cols[kept]
+        return Overlay(shape, rows, cols, cost=self.cost)
+
+    def excludes(self, location):
+        """
+        Check whether the overlay excludes a location from routes.
+
+        Args:
+            location (array_like): The (y, x) location.
+
+        Returns:
+            bool: True if the overlay sets the location to -1.
+        """
+        return self.cost == -1 and len(self.cells_in(location[0], location[1], location[0] + 1, location[1] + 1)[0]) > 0
+
+def polygon_overlay(shape, polygons, cost=-1):
+    """
+    Rasterize polygons to the surface grid as an overlay.
+
+    Each polygon is filled on a canvas covering only its bounding box.
+    Overlays are cached by a hash of the grid, polygons and cost, so a
+    repeated exclusion is rasterized only once per process.
+
+    Args:
+        shape (tuple): The (height, width) of the surface.
+        polygons (list): Polygons as lists of (y, x) vertices in cell
+            indices, such as the output of CoordinatesToIndices.
+        cost (float, optional): See Overlay. Defaults to -1, excluding the
+            polygons from routes.
+
+    Returns:
+        Overlay: The overlay of the cells the polygons cover.
+    """
+    vertices = [np.asarray(polygon, dtype=np.float64).reshape(-1, 2) for polygon in polygons]
+    digest = hashlib.sha1(repr((tuple(shape), cost)).encode())
+    for polygon in vertices:
+        digest.update(np.int64(len(polygon)).tobytes())
+        digest.update(polygon.tobytes())
+    key = digest.hexdigest()
+
+    with _overlay_lock:
+        overlay = _overlay_cache.get(key)
+        if overlay is not None:
+            _overlay_cache.move_to_end(key)
+            return overlay
+
+    rows, cols = [], []
+    for polygon in vertices:
+        points = np.rint(polygon).astype(np.int64)
+        top, left = np.maximum(points.min(axis=0), 0)
+        bottom, right = np.minimum(points.max(axis=0) + 1, shape)
+        if bottom <= top or right <= left:
+            continue
+        canvas = np.zeros((bottom - top, right - left), dtype=np.uint8)
+        cv.fillPoly(canvas, [(points[:, ::-1] - (left, top)).astype(np.int32)], 1)
+        y, x = np.nonzero(canvas)
+        rows.append(y + top)
+        cols.append(x + left)
+
+    overlay = Overlay(shape, np.concatenate(rows or [[]]), np.concatenate(cols or [[]]), cost=cost)
+    with _overlay_lock:
+        _overlay_cache[key] = overlay
+        while len(_overlay_cache) > OVERLAY_CACHE_SIZE:
+            _overlay_cache.popitem(last=False)
+    return overlay
+
+def cell_index(location, width):
+    """
+    Get the flat integer index identifying a cell of a surface.
+
+    Cells are identified by y*width + x throughout the search engine, which
+    avoids formatting, hashing and parsing location strings and places no
+    limit on the size of the surface.
+
+    Args:
+        location (array_like): The (y, x) location of the cell.
+        width (int): The width of the surface.
+
+    Returns:
+        int: The flat index of the cell.
+    """
+    return int(location[0])*width + int(location[1])
+
+def cell_location(cell, width):
+    """
+    Get the (y, x) location of a cell from its flat index.
+
+    Args:
+        cell (int): The flat index of the cell, see cell_index.
+        width (int): The width of the surface.
+
+    Returns:
+        tuple: The (y, x) location of the cell.
+    """
+    return divmod(int(cell), width)
+
+class VisitedSet:
+    """
+    The set of grid cells on the path from the tree root to the current node.
+
+    A single VisitedSet is shared by every node of a tree, so expanding a node
+    never copies the path history. Each cell holds an integer stamp: cells on
+    the committed route (the current root and its ancestors) hold the base
+    stamp, and cells visited while descending the tree during a search
+    trajectory hold that trajectory's generation. Starting a new trajectory
+    only increments the generation, which invalidates every stamp from earlier
+    trajectories at once, so insertion, lookup and reset are constant time.
+
+    Cells are identified by their flat index (see cell_index).
+
+    Attributes:
+        stamps (np.ndarray): Per-cell stamps, indexed by flat cell index.
+        width (int): The width of the cost surface.
+        base (int): Stamp marking cells on the committed route.
+        generation (int): Stamp marking cells visited in the current trajectory.
+    """
+
+    def __init__(self, shape):
+        """
+        Initialize an empty visited set.
+
+        Args:
+            shape (tuple): The (height, width) of the cost surface.
+        """
+        self.stamps = np.zeros(shape[0]*shape[1], dtype=np.int32)
+        self.width = shape[1]
+        self.base = 1
+        self.generation = 1
+
+    def __contains__(self, cell):
+        stamp = self.stamps[cell]
+        return stamp == self.base or stamp == self.generation
+
+    def contains(self, cells):
+        """
+        Vectorized membership test for several cells at once.
+
+        Args:
+            cells (np.ndarray): The flat indices of the cells.
+
+        Returns:
+            np.ndarray: Boolean array, True where the cell is in the set.
+        """
+        stamps = self.stamps[cells]
+        return (stamps == self.base) | (stamps == self.generation)
+
+    def begin_trajectory(self):
+        """
+        Forget the cells visited by the previous search trajectory.
+        """
+        self.generation += 1
+
+    def add(self, cell):
+        """
+        Add a cell visited during the current search trajectory.
+
+        Args:
+            cell (int): The flat index of the cell.
+        """
+        self.stamps[cell] = self.generation
+
+    def commit(self, cell):
+        """
+        Add a cell to the committed route so it is visited in every trajectory.
+
+        Args:
+            cell (int): The flat index of the cell.
+        """
+        self.stamps[cell] = self.base
+
+    def release(self, cell):
+        """
+        Remove a cell from the committed route, e.g. after backtracking.
+
+        Args:
+            cell (int): The flat index of the cell.
+        """
+        self.stamps[cell] = 0
+
+class TranspositionTable:
+    """
+    Visit statistics shared by every node of a tree that reaches the same cell.
+
+    A tree holds a separate node for each order of moves reaching a cell.
+    With a transposition table these nodes pool their evidence: selection
+    reads the visits and value of a child from the entry of its cell, and
+    backpropagation backs up the pooled value. Entries are keyed by flat cell
+    index and belong to the search root they were recorded under, since the
+    cells a route may still visit depend on the committed path. Moving the
+    root starts a new generation, and an entry of an older generation is
+    replaced by the statistics of the first node that reaches its cell again.
+    The memory used is fixed by the number of cells of the surface, however
+    many trajectories are searched.
+
+    Attributes:
+        selections (np.ndarray): Pooled visit count of each cell.
+        value (np.ndarray): Pooled value of each cell.
+        stamps (np.ndarray): Generation each entry was recorded in.
+        generation (int): Generation of the current search root.
+    """
+
+    def __init__(self, shape):
+        """
+        Initialize an empty transposition table.
+
+        Args:
+            shape (tuple): The (height, width) of the cost surface.
+        """
+        self.selections = np.zeros(shape[0]*shape[1], dtype=np.int64)
+        self.value = np.zeros(shape[0]*shape[1], dtype=np.float64)
+        self.stamps = np.zeros(shape[0]*shape[1], dtype=np.int32)
+        self.generation = 1
+
+    def new_root(self):
+        """
+        Invalidate every entry after the search root has moved.
+        """
+        self.generation += 1
+
+    def lookup(self, cells, selections, values):
+        """
+        Get the pooled statistics of one or more cells.
+
+        Args:
+            cells (int or np.ndarray): The flat cell indices.
+            selections (int or np.ndarray): Visits of the nodes at the cells,
+                used for entries of older generations.
+            values (float or np.ndarray): Values of the nodes at the cells,
+                used for entries of older generations.
+
+        Returns:
+            tuple: The (selections, values) of the cells.
+        """
+        current = self.stamps[cells] == self.generation
+        return np.where(current, self.selections[cells], selections), np.where(current, self.value[cells], values)
+
+    def record(self, cell, selections, value):
+        """
+        Add a visit of a node to the entry of its cell.
 
+        Args:
+            cell (int): The flat cell index of the node.
+            selections (int): Visits of the node including this one, used to
+                start an entry of an older generation.
+            value (float): The value of the node after the visit.
+
+        Returns:
+            float: The pooled value of the cell.
+        """
+        if self.stamps[cell] != self.generation:
+            self.stamps[cell] = self.generation
+            self.selections[cell] = selections
+            self.value[cell] = value
         else:
-            assert isinstance(new_root, Node), 'new_root must be str or Node'
+            self.selections[cell] += 1
+            self.value[cell] += (value - self.value[cell])/self.selections[cell]
+        return self.value[cell]
 
-        assert isinstance(new_root, Node)
-        assert not np.array_equal(new_root.location, self.target), 'Root node cannot be terminal node'
-        self.root = new_root  # Simply update the root pointer without deleting anything
+def _neighbour_groups():
+    """
+    Count the groups of open cells around a cell for every neighbourhood.
 
-def search(root, target, num_trajectories, cost_surface, c=np.sqrt(2)):
+    Returns:
+        np.ndarray: uint8 array indexed by the bitmask of the open neighbours in
+            ACTION_DIRECTIONS order, holding how many 8-connected groups they
+            form once the centre cell is removed.
     """
-    Perform Monte Carlo Tree Search from a given root node.
-    
-    This function implements the core MCTS algorithm, consisting of:
-    1. Selection: Traverse the tree from root to leaf following UCB policy
-    2. Expansion: When a leaf node is reached, expand by creating child nodes
-    3. Backpropagation: Update node values based on the search results
-    
-    The search continues until a specified number of trajectories are explored or
-    a terminal state (target) is reached. Nodes that lead to dead ends are marked
-    as no-go to avoid revisiting them.
-    
+    groups = np.zeros(256, dtype=np.uint8)
+    for mask in range(256):
+        directions = ACTION_DIRECTIONS[[bit for bit in range(8) if mask >> bit & 1]]
+        labels = list(range(len(directions)))
+        for i in range(len(directions)):
+            for j in range(i):
+                if np.abs(directions[i] - directions[j]).max() == 1:
+                    old, new = labels[i], labels[j]
+                    labels = [new if label == old else label for label in labels]
+        groups[mask] = len(set(labels))
+    return groups
+
+NEIGHBOUR_GROUPS = _neighbour_groups()
+
+def dead_pockets(cost_surface, start, target, walls=None, max_size=4096):
+    """
+    Find the cells a route from start to target can never usefully enter.
+
+    Routes may not visit a cell twice, so a route that enters a pocket through
+    a one cell wide mouth can never leave it again. Three kinds of dead cells
+    are found with flood fills:
+
+    1. Cells that are not connected to the target at all.
+    2. Pockets of up to max_size cells that are enclosed except for a one cell
+       mouth, found by filling the groups around every cell whose open
+       neighbours fall apart when it is removed.
+    3. Dead-end spurs, cells with a single open neighbour.
+
+    Steps 2 and 3 repeat until no more cells are found, so nested pockets and
+    the mouths of spurs are found too. Pockets holding a start or the target
+    are never dead.
+
     Args:
-        root (Node): The root node to start the search from.
-        target (np.ndarray): The target destination coordinates.
-        num_trajectories (int): The number of search trajectories to perform.
-        cost_surface (np.ndarray): The cost surface for calculating move costs.
-        c (float, optional): Exploration parameter for UCB formula. Defaults to sqrt(2).
-        
+        cost_surface (np.ndarray): The cost surface, with -1 marking impassable cells.
+        start (array_like): The (y, x) location of the start, or an (n, 2)
+            array of the starts of several routes to the target.
+        target (array_like): The (y, x) location of the target.
+        walls (np.ndarray, optional): Boolean array of further cells that
+            count as walls, such as CostSurface.no_go. Defaults to None.
+        max_size (int, optional): Largest pocket searched for. Defaults to 4096.
+
     Returns:
-        tuple: A tuple containing (root_node, next_node) where next_node is the best
-            child to move to, or (None, None) if no valid path exists.
+        np.ndarray: Boolean array, True for the dead cells.
     """
+    height, width = cost_surface.shape
+    starts = np.reshape(start, (-1, 2))
+    passable = cost_surface != -1
+    if walls is not None:
+        passable &= ~walls
+    passable[starts[:, 0], starts[:, 1]] = passable[target[0], target[1]] = True
+    keep = np.zeros(cost_surface.shape, dtype=bool)
+    keep[starts[:, 0], starts[:, 1]] = keep[target[0], target[1]] = True
+
+    _, labels = cv.connectedComponents(passable.astype(np.uint8), connectivity=8)
+    dead = passable & (labels != labels[target[0], target[1]])
+
+    radius = int(np.sqrt(max_size))
+    changed = True
+    while changed:
+        changed = False
+        open_cells = np.pad(passable & ~dead, 1)
+        neighbours = np.zeros(cost_surface.shape, dtype=np.int32)
+        count = np.zeros(cost_surface.shape, dtype=np.int32)
+        for bit, (dy, dx) in enumerate(ACTION_DIRECTIONS):
+            shifted = open_cells[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+            neighbours |= shifted.astype(np.int32) << bit
+            count += shifted
+        open_cells = open_cells[1:-1, 1:-1]
+
+        # Dead-end spurs
+        spurs = open_cells & (count <= 1) & ~keep
+        if spurs.any():
+            dead |= spurs
+            changed = True
+            continue
 
-    for _ in range(num_trajectories):
+        # Pockets behind the cells that split their neighbourhood in two
+        for y, x in np.argwhere(open_cells & (NEIGHBOUR_GROUPS[neighbours] > 1)):
+            if dead[y, x]:
+                continue
+            top, left = max(y - radius, 0), max(x - radius, 0)
+            bottom, right = min(y + radius + 1, height), min(x + radius + 1, width)
+            window = passable[top:bottom, left:right] & ~dead[top:bottom, left:right]
+            window[y - top, x - left] = False
+            _, groups, stats, _ = cv.connectedComponentsWithStats(window.astype(np.uint8), connectivity=8)
+
+            around = groups[max(y - top - 1, 0):y - top + 2, max(x - left - 1, 0):x - left + 2]
+            for group in np.unique(around[around > 0]):
+                # A group reaching the edge of the window may continue beyond it
+                group_left, group_top, group_width, group_height, _ = stats[group]
+                if (top and group_top == 0) or (left and group_left == 0) \
+                        or (bottom < height and group_top + group_height == bottom - top) \
+                        or (right < width and group_left + group_width == right - left):
+                    continue
+                pocket = groups == group
+                if (pocket & keep[top:bottom, left:right]).any():
+                    continue
+                dead[top:bottom, left:right] |= pocket
+                changed = True
+
+    return dead
+
+def cost_to_go(cost_surface, target, cost_weight=1.0):
+    """
+    Compute the accumulated cost of travelling from every cell to the target.
 
-        # Track visits to root for UCB calculations
-        root.selections += 1
-        current_node = root
-        backtracked = False
+    Each cell costs 1 + cost_weight*cost per unit of distance travelled across
+    it, so in free terrain the field equals the distance to the target, while
+    cells behind high cost barriers are as far away as the cheapest detour
+    around them. The field is solved once for all cells with
+    skimage.graph.MCP_Geometric.
 
-        # MCTS Selection phase: traverse tree until reaching a leaf node
-        while current_node.children:
-            
-            # Select new child node to investigate using Upper Confidence Bound (UCB)
-            selected_child = current_node.select(c=c)
+    Args:
+        cost_surface (np.ndarray): The cost surface, with -1 marking impassable cells.
+        target (array_like): The (y, x) location of the target.
+        cost_weight (float, optional): Distance units added per unit of cost.
+            Defaults to 1.0.
 
-            # Dead end detection - if all children are no-go, mark current node as no-go too
-            if selected_child is None:
-                
-                # Flag to indicate that the current node has been backtracked
-                backtracked = True
-                
-                # Set the current node as no-go
-                current_node.mark_as_no_go()
+    Returns:
+        np.ndarray: float64 array of the accumulated cost from each cell to the
+            target, np.inf for impassable cells and cells that cannot reach it.
+    """
+    costs = 1 + cost_weight*np.asarray(cost_surface, dtype=np.float64)
+    costs[cost_surface == -1] = -1
+    field, _ = MCP_Geometric(costs).find_costs([(int(target[0]), int(target[1]))])
+    return field
+
+def search_window(shape, start, target, margin):
+    """
+    Get the window of a surface around an origin-destination pair.
+
+    Args:
+        shape (tuple): The (height, width) of the surface.
+        start (array_like): The (y, x) location of the start.
+        target (array_like): The (y, x) location of the target.
+        margin (int): Number of cells the window extends beyond the bounding
+            box of start and target on every side.
+
+    Returns:
+        tuple: The (top, left, bottom, right) bounds of the window, clipped to
+            the surface, with bottom and right exclusive.
+    """
+    return (
+        max(min(start[0], target[0]) - margin, 0), max(min(start[1], target[1]) - margin, 0),
+        min(max(start[0], target[0]) + margin + 1, shape[0]), min(max(start[1], target[1]) + margin + 1, shape[1])
+        )
+
+def exact_route(cost_surface, start, target, cost_weight=1.0, blocked=(), margin=32):
+    """
+    Find the least cost route between two cells with a deterministic solver.
+
+    Cells are weighted like in cost_to_go. The route is first solved with
+    skimage.graph.MCP_Geometric inside the corridor spanned by start and target
+    and widened by margin cells on every side, and on the whole surface only
+    when the target cannot be reached inside the corridor.
+
+    Args:
+        cost_surface (np.ndarray): The cost surface, with -1 marking impassable cells.
+        start (array_like): The (y, x) location to route from.
+        target (array_like): The (y, x) location to route to.
+        cost_weight (float, optional): Distance units added per unit of cost.
+            Defaults to 1.0.
+        blocked (iterable, optional): (y, x) locations the route may not cross,
+            such as the cells already committed to a route. Defaults to ().
+        margin (int, optional): Number of cells the corridor extends beyond the
+            bounding box of start and target. Defaults to 32.
+
+    Returns:
+        list or None: The [y, x] locations of the route from start to target,
+            both included, or None if the target cannot be reached.
+    """
+    costs = 1 + cost_weight*np.asarray(cost_surface, dtype=np.float64)
+    costs[cost_surface == -1] = -1
+    for y, x in blocked:
+        costs[y, x] = -1
+
+    corridor = search_window(cost_surface.shape, start, target, margin)
+    for top, left, bottom, right in (corridor, (0, 0, *cost_surface.shape)):
+        local_start = (int(start[0]) - top, int(start[1]) - left)
+        local_target = (int(target[0]) - top, int(target[1]) - left)
+        mcp = MCP_Geometric(costs[top:bottom, left:right])
+        cumulative, _ = mcp.find_costs([local_start], [local_target])
+        if np.isfinite(cumulative[local_target]):
+            return [[y + top, x + left] for y, x in mcp.traceback(local_target)]
+    return None
+
+def valid_moves(location, cost_surface, target, visited, distance_factor, distance_field=None):
+    """
+    Find the valid moves from a location and their rewards in one batch.
+
+    The eight neighbouring cells are gathered at once and masked for being out
+    of bounds, already on the path, or impassable (cost of -1). The reward for
+    moving onto the target is 100; any other move is rewarded by its progress
+    toward the target (see Node.calculate_euclidean_reward) minus twice its cost.
+    When a distance field such as `cost_to_go` is given, progress is measured
+    with it instead of the straight-line distance, and moves onto cells from
+    which the target cannot be reached are not valid. No move is valid from
+    such a cell either, since progress from it is undefined.
+
+    Args:
+        location (np.ndarray): The (y, x) location being expanded.
+        cost_surface (np.ndarray): The cost surface to use for cost rewards.
+        target (np.ndarray): The target destination.
+        visited (VisitedSet): The cells already on the path.
+        distance_factor (float): Weight for the distance component.
+        distance_field (np.ndarray, optional): Distance from every cell to the
+            target. Defaults to None, which uses the euclidean distance.
+
+    Returns:
+        tuple: A tuple of (locations, rewards) arrays for the valid moves, in
+            the order of ACTION_DIRECTIONS.
+    """
+    py, px = location[0], location[1]
+    ty, tx = target[0], target[1]
+    locations = ACTION_DIRECTIONS + (py, px)
+    ys = locations[:, 0]
+    xs = locations[:, 1]
+
+    height, width = cost_surface.shape
+    in_bounds = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+    if not in_bounds.all():
+        # Clip only to gather safely, out of bounds moves are masked below
+        ys = np.clip(ys, 0, height - 1)
+        xs = np.clip(xs, 0, width - 1)
+
+    cost_reward = -cost_surface[ys, xs]
+
+    # Do not allow path to cross with itself, out of bounds moves or moves into no-go areas
+    valid = in_bounds & ~visited.contains(ys*width + xs) & (cost_reward != 1)
+
+    if distance_field is None:
+        distance_to_target = np.sqrt((xs-tx)**2 + (ys-ty)**2)
+        previous_distance = np.sqrt((px-tx)**2 + (py-ty)**2)
+    else:
+        previous_distance = distance_field[py, px]
+        if not np.isfinite(previous_distance):
+            return locations[:0], np.zeros(0)
+        distance_to_target = distance_field[ys, xs]
+        valid &= np.isfinite(distance_to_target)
+    euclidean_reward = distance_factor*(previous_distance - distance_to_target - 1.42)
+    rewards = euclidean_reward + cost_reward*2
+    rewards[(ys == ty) & (xs == tx)] = 100
+
+    return locations[valid], rewards[valid]
+
+class Node:
+    """
+    Node class for the Monte Carlo Tree Search algorithm.
+    
+    Each node represents a possible location in the pipeline route. Nodes form a 
+    tree structure with parent-child relationships, allowing for backtracking and
+    exploration of different possible routes.
+    
+    Attributes:
+        location (np.ndarray): The (y, x) coordinates of this node on the cost surface.
+        parent (Node): The parent node in the tree (None for root).
+        children (list): List of child nodes.
+        selections (int): Number of times this node has been selected during search.
+        reward (float): The immediate reward received for selecting this node.
+        value (float): The expected discounted returns from this state.
+        path (VisitedSet): Cells on the path to this node, shared by the whole tree.
+        distance_factor (float): Weight for the euclidean distance component of rewards.
+        is_no_go (bool): Flag indicating whether this node is marked as no-go.
+        action_to_direction (dict): Mapping from action indices to direction vectors.
+    """
+
+    # Shared by every node rather than rebuilt for each instance
+    action_to_direction = dict(enumerate(ACTION_DIRECTIONS))
+
+    def __init__(self, location, parent, reward, path, distance_factor=1.0):
+        """
+        Initialize a Node object.
+        
+        Args:
+            location (np.ndarray): The (y, x) coordinates of this node.
+            parent (Node): The parent node (None for root).
+            reward (float): The immediate reward for selecting this node.
+            path (VisitedSet): Cells already visited in this path. The same
+                instance is shared by every node in the tree.
+            distance_factor (float, optional): Weight for euclidean distance in reward 
+                calculation. Defaults to 1.0.
+        """
+        self.location = location
+        self.parent = parent
+        self.children = []
+        self.selections = 0
+        self.reward = reward # Reward for the parent node selecting this node
+        self.value = 0       # Expected discounted returns when in this state
+        self.path = path
+        self.distance_factor=distance_factor
+        self.is_no_go = False  # New flag to mark nodes as no-go
+
+    def mark_as_no_go(self):
+        """
+        Mark this node as no-go to prevent revisiting.
+        
+        This is used when a node is determined to be a dead end or otherwise
+        unsuitable for inclusion in the optimal path.
+        """
+        self.is_no_go = True
+
+    def calculate_euclidean_reward(self, new_location, target_location):
+        """
+        Calculate the euclidean reward component for a potential new location.
+        
+        The reward is based on how much closer the new location is to the target
+        compared to the current location. A small constant is subtracted to 
+        prevent purely distance-based movement.
+        
+        Args:
+            new_location (np.ndarray): The potential new location to evaluate.
+            target_location (np.ndarray): The target destination location.
+            
+        Returns:
+            float: The calculated euclidean reward component.
+        """
+
+        ay = new_location[0]
+        ax = new_location[1]
+        py = self.location[0]
+        px = self.location[1]
+        ty = target_location[0]
+        tx = target_location[1]
+
+        # Calculate distance to target
+        distance_to_target = np.sqrt((ax-tx)**2 + (ay-ty)**2)
+        previous_distance = np.sqrt((px-tx)**2 + (py-ty)**2)
+
+        # Subtract constant 1.42 to penalize lateral movement that doesn't make sufficient progress toward target
+        # This encourages more direct paths and discourages wandering behavior
+        euclidean_reward = self.distance_factor*(previous_distance - distance_to_target - 1.42)
+
+        return euclidean_reward
+
+    def select(self, c=np.sqrt(2), table=None):
+        """
+        Select a child node to investigate using Upper Confidence Bound (UCB).
+        
+        This implements the UCB formula for balancing exploration and exploitation:
+        UCB = reward + value + c * sqrt(ln(parent_visits) / (child_visits + ε))
+        
+        Args:
+            c (float, optional): Exploration parameter. Higher values encourage
+                more exploration. Defaults to sqrt(2).
+            table (TranspositionTable, optional): Pooled statistics used for the
+                value and visits of each child instead of its own. Defaults to None.
+                
+        Returns:
+            Node or None: The selected child node with highest UCB score, or None
+                if no valid children exist.
+        """
+        high_score = -np.inf
+        selected_child = None
+        log_selections = np.log(self.selections)
+        for child in self.children:
+            # Skip nodes marked as no-go (dead ends)
+            if child.is_no_go:
+                continue
+
+            selections, value = child.selections, child.value
+            if table is not None:
+                selections, value = table.lookup(cell_index(child.location, self.path.width), selections, value)
+                
+            # UCB formula: balances exploitation (first terms) and exploration (last term)
+            ucb = child.reward + value + c*np.sqrt(log_selections/(selections + 0.001))
+
+            if ucb > high_score:
+                high_score = ucb
+                selected_child = child
+
+        return selected_child
+
+    def expand(self, cost_surface, target_location, distance_field=None):
+        """
+        Expand the current node by generating all valid child nodes.
+        
+        This method creates child nodes for all possible actions from the current
+        location, checking for validity (not in path, not out of bounds, etc.).
+        The cells on the path to this node are read from the shared visited set,
+        which `search` fills in while descending the tree.
+        
+        Args:
+            cost_surface (np.ndarray): The cost surface to use for cost rewards.
+            target_location (np.ndarray): The target destination.
+            distance_field (np.ndarray, optional): Precomputed distance to the
+                target used as the reward prior, see valid_moves. Defaults to
+                None, which uses the euclidean distance.
+            
+        Returns:
+            self: Returns the node itself after expansion.
+        """
+        locations, rewards = valid_moves(
+            self.location, cost_surface, target_location, self.path, self.distance_factor, distance_field
+            )
+        for child_location, reward in zip(locations, rewards.tolist()):
+            child = Node(child_location, self, reward, self.path, self.distance_factor)
+            self.children.append(child)
+            
+        self.value = np.mean(rewards)
+    
+    def backpropagate(self, discount=0.98, root=None, table=None):
+        """
+        Backpropagate values up the tree to update parent nodes.
+        
+        This updates the value estimates of the ancestors of this node based on
+        the discounted value of their child, walking up iteratively until the
+        search root is reached.
+        
+        Args:
+            discount (float, optional): Discount factor for future values.
+                Defaults to 0.98.
+            root (Node, optional): The root of the current search, which is the
+                last node updated. Ancestors of the search root are left
+                untouched. Defaults to None, which updates up to the tree root.
+            table (TranspositionTable, optional): Table recording the visit of
+                every node below the search root. Each parent then backs up the
+                pooled value of its child's cell. Defaults to None.
+        """
+        width = self.path.width
+        node = self
+        parent = self.parent
+        value = node.value
+        if table is not None:
+            # The search counts the leaf's own selection after backpropagating
+            value = table.record(cell_index(node.location, width), node.selections + 1, node.value)
+        while parent is not None:
+            parent.value += (value*discount - parent.value)/parent.selections
+            if parent.parent is not None:
+                parent.selections += 1
+            if parent is root:
+                break
+            value = parent.value
+            if table is not None:
+                value = table.record(cell_index(parent.location, width), parent.selections, parent.value)
+            node, parent = parent, parent.parent
+
+    # def rollout(self, num_moves=100):
+    #     for move in num_moves:
+
+def backpropagate_batch(leaves, root, discount=0.98):
+    """
+    Backpropagate the leaves of several trajectories in a single pass.
+
+    Every node below the root that was visited by the trajectories is updated
+    once, deepest first, applying one update to its parent per trajectory that
+    passed through it. Parents therefore back up the values of their children
+    after the whole batch rather than after each trajectory. The selections of
+    the leaves themselves are counted by the search as soon as each trajectory
+    ends, so a batch with a single leaf is identical to Node.backpropagate.
+
+    Args:
+        leaves (list): The leaf Node of each trajectory, all descendants of root.
+        root (Node): The root of the current search.
+        discount (float, optional): Discount factor for future values.
+            Defaults to 0.98.
+    """
+    depths = {}
+    counts = {}
+    nodes = []
+    for leaf in leaves:
+        trajectory = []
+        node = leaf
+        while node is not root:
+            trajectory.append(node)
+            node = node.parent
+
+        for depth, node in enumerate(reversed(trajectory), 1):
+            if node not in counts:
+                depths[node] = depth
+                counts[node] = 0
+                nodes.append(node)
+            counts[node] += 1
+
+    # Children are updated before their parents so every backed up value is final
+    nodes.sort(key=depths.get, reverse=True)
+    for node in nodes:
+        parent = node.parent
+        for _ in range(counts[node]):
+            parent.value += (node.value*discount - parent.value)/parent.selections
+            if parent.parent is not None:
+                parent.selections += 1
+
+class MCTree:
+    """
+    Monte Carlo Tree Search implementation for pipeline routing.
+    
+    This class represents a search tree where each node corresponds to a location on the 
+    cost surface. The tree is used to find the optimal path from a starting location to a 
+    target location by exploring the state space using Monte Carlo Tree Search principles.
+    
+    Attributes:
+        cost_surface (np.ndarray): The cost surface used for calculating move costs.
+        target (np.ndarray): The target destination coordinates.
+        distance_factor (float): Weight factor for distance in reward calculations.
+        root (Node): The root node of the tree representing the starting location.
+        prune (bool): Whether the subtrees of abandoned siblings are released
+            when a new root is selected.
+        max_nodes (int or None): Number of nodes the tree may hold after each
+            search before the least visited leaves are evicted, None for no limit.
+        num_nodes (int): Number of nodes in the tree, counted as they are
+            expanded and released rather than by traversing the tree.
+        distance_field (np.ndarray or None): Precomputed distance to the target
+            used as the reward prior, None for the euclidean distance.
+        table (TranspositionTable or None): Statistics pooled per cell by the
+            nodes reaching it, None when every node keeps its own.
+    """
+
+    def __init__(self, cost_surface, start, target, distance_factor=1.0, prune=False, max_nodes=None,
+                 distance_field=None, transposition=False):
+        """
+        Initialize a Monte Carlo Tree.
+        
+        Args:
+            cost_surface (np.ndarray): The cost surface used for calculating move costs.
+            start (np.ndarray): The starting location coordinates.
+            target (np.ndarray): The target destination coordinates.
+            distance_factor (float, optional): Weight for euclidean distance in reward 
+                calculation. Defaults to 1.0.
+            prune (bool, optional): Release the subtrees of the siblings of each
+                newly selected root, see select_root. Defaults to False.
+            max_nodes (int, optional): Node budget enforced after each search,
+                see enforce_node_budget. Defaults to None (unbounded).
+            distance_field (np.ndarray, optional): Distance from every cell to
+                the target, e.g. from cost_to_go, see valid_moves. Defaults to
+                None, which uses the euclidean distance.
+            transposition (bool, optional): Pool the statistics of the nodes
+                reaching the same cell in a TranspositionTable. Defaults to False.
+        """
+        self.cost_surface = cost_surface
+        self.target = target
+        self.distance_factor = distance_factor
+        self.prune = prune
+        self.max_nodes = max_nodes
+        self.distance_field = distance_field
+        self.table = TranspositionTable(cost_surface.shape) if transposition else None
+        path = VisitedSet(cost_surface.shape)
+        path.commit(cell_index(start, path.width))
+        self.root = Node(location=start, parent=None, reward=None, path=path, distance_factor=distance_factor)
+        self.num_nodes = 1
+        self._expanded = []
+        self._candidates = []
+        self._queued = set()
+        self._pushes = 0
+
+    def traverse(self, node):
+        """
+        Traverse the tree starting from the given node and return all locations.
+        
+        This method recursively collects all locations in the subtree rooted at 
+        the specified node.
+        
+        Args:
+            node (Node): The node to start traversal from.
+            
+        Returns:
+            list: A list of all location coordinates in the subtree.
+        """
+        # Traverse the tree and return the path
+        locations = [node.location.tolist()]
+        for child in node.children:
+            locations.extend(self.traverse(child))
+        return locations   
+
+    def select_root(self, new_root):
+        """
+        Select a new root node without deleting parent connections.
+        
+        This method allows for re-rooting the tree at a different node, which is useful
+        when committing to a particular path segment during search. When pruning
+        is enabled, the siblings of the new root keep their statistics but their
+        subtrees are released. The siblings can still be selected and expanded
+        again if the search backtracks to their parent.
+        
+        Args:
+            new_root (int or Node): Either the flat cell index of a child of the
+                current root (see cell_index) or a Node object to become the new
+                root.
+                
+        Raises:
+            ValueError: If the specified node cannot be found or if trying to set
+                the root to the target node.
+            AssertionError: If new_root is not an int or Node, or if it equals the target.
+        """
+        width = self.root.path.width
+        if isinstance(new_root, (int, np.integer)):
+            next_root_found = False
+            for child in self.root.children:
+                if new_root == cell_index(child.location, width):
+                    new_root = child
+                    next_root_found = True
+                    break
+            if not next_root_found:
+                child_locations = [child.location for child in self.root.children]
+                raise ValueError('Unable to find the child node at {} from following locations: {}'.format(
+                    cell_location(new_root, width), child_locations))
+
+        else:
+            assert isinstance(new_root, Node), 'new_root must be int or Node'
+
+        assert isinstance(new_root, Node)
+        assert not np.array_equal(new_root.location, self.target), 'Root node cannot be terminal node'
+        new_root.path.commit(cell_index(new_root.location, width))
+        self._track_expansions()
+        if self.prune and new_root.parent is not None:
+            for sibling in new_root.parent.children:
+                if sibling is not new_root:
+                    self.num_nodes -= self._release(sibling)
+        self.root = new_root  # Update the root pointer, keeping the ancestry for backtracking
+        if self.table is not None:
+            self.table.new_root()
+
+    def backtrack(self):
+        """
+        Mark the current root as a dead end and move the root to its parent.
+
+        The old root leaves the ancestry of the root, so it may be collapsed by
+        enforce_node_budget from then on.
+        """
+        self._track_expansions()
+        self.root.mark_as_no_go()
+        self.root.path.release(cell_index(self.root.location, self.root.path.width))
+        self._push_candidate(self.root)
+        self.root = self.root.parent
+        if self.table is not None:
+            self.table.new_root()
+
+    def root_statistics(self):
+        """
+        Summarize the valid children of the current root.
+
+        Returns:
+            tuple: A tuple of (cells, selections, values) arrays with one entry
+                per child of the root that is not marked as no-go, where cells
+                holds the flat cell index of each child (see cell_index). With
+                a transposition table the pooled statistics are returned.
+        """
+        width = self.root.path.width
+        children = [child for child in self.root.children if not child.is_no_go]
+        cells = np.array([cell_index(child.location, width) for child in children], dtype=np.int64)
+        selections = np.array([child.selections for child in children], dtype=np.int64)
+        values = np.array([child.value for child in children], dtype=np.float64)
+        if self.table is not None:
+            selections, values = self.table.lookup(cells, selections, values)
+        return cells, selections, values
+
+    def principal_variation(self, length, consensus):
+        """
+        Follow the most visited children below the current root.
+
+        The chain stops at a node without visited valid children, or when the
+        most visited child holds less than `consensus` of the visits of all
+        valid children of its parent. As in `search`, a valid child at the
+        target is always followed and ends the chain.
+
+        Args:
+            length (int): The maximum number of cells to return.
+            consensus (float): Share of its siblings' visits a child needs to
+                extend the chain.
+
+        Returns:
+            list: The flat cell index of each node of the chain (see cell_index).
+        """
+        width = self.root.path.width
+        cells = []
+        node = self.root
+        while len(cells) < length:
+            children = [child for child in node.children if not child.is_no_go]
+            if not children:
+                break
+
+            for child in children:
+                if np.array_equal(child.location, self.target):
+                    return cells + [cell_index(child.location, width)]
+
+            best = max(children, key=lambda child: child.selections)
+            if best.selections == 0 or best.selections < consensus*sum(child.selections for child in children):
+                break
+            cells.append(cell_index(best.location, width))
+            node = best
+        return cells
+
+    def search(self, num_trajectories, c=np.sqrt(2), backprop_batch=1):
+        """
+        Search from the current root and summarize the root's children.
+
+        Args:
+            num_trajectories (int): The number of search trajectories to perform.
+            c (float, optional): Exploration parameter for UCB formula. Defaults to sqrt(2).
+            backprop_batch (int, optional): Number of trajectories whose updates
+                are accumulated before backpropagating them. Defaults to 1.
+
+        Returns:
+            tuple or None: The root statistics (see root_statistics), or None
+                if the root has no valid children left.
+        """
+        root, node = search(
+            self.root, self.target, num_trajectories, self.cost_surface, c, backprop_batch, self.distance_field,
+            self.table, self._expanded
+            )
+        if root is None or node is None:
+            return None
+        self.enforce_node_budget()
+        return self.root_statistics()
+
+    def _track_expansions(self):
+        """
+        Count the nodes created by the searches since the last call, and record
+        the nodes they expanded as candidates of enforce_node_budget.
+        """
+        for node in self._expanded:
+            self.num_nodes += len(node.children)
+            self._push_candidate(node)
+        self._expanded = []
+
+    def _push_candidate(self, node):
+        """
+        Record a node that may be collapsed by enforce_node_budget.
+
+        Candidates are kept in a heap of (selections, order, node) entries,
+        at most one per node, and checked when they are popped, so a node may
+        be pushed whether or not it can be collapsed now. The heap is rebuilt
+        without the released nodes when it holds twice as many entries as the
+        tree has nodes.
+
+        Args:
+            node (Node): The node to record.
+        """
+        if self.max_nodes is None or not node.children or node in self._queued:
+            return
+        heapq.heappush(self._candidates, (node.selections, self._pushes, node))
+        self._queued.add(node)
+        self._pushes += 1
+        if len(self._candidates) > 2*self.num_nodes:
+            self._candidates = [entry for entry in self._candidates if entry[2].children]
+            heapq.heapify(self._candidates)
+            self._queued = {entry[2] for entry in self._candidates}
+
+    def _release(self, node):
+        """
+        Release the subtree below a node, turning it back into an unexpanded leaf.
+
+        The released nodes are emptied too, so any of them still recorded as a
+        candidate of enforce_node_budget is skipped.
+
+        Args:
+            node (Node): The node whose descendants are released.
+
+        Returns:
+            int: The number of nodes released.
+        """
+        released = 0
+        stack = node.children
+        node.children = []
+        while stack:
+            child = stack.pop()
+            released += 1
+            stack.extend(child.children)
+            child.children = []
+        return released
+
+    def enforce_node_budget(self):
+        """
+        Evict the least visited leaves until the tree fits in its node budget.
+
+        Leaves are evicted together with their siblings by collapsing a parent
+        whose children are all leaves back into an unexpanded leaf, so it keeps
+        its own statistics and is expanded again if it is selected later. The
+        current root and its ancestors are never collapsed, so the tree never
+        shrinks below the committed route and the children of its nodes.
+
+        The tree is not traversed: the node count is kept up to date as nodes
+        are expanded and released, and the parents that may be collapsed are
+        kept in a heap as they are expanded, or as their last expanded child is
+        collapsed. The parent with the fewest selections is collapsed first,
+        ties going to the one recorded first.
+        """
+        self._track_expansions()
+        if self.max_nodes is None or self.num_nodes <= self.max_nodes:
+            return
+
+        ancestry = set()
+        node = self.root
+        while node is not None:
+            ancestry.add(node)
+            node = node.parent
+
+        while self.num_nodes > self.max_nodes and self._candidates:
+            selections, order, node = heapq.heappop(self._candidates)
+            self._queued.discard(node)
+            if node in ancestry or not node.children or any(child.children for child in node.children):
+                continue
+            if selections != node.selections:
+                # Selections only grow, so the entry is moved further down the heap
+                heapq.heappush(self._candidates, (node.selections, order, node))
+                self._queued.add(node)
+                continue
+
+            self.num_nodes -= self._release(node)
+            parent = node.parent
+            if parent is not None and not any(child.children for child in parent.children):
+                self._push_candidate(parent)
+
+class NodePool:
+    """
+    Preallocated array storage for the nodes of a Monte Carlo search tree.
+
+    Instead of one Python object per node, every node is a row index into a set
+    of parallel NumPy arrays. Children are always created together when a node
+    is expanded, so the children of a node occupy one contiguous block of rows
+    described by its first child index and child count. The arrays grow by
+    doubling when the pool is full.
+
+    Attributes:
+        location (np.ndarray): (capacity, 2) array of (y, x) node coordinates.
+        parent (np.ndarray): Index of each node's parent, -1 for the root.
+        first_child (np.ndarray): Index of each node's first child, -1 if the
+            node has not been expanded.
+        num_children (np.ndarray): Number of children of each node.
+        selections (np.ndarray): Number of times each node has been selected.
+        reward (np.ndarray): Immediate reward for the parent selecting each node.
+        value (np.ndarray): Expected discounted returns from each node.
+        is_no_go (np.ndarray): Flags marking nodes as dead ends.
+        size (int): Number of nodes currently stored in the pool.
+    """
+
+    # Name and empty value of every per-node array
+    FIELDS = (('location', 0), ('parent', -1), ('first_child', -1),
+              ('num_children', 0), ('selections', 0), ('reward', 0),
+              ('value', 0), ('is_no_go', False))
+
+    def __init__(self, capacity=1024):
+        """
+        Initialize an empty node pool.
+
+        Args:
+            capacity (int, optional): Number of nodes to preallocate. Defaults
+                to 1024.
+        """
+        self.size = 0
+        self.location = np.zeros((capacity, 2), dtype=np.int64)
+        self.parent = np.full(capacity, -1, dtype=np.int64)
+        self.first_child = np.full(capacity, -1, dtype=np.int64)
+        self.num_children = np.zeros(capacity, dtype=np.int64)
+        self.selections = np.zeros(capacity, dtype=np.int64)
+        self.reward = np.zeros(capacity, dtype=np.float64)
+        self.value = np.zeros(capacity, dtype=np.float64)
+        self.is_no_go = np.zeros(capacity, dtype=bool)
+
+    @property
+    def capacity(self):
+        """int: Number of nodes the pool can hold before growing."""
+        return self.parent.shape[0]
+
+    def _grow(self, required):
+        """
+        Double the pool capacity until at least `required` nodes fit.
+
+        Args:
+            required (int): The minimum capacity needed.
+        """
+        capacity = self.capacity
+        while capacity < required:
+            capacity *= 2
+
+        for name, fill in self.FIELDS:
+            old = getattr(self, name)
+            new = np.full((capacity, *old.shape[1:]), fill, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def reserve(self, count):
+        """
+        Grow the pool if needed so `count` more nodes fit without growing.
+
+        Args:
+            count (int): The number of nodes to make room for.
+        """
+        if self.size + count > self.capacity:
+            self._grow(self.size + count)
+
+    def allocate(self, count):
+        """
+        Reserve a contiguous block of `count` new nodes.
+
+        Args:
+            count (int): The number of nodes to reserve.
+
+        Returns:
+            int: The index of the first reserved node.
+        """
+        self.reserve(count)
+        first = self.size
+        self.size += count
+        return first
+
+    def children(self, node):
+        """
+        Get the indices of the children of a node.
+
+        Args:
+            node (int): The node index.
+
+        Returns:
+            range: The indices of the node's children.
+        """
+        first = self.first_child[node]
+        return range(first, first + self.num_children[node])
+
+    def compact(self, order):
+        """
+        Keep only the given nodes, renumbered in the given order.
+
+        The freed rows at the end of the pool are cleared so they can be
+        reused by `allocate`. The order must keep the children of every kept
+        node contiguous and include the parent of every kept node except the
+        first, which becomes the tree root at index 0.
+
+        Args:
+            order (np.ndarray): The indices of the nodes to keep.
+
+        Returns:
+            np.ndarray: Map from old to new node indices, -1 for released nodes.
+        """
+        remap = np.full(self.size, -1, dtype=np.int64)
+        remap[order] = np.arange(len(order))
+        kept = len(order)
+
+        for name, fill in self.FIELDS:
+            array = getattr(self, name)
+            array[:kept] = array[order]
+            array[kept:self.size] = fill
+
+        parent = self.parent[:kept]
+        parent[parent != -1] = remap[parent[parent != -1]]
+        expanded = self.num_children[:kept] > 0
+        self.first_child[:kept][expanded] = remap[self.first_child[:kept][expanded]]
+        self.first_child[:kept][~expanded] = -1
+        self.size = kept
+        return remap
+
+class PoolTree:
+    """
+    Monte Carlo search tree backed by a NodePool.
+
+    This is an alternate representation of MCTree that stores all of its nodes
+    in preallocated arrays. The select, expand and backpropagate operations
+    mirror those of Node and produce the same statistics, but operate on node
+    indices, so no per-node Python objects are created.
+
+    Attributes:
+        cost_surface (np.ndarray): The cost surface used for calculating move costs.
+        target (np.ndarray): The target destination coordinates.
+        distance_factor (float): Weight factor for distance in reward calculations.
+        pool (NodePool): Storage for every node of the tree.
+        visited (VisitedSet): Cells on the path to the node being searched.
+        root (int): Index of the current root node. The tree root is always
+            stored at index 0.
+        prune (bool): Whether the subtrees of abandoned siblings are released
+            when a new root is selected.
+        max_nodes (int or None): Number of nodes the tree may hold after each
+            search before the least visited leaves are evicted, None for no limit.
+        num_nodes (int): Number of nodes in the tree. Released nodes keep their
+            rows in the pool until it is compacted, see compact_if_sparse.
+        distance_field (np.ndarray or None): Precomputed distance to the target
+            used as the reward prior, None for the euclidean distance.
+        table (TranspositionTable or None): Statistics pooled per cell by the
+            nodes reaching it, None when every node keeps its own.
+    """
+
+    def __init__(self, cost_surface, start, target, distance_factor=1.0, capacity=1024, prune=False, max_nodes=None,
+                 distance_field=None, transposition=False):
+        """
+        Initialize a pool-backed Monte Carlo Tree.
+
+        Args:
+            cost_surface (np.ndarray): The cost surface used for calculating move costs.
+            start (np.ndarray): The starting location coordinates.
+            target (np.ndarray): The target destination coordinates.
+            distance_factor (float, optional): Weight for euclidean distance in reward
+                calculation. Defaults to 1.0.
+            capacity (int, optional): Number of nodes to preallocate. Defaults to 1024.
+            prune (bool, optional): Release the subtrees of the siblings of each
+                newly selected root, see MCTree.select_root. Defaults to False.
+            max_nodes (int, optional): Node budget enforced after each search,
+                see MCTree.enforce_node_budget. Defaults to None (unbounded).
+            distance_field (np.ndarray, optional): Distance from every cell to
+                the target, see MCTree. Defaults to None.
+            transposition (bool, optional): Pool the statistics of the nodes
+                reaching the same cell, see MCTree. Defaults to False.
+        """
+        self.cost_surface = cost_surface
+        self.target = np.asarray(target)
+        self.distance_factor = distance_factor
+        self.prune = prune
+        self.max_nodes = max_nodes
+        self.distance_field = distance_field
+        self.pool = NodePool(capacity)
+        self.root = self.pool.allocate(1)
+        self.pool.location[self.root] = start
+        self.visited = VisitedSet(cost_surface.shape)
+        self.visited.commit(cell_index(start, self.visited.width))
+        self.table = TranspositionTable(cost_surface.shape) if transposition else None
+        self.num_nodes = 1
+        self._tracked = self.pool.size
+        self._candidates = []
+        self._queued = set()
+        self._pushes = 0
+
+    def cells(self, nodes):
+        """
+        Get the flat cell index of one or more nodes.
+
+        Args:
+            nodes (int or np.ndarray): The node indices.
+
+        Returns:
+            int or np.ndarray: The flat cell index of each node (see cell_index).
+        """
+        location = self.pool.location[nodes]
+        return location[..., 0]*self.visited.width + location[..., 1]
+
+    def mark_as_no_go(self, node):
+        """
+        Mark a node as no-go to prevent revisiting.
+
+        Args:
+            node (int): The node index.
+        """
+        self.pool.is_no_go[node] = True
+
+    def select(self, node, c=np.sqrt(2)):
+        """
+        Select a child node to investigate using Upper Confidence Bound (UCB).
+
+        See Node.select for the formula used. The children of a node are stored
+        contiguously in the pool, so the scores of all children are computed in
+        one vectorized call over slices of the statistics arrays.
+
+        Args:
+            node (int): The node index to select a child of.
+            c (float, optional): Exploration parameter. Defaults to sqrt(2).
+
+        Returns:
+            int: The index of the selected child, or -1 if no valid children exist.
+        """
+        pool = self.pool
+        first = pool.first_child[node]
+        children = slice(first, first + pool.num_children[node])
+        selections, value = pool.selections[children], pool.value[children]
+        if self.table is not None:
+            selections, value = self.table.lookup(self.cells(np.arange(first, children.stop)), selections, value)
+
+        ucb = pool.reward[children] + value \
+            + c*np.sqrt(np.log(pool.selections[node])/(selections + 0.001))
+
+        # Skip nodes marked as no-go (dead ends)
+        ucb[pool.is_no_go[children]] = -np.inf
+
+        if not ucb.size:
+            return -1
+
+        # argmax returns the first of equal scores, like a strict comparison loop
+        best = ucb.argmax()
+        if ucb[best] == -np.inf:
+            return -1
+        return first + best
+
+    def expand(self, node):
+        """
+        Expand a node by generating all valid child nodes.
+
+        See Node.expand for the rules used to create children and their rewards.
+
+        Args:
+            node (int): The node index to expand.
+        """
+        pool = self.pool
+        locations, rewards = valid_moves(
+            pool.location[node], self.cost_surface, self.target, self.visited, self.distance_factor,
+            self.distance_field
+            )
+
+        count = len(rewards)
+        first = pool.allocate(count)
+        pool.first_child[node] = first
+        pool.num_children[node] = count
+        if count:
+            block = slice(first, first + count)
+            pool.location[block] = locations
+            pool.parent[block] = node
+            pool.reward[block] = rewards
+        pool.value[node] = np.mean(rewards)
+
+    def backpropagate(self, node, discount=0.98):
+        """
+        Backpropagate values up the tree to update parent nodes.
+
+        The ancestors of the node are updated up to and including the current
+        root. See Node.backpropagate for the update rule and the use of the
+        transposition table.
+
+        Args:
+            node (int): The node index to start backpropagation from.
+            discount (float, optional): Discount factor for future values.
+                Defaults to 0.98.
+        """
+        pool = self.pool
+        table = self.table
+        parent = pool.parent[node]
+        value = pool.value[node]
+        if table is not None:
+            value = table.record(self.cells(node), pool.selections[node] + 1, pool.value[node])
+        while parent != -1:
+            pool.value[parent] += (value*discount - pool.value[parent])/pool.selections[parent]
+            if pool.parent[parent] != -1:
+                pool.selections[parent] += 1
+            if parent == self.root:
+                break
+            value = pool.value[parent]
+            if table is not None:
+                value = table.record(self.cells(parent), pool.selections[parent], pool.value[parent])
+            node, parent = parent, pool.parent[parent]
+
+    def backpropagate_batch(self, leaves, discount=0.98):
+        """
+        Backpropagate the leaves of several trajectories in a single pass.
+
+        See the module level backpropagate_batch for the update rule.
+
+        Args:
+            leaves (list): The leaf node index of each trajectory, all
+                descendants of the current root.
+            discount (float, optional): Discount factor for future values.
+                Defaults to 0.98.
+        """
+        pool = self.pool
+        depths = {}
+        counts = {}
+        nodes = []
+        for leaf in leaves:
+            trajectory = []
+            node = leaf
+            while node != self.root:
+                trajectory.append(node)
+                node = pool.parent[node]
+
+            for depth, node in enumerate(reversed(trajectory), 1):
+                if node not in counts:
+                    depths[node] = depth
+                    counts[node] = 0
+                    nodes.append(node)
+                counts[node] += 1
+
+        # Children are updated before their parents so every backed up value is final
+        nodes.sort(key=depths.get, reverse=True)
+        for node in nodes:
+            parent = pool.parent[node]
+            for _ in range(counts[node]):
+                pool.value[parent] += (pool.value[node]*discount - pool.value[parent])/pool.selections[parent]
+                if pool.parent[parent] != -1:
+                    pool.selections[parent] += 1
+
+    def traverse(self, node):
+        """
+        Traverse the tree starting from the given node and return all locations.
+
+        Args:
+            node (int): The node index to start traversal from.
+
+        Returns:
+            list: A list of all location coordinates in the subtree.
+        """
+        locations = [self.pool.location[node].tolist()]
+        for child in self.pool.children(node):
+            locations.extend(self.traverse(child))
+        return locations
+
+    def select_root(self, new_root):
+        """
+        Select a new root node without deleting parent connections.
+
+        When pruning is enabled the subtrees of the siblings of the new root
+        are released, see MCTree.select_root, and the pool is compacted once
+        released nodes fill enough of it, see compact_if_sparse.
+
+        Args:
+            new_root (int): The flat cell index of a child of the current root
+                (see cell_index).
+
+        Raises:
+            ValueError: If the specified node cannot be found.
+            AssertionError: If the new root is the target node.
+        """
+        pool = self.pool
+        children = np.arange(pool.first_child[self.root], pool.first_child[self.root] + pool.num_children[self.root])
+        matches = children[self.cells(children) == new_root]
+        if not matches.size:
+            raise ValueError('Unable to find the child node at {} from following locations: {}'.format(
+                cell_location(new_root, self.visited.width), pool.location[children].tolist()))
+
+        child = matches[0]
+        assert not np.array_equal(pool.location[child], self.target), 'Root node cannot be terminal node'
+        self.visited.commit(new_root)
+        self._track_expansions()
+        self.root = child
+        if self.table is not None:
+            self.table.new_root()
+        if self.prune:
+            self.num_nodes -= self._release(children[children != child])
+            self.compact_if_sparse()
+
+    def ancestry(self):
+        """
+        Get the current root and all of its ancestors.
+
+        Returns:
+            np.ndarray: The node indices from the current root up to the tree root.
+        """
+        nodes = [self.root]
+        while self.pool.parent[nodes[-1]] != -1:
+            nodes.append(self.pool.parent[nodes[-1]])
+        return np.array(nodes, dtype=np.int64)
+
+    def compact(self):
+        """
+        Release the nodes that are no longer reachable from the tree root.
+
+        The reachable nodes are renumbered breadth-first, which keeps the
+        children of every node contiguous and in the same order.
+        """
+        self._track_expansions()
+        pool = self.pool
+        levels = [np.zeros(1, dtype=np.int64)]
+        while True:
+            expanded = levels[-1][pool.num_children[levels[-1]] > 0]
+            if not expanded.size:
+                break
+            counts = pool.num_children[expanded]
+            offsets = np.cumsum(counts) - counts
+            levels.append(np.repeat(pool.first_child[expanded] - offsets, counts) + np.arange(counts.sum()))
+
+        remap = pool.compact(np.concatenate(levels))
+        self.root = remap[self.root]
+        self.num_nodes = self._tracked = pool.size
+        self._candidates = [(selections, order, int(remap[node])) for selections, order, node in self._candidates
+                            if remap[node] != -1]
+        heapq.heapify(self._candidates)
+        self._queued = {entry[2] for entry in self._candidates}
+
+    def compact_if_sparse(self):
+        """
+        Compact the pool once released nodes fill COMPACT_FRACTION of its rows.
+        """
+        self._track_expansions()
+        if self.pool.size - self.num_nodes > COMPACT_FRACTION*self.pool.size:
+            self.compact()
+
+    def _track_expansions(self):
+        """
+        Count the nodes created by the searches since the last call, and record
+        the nodes they expanded as candidates of enforce_node_budget.
+
+        Each expansion allocates one block of children at the end of the pool,
+        so the new rows hold the children of the expanded nodes in the order
+        they were expanded.
+        """
+        pool = self.pool
+        if pool.size == self._tracked:
+            return
+        parents = pool.parent[self._tracked:pool.size]
+        self.num_nodes += pool.size - self._tracked
+        self._tracked = pool.size
+        for node in parents[np.flatnonzero(np.diff(parents, prepend=-1))].tolist():
+            self._push_candidate(node)
+
+    def _push_candidate(self, node):
+        """
+        Record a node that may be collapsed by enforce_node_budget.
+
+        See MCTree._push_candidate.
+
+        Args:
+            node (int): The node index to record.
+        """
+        pool = self.pool
+        if self.max_nodes is None or not pool.num_children[node] or node in self._queued:
+            return
+        heapq.heappush(self._candidates, (int(pool.selections[node]), self._pushes, node))
+        self._queued.add(node)
+        self._pushes += 1
+        if len(self._candidates) > 2*self.num_nodes:
+            self._candidates = [entry for entry in self._candidates if pool.num_children[entry[2]]]
+            heapq.heapify(self._candidates)
+            self._queued = {entry[2] for entry in self._candidates}
+
+    def _release(self, nodes):
+        """
+        Release the subtrees below nodes, turning them back into unexpanded leaves.
+
+        The released nodes are emptied too, so any of them still recorded as a
+        candidate of enforce_node_budget is skipped. Their rows are reused once
+        the pool is compacted.
+
+        Args:
+            nodes (np.ndarray): The node indices whose descendants are released.
+
+        Returns:
+            int: The number of nodes released.
+        """
+        pool = self.pool
+        released = 0
+        level = nodes[pool.num_children[nodes] > 0]
+        while level.size:
+            counts = pool.num_children[level]
+            offsets = np.cumsum(counts) - counts
+            children = np.repeat(pool.first_child[level] - offsets, counts) + np.arange(counts.sum())
+            pool.first_child[level] = -1
+            pool.num_children[level] = 0
+            released += children.size
+            level = children[pool.num_children[children] > 0]
+        return released
+
+    def enforce_node_budget(self):
+        """
+        Evict the least visited leaves until the tree fits in its node budget.
+
+        See MCTree.enforce_node_budget for the eviction rule, which evicts the
+        same nodes. The pool is compacted once the evicted nodes fill enough
+        of it, see compact_if_sparse.
+        """
+        self._track_expansions()
+        if self.max_nodes is None or self.num_nodes <= self.max_nodes:
+            return
+
+        pool = self.pool
+        ancestry = set(self.ancestry().tolist())
+        while self.num_nodes > self.max_nodes and self._candidates:
+            selections, order, node = heapq.heappop(self._candidates)
+            self._queued.discard(node)
+            first, count = pool.first_child[node], pool.num_children[node]
+            if node in ancestry or not count or pool.num_children[first:first + count].any():
+                continue
+            if selections != pool.selections[node]:
+                # Selections only grow, so the entry is moved further down the heap
+                heapq.heappush(self._candidates, (int(pool.selections[node]), order, node))
+                self._queued.add(node)
+                continue
+
+            self.num_nodes -= int(count)
+            pool.first_child[node] = -1
+            pool.num_children[node] = 0
+            parent = int(pool.parent[node])
+            if parent != -1:
+                first, count = pool.first_child[parent], pool.num_children[parent]
+                if not pool.num_children[first:first + count].any():
+                    self._push_candidate(parent)
+        self.compact_if_sparse()
+
+    def backtrack(self):
+        """
+        Mark the current root as a dead end and move the root to its parent.
+
+        See MCTree.backtrack.
+        """
+        self._track_expansions()
+        self.mark_as_no_go(self.root)
+        self.visited.release(self.cells(self.root))
+        self._push_candidate(int(self.root))
+        self.root = self.pool.parent[self.root]
+        if self.table is not None:
+            self.table.new_root()
+
+    def root_statistics(self):
+        """
+        Summarize the valid children of the current root.
+
+        Returns:
+            tuple: A tuple of (cells, selections, values) arrays with one entry
+                per child of the root that is not marked as no-go, where cells
+                holds the flat cell index of each child (see cell_index).
+        """
+        pool = self.pool
+        first = pool.first_child[self.root]
+        children = np.arange(first, first + pool.num_children[self.root])
+        children = children[~pool.is_no_go[children]]
+        cells, selections, values = self.cells(children), pool.selections[children], pool.value[children]
+        if self.table is not None:
+            selections, values = self.table.lookup(cells, selections, values)
+        return cells, selections, values
+
+    def principal_variation(self, length, consensus):
+        """
+        Follow the most visited children below the current root.
+
+        See MCTree.principal_variation for the rules and arguments.
+
+        Returns:
+            list: The flat cell index of each node of the chain.
+        """
+        pool = self.pool
+        target_cell = cell_index(self.target, self.visited.width)
+        cells = []
+        node = self.root
+        while len(cells) < length:
+            first = pool.first_child[node]
+            children = np.arange(first, first + pool.num_children[node])
+            children = children[~pool.is_no_go[children]]
+            if not children.size:
+                break
+
+            child_cells = self.cells(children)
+            if (child_cells == target_cell).any():
+                return cells + [target_cell]
+
+            selections = pool.selections[children]
+            best = selections.argmax()
+            if selections[best] == 0 or selections[best] < consensus*selections.sum():
+                break
+            cells.append(int(child_cells[best]))
+            node = children[best]
+        return cells
+
+    def search(self, num_trajectories, c=np.sqrt(2), backprop_batch=1):
+        """
+        Search from the current root and summarize the root's children.
+
+        Args:
+            num_trajectories (int): The number of search trajectories to perform.
+            c (float, optional): Exploration parameter for UCB formula. Defaults to sqrt(2).
+            backprop_batch (int, optional): Number of trajectories whose updates
+                are accumulated before backpropagating them. Defaults to 1.
+
+        Returns:
+            tuple or None: The root statistics (see root_statistics), or None
+                if the root has no valid children left.
+        """
+        tree, node = search_pool(self, num_trajectories, c, backprop_batch)
+        if tree is None:
+            return None
+        self.enforce_node_budget()
+        return self.root_statistics()
+
+def search(root, target, num_trajectories, cost_surface, c=np.sqrt(2), backprop_batch=1, distance_field=None,
+           table=None, expanded=None):
+    """
+    Perform Monte Carlo Tree Search from a given root node.
+    
+    This function implements the core MCTS algorithm, consisting of:
+    1. Selection: Traverse the tree from root to leaf following UCB policy
+    2. Expansion: When a leaf node is reached, expand by creating child nodes
+    3. Backpropagation: Update node values up to the root based on the search results
+    
+    The search continues until a specified number of trajectories are explored or
+    a terminal state (target) is reached. Nodes that lead to dead ends are marked
+    as no-go to avoid revisiting them.
+    
+    Args:
+        root (Node): The root node to start the search from.
+        target (np.ndarray): The target destination coordinates.
+        num_trajectories (int): The number of search trajectories to perform.
+        cost_surface (np.ndarray): The cost surface for calculating move costs.
+        c (float, optional): Exploration parameter for UCB formula. Defaults to sqrt(2).
+        backprop_batch (int, optional): Number of trajectories whose updates are
+            accumulated and then backpropagated together in one pass, see
+            backpropagate_batch. Defaults to 1, which backpropagates after
+            every trajectory.
+        distance_field (np.ndarray, optional): Precomputed distance to the
+            target used as the reward prior, see valid_moves. Defaults to None.
+        table (TranspositionTable, optional): Statistics pooled per cell, used
+            for selection and backpropagation. Requires backprop_batch of 1.
+            Defaults to None.
+        expanded (list, optional): Collects every node the search expands, in
+            order. Defaults to None.
+        
+    Returns:
+        tuple: A tuple containing (root_node, next_node) where next_node is the best
+            child to move to, or (None, None) if no valid path exists.
+    """
+    pending = []
+
+    for _ in range(num_trajectories):
+
+        # Track visits to root for UCB calculations
+        root.selections += 1
+        current_node = root
+        backtracked = False
+        root.path.begin_trajectory()
+
+        # MCTS Selection phase: traverse tree until reaching a leaf node
+        while current_node.children:
+            
+            # Select new child node to investigate using Upper Confidence Bound (UCB)
+            selected_child = current_node.select(c=c, table=table)
+
+            # Dead end detection - if all children are no-go, mark current node as no-go too
+            if selected_child is None:
+                
+                # Flag to indicate that the current node has been backtracked
+                backtracked = True
+                
+                # Set the current node as no-go
+                current_node.mark_as_no_go()
+
+                # Backtrack to parent node
+                current_node = current_node.parent
+
+                # If no parent, raise error - no possible route exists
+                if current_node is None:
+                    raise ValueError('Unable to find pipeline route')
+
+                continue
+
+            else:
+                current_node = selected_child
+                current_node.path.add(cell_index(current_node.location, current_node.path.width))
+
+            # Check if we've reached the target
+            if np.array_equal(current_node.location, target):
+                break
+        
+        # MCTS Expansion phase: expand non-terminal leaf nodes
+        if not np.array_equal(current_node.location, target) and not backtracked:
+            
+            # Create child nodes for all valid moves from current position
+            current_node.expand(cost_surface, target, distance_field)
+            if expanded is not None:
+                expanded.append(current_node)
+            
+            # Check if expansion produced valid children, otherwise mark as dead end
+            if not current_node.children:
+
+                # Flag to indicate that the current node has been backtracked
+                backtracked = True
+
+                # Mark current node as no-go
+                current_node.mark_as_no_go()
+
+                # Backtrack to parent node
+                current_node = current_node.parent
+                    
+        # MCTS Backpropagation phase: update value estimates up to the search root
+        if not current_node is root and not backtracked:
+            if backprop_batch == 1:
+                current_node.backpropagate(root=root, table=table)
+            else:
+                pending.append(current_node)
+                if len(pending) == backprop_batch:
+                    backpropagate_batch(pending, root)
+                    pending = []
+
+            # Leaves are counted straight away so the trajectories of a batch spread out
+            current_node.selections += 1
+
+        # Check if the root node has any valid children left
+        if not [child for child in root.children if not child.is_no_go]:
+            return None, None
+
+    if pending:
+        backpropagate_batch(pending, root)
+
+    # After all trajectories, select the best child based on selection count
+    max_value = -np.inf
+    most_selections = 0
+    next_node = None
+
+    # Find the child with the most selections (most promising move)
+    for child in root.children:
+        if child.is_no_go:
+            continue
+
+        # If target is directly reachable, select it immediately
+        if np.array_equal(child.location, target):
+            next_node = child
+            break
+
+        if child.selections > most_selections:
+            most_selections = child.selections
+            next_node = child
+
+    # All children are no-go
+    if next_node is None and root.children:
+        return None, None
+
+    return root, next_node
+
+def search_pool(tree, num_trajectories, c=np.sqrt(2), backprop_batch=1):
+    """
+    Perform Monte Carlo Tree Search from the root of a pool-backed tree.
+
+    This is the PoolTree counterpart of `search` and follows exactly the same
+    selection, expansion, dead-end marking and backpropagation rules, so both
+    produce the same statistics and decisions for the same inputs.
+
+    Args:
+        tree (PoolTree): The tree to search, starting from its current root.
+        num_trajectories (int): The number of search trajectories to perform.
+        c (float, optional): Exploration parameter for UCB formula. Defaults to sqrt(2).
+        backprop_batch (int, optional): Number of trajectories whose updates are
+            accumulated and then backpropagated together. Defaults to 1.
+
+    Returns:
+        tuple: A tuple containing (tree, next_node) where next_node is the index
+            of the best child to move to, or (None, None) if no valid path exists.
+    """
+    pool = tree.pool
+    pending = []
+    root = tree.root
+    target = tree.target
+
+    def at_target(node):
+        return pool.location[node, 0] == target[0] and pool.location[node, 1] == target[1]
+
+    def has_valid_child(node):
+        return not pool.is_no_go[pool.children(node)].all()
+
+    for _ in range(num_trajectories):
+
+        # Track visits to root for UCB calculations
+        pool.selections[root] += 1
+        current_node = root
+        backtracked = False
+        tree.visited.begin_trajectory()
+
+        # MCTS Selection phase: traverse tree until reaching a leaf node
+        while pool.num_children[current_node]:
+
+            selected_child = tree.select(current_node, c=c)
+
+            # Dead end detection - if all children are no-go, mark current node as no-go too
+            if selected_child == -1:
+                backtracked = True
+                tree.mark_as_no_go(current_node)
+                current_node = pool.parent[current_node]
+
+                # If no parent, raise error - no possible route exists
+                if current_node == -1:
+                    raise ValueError('Unable to find pipeline route')
+
+                continue
+
+            else:
+                current_node = selected_child
+                tree.visited.add(tree.cells(current_node))
+
+            # Check if we've reached the target
+            if at_target(current_node):
+                break
+
+        # MCTS Expansion phase: expand non-terminal leaf nodes
+        if not at_target(current_node) and not backtracked:
+            tree.expand(current_node)
+
+            # Check if expansion produced valid children, otherwise mark as dead end
+            if not pool.num_children[current_node]:
+                backtracked = True
+                tree.mark_as_no_go(current_node)
+                current_node = pool.parent[current_node]
+
+        # MCTS Backpropagation phase: update value estimates up to the search root
+        if current_node != root and not backtracked:
+            if backprop_batch == 1:
+                tree.backpropagate(current_node)
+            else:
+                pending.append(current_node)
+                if len(pending) == backprop_batch:
+                    tree.backpropagate_batch(pending)
+                    pending = []
+
+            # Leaves are counted straight away so the trajectories of a batch spread out
+            pool.selections[current_node] += 1
+
+        # Check if the root node has any valid children left
+        if not has_valid_child(root):
+            return None, None
+
+    if pending:
+        tree.backpropagate_batch(pending)
+
+    # After all trajectories, select the child with the most selections
+    most_selections = 0
+    next_node = -1
+    for child in pool.children(root):
+        if pool.is_no_go[child]:
+            continue
+
+        # If target is directly reachable, select it immediately
+        if at_target(child):
+            next_node = child
+            break
+
+        if pool.selections[child] > most_selections:
+            most_selections = pool.selections[child]
+            next_node = child
+
+    # All children are no-go
+    if next_node == -1:
+        return None, None
+
+    return tree, next_node
+
+def _search_trajectories(location, parent, first_child, num_children, selections, reward, value, is_no_go,
+                         size, root, target, cost_surface, distance_field, stamps, base, generation, log_table,
+                         distance_factor, c, num_trajectories):
+    """
+    Run search_pool trajectories on the raw arrays of a PoolTree.
+
+    This is the loop of `search_pool` written with scalar operations only, so
+    it can be compiled by Numba (see JitTree). Every floating point operation
+    is performed in the same order as in the NumPy implementation, logarithms
+    are read from a table computed by NumPy and the mean of the child rewards
+    follows NumPy's summation order, so both produce identical trees. The
+    arrays of the pool must have room for 8 new nodes per trajectory. An empty
+    distance field selects the euclidean distance, see valid_moves.
+
+    Returns:
+        tuple: A tuple of (status, size, generation, next_node) where status is
+            one of the SEARCH_* codes, size and generation are the new pool
+            size and visited set generation, and next_node is the index of the
+            child of the root with the most selections, or -1.
+    """
+    height, width = cost_surface.shape
+    ty, tx = target[0], target[1]
+    use_field = distance_field.size > 0
+    rewards = np.empty(8, dtype=np.float64)
+
+    for _ in range(num_trajectories):
+
+        # Track visits to root for UCB calculations
+        selections[root] += 1
+        current_node = root
+        backtracked = False
+        generation += 1
+
+        # MCTS Selection phase: traverse tree until reaching a leaf node
+        while num_children[current_node] > 0:
+            first = first_child[current_node]
+            log_selections = log_table[selections[current_node]]
+            high_score = -np.inf
+            selected_child = -1
+            for child in range(first, first + num_children[current_node]):
+                if is_no_go[child]:
+                    continue
+                ucb = reward[child] + value[child] + c*np.sqrt(log_selections/(selections[child] + 0.001))
+                if ucb > high_score:
+                    high_score = ucb
+                    selected_child = child
+
+            # Dead end detection - if all children are no-go, mark current node as no-go too
+            if selected_child == -1:
+                backtracked = True
+                is_no_go[current_node] = True
+                current_node = parent[current_node]
+                if current_node == -1:
+                    return SEARCH_UNREACHABLE, size, generation, -1
+                continue
+
+            current_node = selected_child
+            stamps[location[current_node, 0]*width + location[current_node, 1]] = generation
+
+            # Check if we've reached the target
+            if location[current_node, 0] == ty and location[current_node, 1] == tx:
+                break
+
+        at_target = location[current_node, 0] == ty and location[current_node, 1] == tx
+
+        # MCTS Expansion phase: expand non-terminal leaf nodes, see valid_moves
+        if not at_target and not backtracked:
+            py, px = location[current_node, 0], location[current_node, 1]
+            if use_field:
+                previous_distance = distance_field[py, px]
+            else:
+                previous_distance = np.sqrt((px - tx)**2 + (py - ty)**2)
+            count = 0
+            for action in range(8 if np.isfinite(previous_distance) else 0):
+                y = py + ACTION_DIRECTIONS[action, 0]
+                x = px + ACTION_DIRECTIONS[action, 1]
+                if y < 0 or y >= height or x < 0 or x >= width:
+                    continue
+                stamp = stamps[y*width + x]
+                if stamp == base or stamp == generation:
+                    continue
+                cost_reward = -cost_surface[y, x]
+                if cost_reward == 1:
+                    continue
+
+                if use_field:
+                    distance_to_target = distance_field[y, x]
+                    if not np.isfinite(distance_to_target):
+                        continue
+                else:
+                    distance_to_target = np.sqrt((x - tx)**2 + (y - ty)**2)
+                euclidean_reward = distance_factor*(previous_distance - distance_to_target - 1.42)
+                child_reward = euclidean_reward + (cost_reward + cost_reward)
+                if y == ty and x == tx:
+                    child_reward = 100.0
+
+                child = size + count
+                location[child, 0] = y
+                location[child, 1] = x
+                parent[child] = current_node
+                reward[child] = child_reward
+                rewards[count] = child_reward
+                count += 1
+
+            first_child[current_node] = size
+            num_children[current_node] = count
+            size += count
+
+            # np.mean adds up to 7 values in order and 8 values pairwise
+            if count == 8:
+                total = ((rewards[0] + rewards[1]) + (rewards[2] + rewards[3])) \
+                    + ((rewards[4] + rewards[5]) + (rewards[6] + rewards[7]))
+            else:
+                total = 0.0
+                for i in range(count):
+                    total += rewards[i]
+            value[current_node] = total/count if count else np.nan
+
+            # Check if expansion produced valid children, otherwise mark as dead end
+            if count == 0:
+                backtracked = True
+                is_no_go[current_node] = True
+                current_node = parent[current_node]
+
+        # MCTS Backpropagation phase: update value estimates up to the search root
+        if current_node != root and not backtracked:
+            node = current_node
+            node_parent = parent[node]
+            while node_parent != -1:
+                value[node_parent] += (value[node]*0.98 - value[node_parent])/selections[node_parent]
+                if parent[node_parent] != -1:
+                    selections[node_parent] += 1
+                if node_parent == root:
+                    break
+                node = node_parent
+                node_parent = parent[node_parent]
+            selections[current_node] += 1
+
+        # Check if the root node has any valid children left
+        has_valid_child = False
+        for child in range(first_child[root], first_child[root] + num_children[root]):
+            if not is_no_go[child]:
+                has_valid_child = True
+                break
+        if not has_valid_child:
+            return SEARCH_DEAD_END, size, generation, -1
+
+    # After all trajectories, select the child with the most selections
+    most_selections = 0
+    next_node = -1
+    for child in range(first_child[root], first_child[root] + num_children[root]):
+        if is_no_go[child]:
+            continue
+        if location[child, 0] == ty and location[child, 1] == tx:
+            next_node = child
+            break
+        if selections[child] > most_selections:
+            most_selections = selections[child]
+            next_node = child
+
+    return SEARCH_OK, size, generation, next_node
+
+# Status codes returned by _search_trajectories
+SEARCH_OK = 0
+SEARCH_DEAD_END = 1
+SEARCH_UNREACHABLE = 2
+
+# Whether Numba is installed to compile the search kernel
+JIT_AVAILABLE = numba is not None
+# Compiled search kernel, built by _compiled_kernel on the first compiled search
+_search_kernel = None
+_kernel_failed = False
+
+def _compiled_kernel():
+    """
+    Get `_search_trajectories` compiled with Numba, compiling it on first use.
+
+    Numba caches the compiled kernel next to this module's source, which a
+    frozen (PyInstaller) bundle does not ship, so the cache is only used when
+    running from source.
+
+    Returns:
+        numba.core.registry.CPUDispatcher: The compiled kernel, or None when
+            Numba is not installed or the kernel failed to compile.
+    """
+    global _search_kernel
+    if _search_kernel is None and JIT_AVAILABLE and not _kernel_failed:
+        try:
+            _search_kernel = numba.njit(cache=not getattr(sys, 'frozen', False))(_search_trajectories)
+        except Exception as e:
+            _disable_kernel(e)
+    return _search_kernel
+
+def _disable_kernel(error):
+    """
+    Stop using the compiled kernel after it failed to compile.
+
+    Args:
+        error (Exception): The compilation error.
+    """
+    global _search_kernel, _kernel_failed
+    _search_kernel = None
+    _kernel_failed = True
+    warnings.warn('Unable to compile the search kernel ({}), searching with the pure Python pool backend '
+                  'instead'.format(error))
+
+class JitTree(PoolTree):
+    """
+    Pool-backed Monte Carlo search tree searched by a compiled kernel.
+
+    The trajectories of `search` are run by `_search_trajectories` compiled
+    with Numba on the first search, which follows the same rules as
+    `search_pool` and builds an identical tree. Every other operation, such as
+    selecting roots, backtracking and pruning, is inherited from PoolTree.
+    When Numba is not installed, the kernel fails to compile, trajectories are
+    backpropagated in batches or a transposition table is used, the tree is
+    searched by `search_pool` instead.
+
+    Attributes:
+        log_table (np.ndarray): Natural logarithm of every selection count up
+            to the largest one seen, computed by NumPy.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initialize a compiled Monte Carlo Tree.
+
+        See PoolTree for the arguments.
+        """
+        super().__init__(*args, **kwargs)
+        self.log_table = np.zeros(0)
+
+    def _ensure_log_table(self, required):
+        """
+        Extend the logarithm table to cover selection counts below `required`.
+
+        Args:
+            required (int): The number of table entries needed.
+        """
+        if len(self.log_table) < required:
+            with np.errstate(divide='ignore'):
+                self.log_table = np.log(np.arange(max(required, 2*len(self.log_table)), dtype=np.int64))
+
+    def search(self, num_trajectories, c=np.sqrt(2), backprop_batch=1):
+        """
+        Search from the current root and summarize the root's children.
+
+        See PoolTree.search for the arguments and return value.
+
+        Raises:
+            ValueError: If the search backtracks past the tree root.
+        """
+        kernel = _compiled_kernel()
+        if kernel is None or backprop_batch != 1 or self.table is not None:
+            return super().search(num_trajectories, c, backprop_batch)
+
+        pool = self.pool
+        visited = self.visited
+
+        # Each trajectory expands at most one node, and increments any
+        # selection count by at most two
+        pool.reserve(8*num_trajectories)
+        self._ensure_log_table(int(pool.selections[:pool.size].max()) + 2*num_trajectories + 1)
+
+        try:
+            status, pool.size, visited.generation, next_node = kernel(
+                pool.location, pool.parent, pool.first_child, pool.num_children,
+                pool.selections, pool.reward, pool.value, pool.is_no_go,
+                pool.size, self.root, np.asarray(self.target, dtype=np.int64), self.cost_surface,
+                self.distance_field if self.distance_field is not None else np.zeros((0, 0)),
+                visited.stamps, visited.base, visited.generation, self.log_table,
+                float(self.distance_factor), float(c), num_trajectories
+                )
+        except numba.core.errors.NumbaError as e:
+            # Compilation fails before the kernel touches the tree
+            _disable_kernel(e)
+            return super().search(num_trajectories, c, backprop_batch)
+
+        if status == SEARCH_UNREACHABLE:
+            raise ValueError('Unable to find pipeline route')
+        if status == SEARCH_DEAD_END or next_node == -1:
+            return None
+        self.enforce_node_budget()
+        return self.root_statistics()
+
+# Tree classes available to the forest, keyed by MCAgent backend name
+TREE_BACKENDS = {
+    'object': MCTree,
+    'pool': PoolTree,
+    'jit': JitTree,
+}
+
+def aggregate_statistics(results, target):
+    """
+    Combine the root statistics of every tree in the forest into one move.
+
+    The trees are searched independently from the same root (root-parallel
+    MCTS), so their visit counts for each child cell are summed and the cell
+    with the most visits overall is chosen. As in `search`, a child at the
+    target cell is always chosen when it is valid.
+
+    Args:
+        results (list): The root statistics of each tree, see
+            MCTree.root_statistics. None marks a tree whose root has no valid
+            children left.
+        target (int): The flat cell index of the target (see cell_index).
+
+    Returns:
+        tuple: A tuple containing (next_cell, totals) where next_cell is the
+            flat index of the chosen cell, or None if the root is a dead end,
+            and totals maps each child cell to its summed visits and
+            visit-weighted mean value.
+    """
+    visits = {}
+    value_sums = {}
+    for result in results:
+        if result is None:
+            return None, {}
+
+        cells, selections, values = result
+        for cell, count, value in zip(cells.tolist(), selections.tolist(), values.tolist()):
+            visits[cell] = visits.get(cell, 0) + count
+            value_sums[cell] = value_sums.get(cell, 0) + count*value
+
+    totals = {
+        cell: (count, value_sums[cell]/count if count else 0.0)
+        for cell, count in visits.items()
+        }
+
+    if target in visits:
+        return target, totals
+
+    # Ties go to the first cell seen, matching the child order used by search
+    next_cell = max(visits, key=visits.get, default=None)
+    if next_cell is None or visits[next_cell] == 0:
+        return None, totals
+    return next_cell, totals
+
+def decision_settled(results, totals, next_cell, remaining, confidence):
+    """
+    Check whether further search can be skipped for the current step.
+
+    A step is settled when the root is a dead end, the target can be reached
+    directly, the most visited child leads the runner-up by more visits than
+    the remaining trajectories could add, or it holds at least `confidence` of
+    all visits and every tree prefers it on its own.
+
+    Args:
+        results (list): The root statistics of each tree, see aggregate_statistics.
+        totals (dict): The pooled statistics returned by aggregate_statistics.
+        next_cell (int or None): The cell chosen by aggregate_statistics.
+        remaining (int): The number of trajectories left in the step's budget,
+            summed over all trees.
+        confidence (float): Share of the pooled visits the chosen child needs
+            for the step to end early when the trees agree.
+
+    Returns:
+        bool: True if the step's decision is settled.
+    """
+    if next_cell is None or next_cell not in totals:
+        return True
+
+    visits = sorted((count for count, _ in totals.values()), reverse=True)
+    leader = totals[next_cell][0]
+    if leader < visits[0]:
+        # The target was chosen without being the most visited child
+        return True
+
+    runner_up = visits[1] if len(visits) > 1 else 0
+    if leader - runner_up > remaining:
+        return True
+
+    if leader < confidence*sum(visits):
+        return False
+    return all(cells[selections.argmax()] == next_cell for cells, selections, _ in results)
+
+def consensus_prefix(variations, next_cell):
+    """
+    Get the cells that every tree agrees to move through next.
+
+    Args:
+        variations (list): The principal variation of each tree, see
+            MCTree.principal_variation.
+        next_cell (int): The cell chosen from the pooled root statistics.
+
+    Returns:
+        list: The longest chain of cells shared by the start of every
+            variation, or [next_cell] if a tree does not start with it.
+    """
+    prefix = [next_cell]
+    if not all(variation[:1] == [next_cell] for variation in variations):
+        return prefix
+
+    for step, cell in enumerate(variations[0][1:], 1):
+        if not all(len(variation) > step and variation[step] == cell for variation in variations):
+            break
+        prefix.append(cell)
+    return prefix
+
+class LocalForest:
+    """
+    A forest of search trees that all live in the calling process.
+
+    This is used when the agent runs a single tree, where a worker process
+    would only add start-up and communication overhead. It exposes the same
+    commands as WorkerForest.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty local forest.
+        """
+        self.trees = []
+        self.c = []
+
+    def reset(self, cost_surface, start, target, distance_factor, backend, c, prune=False, max_nodes=None,
+              distance_field=None, transposition=False):
+        """
+        Replace the forest with new trees rooted at the start location.
+
+        Args:
+            cost_surface (np.ndarray): The cost surface for calculating move costs.
+            start (list): The starting location coordinates [y, x].
+            target (list): The target destination coordinates [y, x].
+            distance_factor (float): Weight for euclidean distance in reward calculation.
+            backend (str): Key of the tree class in TREE_BACKENDS.
+            c (list): Exploration parameter of each tree.
+            prune (bool, optional): Whether the trees release abandoned sibling
+                subtrees, see MCTree.select_root. Defaults to False.
+            max_nodes (int, optional): Node budget of each tree, see
+                MCTree.enforce_node_budget. Defaults to None (unbounded).
+            distance_field (np.ndarray, optional): Distance from every cell to
+                the target used as the reward prior. Defaults to None.
+            transposition (bool, optional): Whether each tree pools statistics
+                per cell, see TranspositionTable. Defaults to False.
+        """
+        tree_class = TREE_BACKENDS[backend]
+        self.trees = [
+            tree_class(
+                cost_surface, start, target, distance_factor=distance_factor, prune=prune, max_nodes=max_nodes,
+                distance_field=distance_field, transposition=transposition
+                )
+            for _ in c
+            ]
+        self.c = list(c)
+
+    def search(self, num_trajectories, backprop_batch=1):
+        """
+        Search every tree from its current root.
+
+        Args:
+            num_trajectories (int): The number of search trajectories per tree.
+            backprop_batch (int, optional): Number of trajectories whose updates
+                are accumulated before backpropagating them. Defaults to 1.
+
+        Returns:
+            list: The root statistics of each tree (see MCTree.root_statistics),
+                or None for trees whose root has no valid children left.
+        """
+        return [tree.search(num_trajectories, c, backprop_batch) for tree, c in zip(self.trees, self.c)]
+
+    def principal_variations(self, length, consensus):
+        """
+        Get the principal variation of every tree.
+
+        Args:
+            length (int): The maximum number of cells of each variation.
+            consensus (float): See MCTree.principal_variation.
+
+        Returns:
+            list: The variation of each tree as a list of flat cell indices.
+        """
+        return [tree.principal_variation(length, consensus) for tree in self.trees]
+
+    def select_root(self, new_root):
+        """
+        Move the root of every tree to the chosen child location.
+
+        Args:
+            new_root (int): The flat cell index of the new root, see MCTree.select_root.
+        """
+        for tree in self.trees:
+            tree.select_root(new_root)
+
+    def backtrack(self):
+        """
+        Mark the root of every tree as a dead end and return to its parent.
+        """
+        for tree in self.trees:
+            tree.backtrack()
+
+    def close(self):
+        """
+        Release the trees of the forest.
+        """
+        self.trees = []
+
+def _forest_worker(connection):
+    """
+    Event loop of a WorkerForest process.
+
+    Each worker owns one search tree for the lifetime of a route. The cost
+    surface and distance field are attached read-only from shared memory, so
+    only small commands and results are sent through the connection.
+
+    Args:
+        connection (multiprocessing.connection.Connection): The worker end of
+            the pipe to the coordinating process.
+    """
+    segments = {}
+    tree = None
+    c = None
+
+    def attach(descriptor):
+        name, shape, dtype = descriptor
+        if name not in segments:
+            segments[name] = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=dtype, buffer=segments[name].buf)
+        array.flags.writeable = False
+        return array
+
+    while True:
+        command, *args = connection.recv()
+        if command == 'close':
+            break
+
+        try:
+            result = None
+            if command == 'reset':
+                surface, field, start, target, distance_factor, backend, c, prune, max_nodes, transposition = args
+                tree = None
+
+                # Detach from the segments of previous routes that are no longer shared
+                names = {surface[0]} | ({field[0]} if field is not None else set())
+                for name in [name for name in segments if name not in names]:
+                    segments.pop(name).close()
+
+                tree = TREE_BACKENDS[backend](
+                    attach(surface), start, target, distance_factor=distance_factor, prune=prune,
+                    max_nodes=max_nodes, distance_field=attach(field) if field is not None else None,
+                    transposition=transposition
+                    )
+
+            elif command == 'search':
+                num_trajectories, backprop_batch = args
+                result = tree.search(num_trajectories, c, backprop_batch)
+
+            elif command == 'principal_variation':
+                result = tree.principal_variation(*args)
+
+            elif command == 'select_root':
+                tree.select_root(args[0])
+
+            elif command == 'backtrack':
+                tree.backtrack()
+
+            else:
+                raise ValueError('Unknown forest command: {}'.format(command))
+
+        except Exception as e:
+            connection.send(('error', e))
+            continue
+
+        connection.send(('ok', result))
+
+    tree = None
+    for shm in segments.values():
+        shm.close()
+    connection.close()
+
+class WorkerForest:
+    """
+    A forest of search trees that live in long-lived worker processes.
+
+    The worker processes are started once and reused for every step of every
+    route, each one owning a single tree. The cost surface and distance field
+    are copied once into shared memory and attached by all workers, so each
+    step only exchanges
+    small commands and the statistics of the children of each tree's root,
+    whose size does not depend on how large the trees grow.
+
+    Attributes:
+        num_workers (int): Number of worker processes (and trees).
+    """
+
+    def __init__(self, num_workers):
+        """
+        Start the worker processes.
+
+        Args:
+            num_workers (int): Number of worker processes to start.
+        """
+        self.num_workers = num_workers
+        self._connections = []
+        self._processes = []
+        self._segments = []
+        self._shared = {}
+
+        # Start the resource tracker before the workers so they all share it,
+        # otherwise each worker would track and unlink the shared surface itself
+        resource_tracker.ensure_running()
+
+        for _ in range(num_workers):
+            parent_connection, child_connection = mp.Pipe()
+            process = mp.Process(target=_forest_worker, args=(child_connection,), daemon=True)
+            process.start()
+            child_connection.close()
+            self._connections.append(parent_connection)
+            self._processes.append(process)
+
+        # Stop the workers and free shared memory even if close is never called
+        self._finalizer = weakref.finalize(
+            self, WorkerForest._shutdown, self._connections, self._processes, self._segments
+            )
+
+    def _share(self, role, array):
+        """
+        Copy an array into shared memory unless it is already shared.
 
-                # Backtrack to parent node
-                current_node = current_node.parent
+        Each role holds one array at a time, so sharing a new array frees the
+        segment of the array it replaces.
 
-                # If no parent, raise error - no possible route exists
-                if current_node is None:
-                    raise ValueError('Unable to find pipeline route')
+        Args:
+            role (str): The name of the array, e.g. 'surface'.
+            array (np.ndarray): The array to share with the workers.
 
-                continue
+        Returns:
+            tuple: A (name, shape, dtype) descriptor the workers attach to.
+        """
+        shared = self._shared.get(role)
+        if shared is None or shared[0] is not array:
+            if shared is not None:
+                self._segments.remove(shared[1])
+                WorkerForest._release([shared[1]])
+
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            copy = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            copy[:] = array
+            del copy
+            self._segments.append(shm)
+            shared = self._shared[role] = (array, shm)
+
+        return shared[1].name, array.shape, array.dtype.str
+
+    @staticmethod
+    def _release(segments):
+        """
+        Free shared memory segments.
 
-            else:
-                current_node = selected_child
+        Args:
+            segments (list): The SharedMemory segments to free, emptied in place.
+        """
+        while segments:
+            shm = segments.pop()
+            shm.close()
+            shm.unlink()
 
-            # Check if we've reached the target
-            if np.array_equal(current_node.location, target):
-                break
-        
-        # MCTS Expansion phase: expand non-terminal leaf nodes
-        if not np.array_equal(current_node.location, target) and not backtracked:
-            
-            # Create child nodes for all valid moves from current position
-            current_node.expand(cost_surface, target)
-            
-            # Check if expansion produced valid children, otherwise mark as dead end
-            if not current_node.children:
+    @staticmethod
+    def _shutdown(connections, processes, segments):
+        """
+        Stop the worker processes and free the shared memory segments.
 
-                # Flag to indicate that the current node has been backtracked
-                backtracked = True
+        Args:
+            connections (list): Pipes to the workers, emptied in place.
+            processes (list): The worker processes, emptied in place.
+            segments (list): The SharedMemory segments, emptied in place.
+        """
+        for connection, process in zip(connections, processes):
+            try:
+                connection.send(('close',))
+            except (BrokenPipeError, OSError):
+                pass
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+            connection.close()
+
+        connections.clear()
+        processes.clear()
+        WorkerForest._release(segments)
+
+    def _call(self, commands):
+        """
+        Send one command to each worker and collect their results.
 
-                # Mark current node as no-go
-                current_node.mark_as_no_go()
+        Args:
+            commands (list): One command tuple per worker.
 
-                # Backtrack to parent node
-                current_node = current_node.parent
-                    
-        # MCTS Backpropagation phase: update value estimates up the tree
-        if not current_node is root and not backtracked:
-            current_node.backpropagate()
-            current_node.selections += 1
+        Returns:
+            list: The result returned by each worker.
 
-        # Check if the root node has any valid children left
-        if not [child for child in root.children if not child.is_no_go]:
-            return None, None
+        Raises:
+            Exception: Re-raises the first exception raised by a worker.
+        """
+        for connection, command in zip(self._connections, commands):
+            connection.send(command)
+
+        results = []
+        error = None
+        for connection in self._connections:
+            status, result = connection.recv()
+            if status == 'error' and error is None:
+                error = result
+            results.append(result)
+
+        if error is not None:
+            raise error
+        return results
+
+    def reset(self, cost_surface, start, target, distance_factor, backend, c, prune=False, max_nodes=None,
+              distance_field=None, transposition=False):
+        """
+        Replace the forest with new trees rooted at the start location.
 
-    # After all trajectories, select the best child based on selection count
-    max_value = -np.inf
-    most_selections = 0
-    next_node = None
+        See LocalForest.reset for the arguments.
+        """
+        surface = self._share('surface', cost_surface)
+        field = self._share('distance_field', distance_field) if distance_field is not None else None
+        self._call([
+            ('reset', surface, field, list(start), list(target), distance_factor, backend, tree_c, prune, max_nodes,
+             transposition)
+            for tree_c in c
+            ])
+
+    def search(self, num_trajectories, backprop_batch=1):
+        """
+        Search every tree from its current root.
 
-    # Find the child with the most selections (most promising move)
-    for child in root.children:
-        if child.is_no_go:
-            continue
+        See LocalForest.search for the arguments and return value.
+        """
+        return self._call([('search', num_trajectories, backprop_batch)]*self.num_workers)
 
-        # If target is directly reachable, select it immediately
-        if np.array_equal(child.location, target):
-            next_node = child
-            break
+    def principal_variations(self, length, consensus):
+        """
+        Get the principal variation of every tree.
 
-        if child.selections > most_selections:
-            most_selections = child.selections
-            next_node = child
+        See LocalForest.principal_variations for the arguments and return value.
+        """
+        return self._call([('principal_variation', length, consensus)]*self.num_workers)
 
-    # All children are no-go
-    if next_node is None and root.children:
-        return None, None
-        
-    return root, next_node
+    def select_root(self, new_root):
+        """
+        Move the root of every tree to the chosen child location.
+
+        See LocalForest.select_root for the arguments.
+        """
+        self._call([('select_root', new_root)]*self.num_workers)
+
+    def backtrack(self):
+        """
+        Mark the root of every tree as a dead end and return to its parent.
+        """
+        self._call([('backtrack',)]*self.num_workers)
+
+    def close(self):
+        """
+        Stop the worker processes and free the shared cost surface.
+        """
+        self._finalizer()
+        self._shared.clear()
 
 class MCAgent:
     """
@@ -766,24 +4211,118 @@ class MCAgent:
     This class implements a pipeline routing agent that uses multiple parallel MCTS
     instances (a "forest" of search trees) to explore the state space efficiently.
     Each tree can use different exploration parameters to diversify the search.
-    The trees vote on the next best move, providing a more robust routing solution.
+    The visit statistics of all trees are pooled to pick the next best move,
+    providing a more robust routing solution.
     
     Attributes:
         num_workers (int): Number of parallel MCTS instances to run.
         distance_factor (float): Weight factor for distance in reward calculations.
         trajectories (int): Number of search trajectories for each tree.
         c (list): List of exploration parameters, one for each worker.
+        backend (str): Tree representation used for searching, either 'object'
+            (Node objects), 'pool' (array-backed NodePool) or 'jit' (NodePool
+            searched by a compiled kernel).
+        backprop_batch (int): Number of trajectories accumulated before their
+            updates are backpropagated.
+        prune (bool): Whether the trees release the subtrees of abandoned
+            siblings after each committed step.
+        max_nodes (int or None): Node budget of each tree, None for no limit.
+        prior (str): Distance used to reward progress toward the target, either
+            'euclidean' or 'cost_to_go' (see cost_to_go).
+        min_trajectories (int or None): Number of trajectories searched per tree
+            before a step may end early, None for a fixed budget.
+        confidence (float): Share of the pooled root visits the chosen child
+            needs for a step to end early, see decision_settled.
+        max_commit (int): Most cells committed after each search round.
+        consensus (float): Visit share each cell of a principal variation
+            needs to be committed, see MCTree.principal_variation.
+        skip_pockets (bool): Whether dead pockets are made impassable before
+            each route is searched, see dead_pockets.
+        transposition (bool): Whether each tree pools the statistics of the
+            nodes reaching the same cell, see TranspositionTable.
+        report (dict): Statistics of the last route. 'trajectories' holds the
+            number of trajectories searched per tree in each search round,
+            'committed' the number of cells committed after it, 'segments'
+            the (engine, first, last) path indices produced by each engine,
+            'mcts' for the search and 'exact' for the deadline fallback, and
+            'pockets' the number of dead cells made impassable.
+        forest (LocalForest or WorkerForest): The trees of the agent. With more
+            than one worker the trees live in persistent worker processes that
+            are started on the first route and reused until `close` is called.
     """
-    def __init__(self, trajectories, num_workers=None, distance_factor=1.0):
+    def __init__(
+            self,
+            trajectories,
+            num_workers=None,
+            distance_factor=1.0,
+            backend='object',
+            backprop_batch=1,
+            prune=False,
+            max_nodes=None,
+            prior='euclidean',
+            min_trajectories=None,
+            confidence=0.5,
+            max_commit=1,
+            consensus=0.5,
+            skip_pockets=False,
+            transposition=False
+            ):
         """
         Initialize a Monte Carlo Agent.
         
         Args:
-            trajectories (int): Number of search trajectories for each MCTS instance.
+            trajectories (int): Number of search trajectories for each MCTS instance,
+                or the most searched per step when min_trajectories is set.
             num_workers (int, optional): Number of parallel MCTS instances to run.
                 If None, uses half the available CPU cores. Defaults to None.
             distance_factor (float, optional): Weight for euclidean distance in reward
                 calculation. Defaults to 1.0.
+            backend (str, optional): Tree representation to search with. 'object'
+                builds a tree of Node objects, 'pool' stores every node in a
+                preallocated NodePool and 'jit' searches a NodePool with a
+                kernel compiled by Numba, falling back to 'pool' when Numba is
+                not installed. Defaults to 'object'.
+            backprop_batch (int, optional): Number of trajectories whose updates
+                are accumulated and backpropagated together in one pass.
+                Defaults to 1, which backpropagates after every trajectory.
+            prune (bool, optional): Release the subtrees of the siblings of each
+                committed step. The committed route and the siblings themselves
+                are kept, so backtracking still works. Defaults to False.
+            max_nodes (int, optional): Maximum number of nodes kept by each tree
+                after every search step. The least visited leaves are evicted
+                when it is exceeded. Defaults to None (unbounded).
+            prior (str, optional): 'euclidean' rewards straight-line progress
+                toward the target. 'cost_to_go' computes the accumulated cost to
+                the target once per route and rewards progress along it, so
+                trees do not explore pockets behind high cost barriers.
+                Defaults to 'euclidean'.
+            min_trajectories (int, optional): Enables an adaptive budget. Each
+                step first searches min_trajectories per tree, then keeps
+                searching in chunks of min_trajectories, up to trajectories,
+                until the decision is settled (see decision_settled).
+                Defaults to None, which always searches trajectories.
+            confidence (float, optional): Share of the pooled root visits the
+                most visited child needs for a step to end early when all
+                trees agree on it. Defaults to 0.5.
+            max_commit (int, optional): Most cells committed after each search
+                round. Beyond the chosen cell, the cells on which the principal
+                variations of all trees agree are committed too. Defaults to 1.
+            consensus (float, optional): Share of its siblings' visits each
+                cell of a principal variation needs. Defaults to 0.5.
+            skip_pockets (bool, optional): Make the cells found by dead_pockets
+                impassable before searching, so trees never expand into
+                cul-de-sacs. Defaults to False.
+            transposition (bool, optional): Share the value and visits of every
+                node reaching a cell through a TranspositionTable per tree.
+                Requires a backprop_batch of 1. Defaults to False.
+
+        Raises:
+            KeyError: If an invalid backend or prior is specified.
+            ValueError: If backprop_batch, max_nodes, min_trajectories or
+                max_commit is smaller than 1, confidence or consensus is not in
+                (0, 1], the cost_to_go prior is used without a positive
+                distance_factor, or transposition is combined with batched
+                backpropagation.
         """
         
         self.num_workers = num_workers
@@ -796,13 +4335,99 @@ class MCAgent:
         else:
             self.c = [np.sqrt(2)]
 
-    def route(self, cost_surface, start, target, max_steps=1000, show_viz=False):
+        if backend not in TREE_BACKENDS:
+            raise KeyError('Unknown search backend: {}'.format(backend))
+        if backend == 'jit' and not JIT_AVAILABLE:
+            warnings.warn('Numba is not installed, searching with the pure Python pool backend instead')
+        self.backend = backend
+
+        if backprop_batch < 1:
+            raise ValueError('backprop_batch must be at least 1, got {}'.format(backprop_batch))
+        self.backprop_batch = backprop_batch
+
+        if max_nodes is not None and max_nodes < 1:
+            raise ValueError('max_nodes must be at least 1, got {}'.format(max_nodes))
+        self.prune = prune
+        self.max_nodes = max_nodes
+
+        if prior not in ('euclidean', 'cost_to_go'):
+            raise KeyError('Unknown prior: {}'.format(prior))
+        if prior == 'cost_to_go' and distance_factor <= 0:
+            raise ValueError('The cost_to_go prior requires a positive distance_factor')
+        self.prior = prior
+
+        if min_trajectories is not None and min_trajectories < 1:
+            raise ValueError('min_trajectories must be at least 1, got {}'.format(min_trajectories))
+        if not 0 < confidence <= 1:
+            raise ValueError('confidence must be in (0, 1], got {}'.format(confidence))
+        self.min_trajectories = min_trajectories
+        self.confidence = confidence
+
+        if max_commit < 1:
+            raise ValueError('max_commit must be at least 1, got {}'.format(max_commit))
+        if not 0 < consensus <= 1:
+            raise ValueError('consensus must be in (0, 1], got {}'.format(consensus))
+        self.max_commit = max_commit
+        self.consensus = consensus
+        self.skip_pockets = skip_pockets
+
+        if transposition and backprop_batch != 1:
+            raise ValueError('transposition requires a backprop_batch of 1, got {}'.format(backprop_batch))
+        self.transposition = transposition
+        self.report = {'trajectories': [], 'committed': []}
+        self.forest = None
+
+    def _get_forest(self):
+        """
+        Get the agent's forest, starting the worker processes if needed.
+
+        Returns:
+            LocalForest or WorkerForest: The forest of search trees.
+        """
+        if self.forest is None:
+            if self.num_workers > 1:
+                self.forest = WorkerForest(self.num_workers)
+            else:
+                self.forest = LocalForest()
+        return self.forest
+
+    def prior_field(self, cost_surface, target):
+        """
+        Compute the cost_to_go field of a target for the cost_to_go prior.
+
+        Args:
+            cost_surface (np.ndarray): The cost surface searched.
+            target (list): The target destination coordinates [y, x].
+
+        Returns:
+            np.ndarray: The field, see cost_to_go.
+        """
+        # Weight costs like the rewards do, which subtract twice the cost of
+        # each move but only distance_factor times its progress
+        return cost_to_go(cost_surface, target, cost_weight=2/self.distance_factor)
+
+    def close(self):
+        """
+        Stop the agent's worker processes and release their shared memory.
+        """
+        if self.forest is not None:
+            self.forest.close()
+            self.forest = None
+
+    def route(self, cost_surface, start, target, max_steps=1000, show_viz=False, time_budget=None, no_go=None,
+              distance_field=None, dead=None):
         """
         Find an optimal route from start to target on the cost surface.
         
         This method uses multiple parallel MCTS instances to determine the best
-        path. At each step, all trees vote on the next location to move to.
+        path. At each step, the trees' visit counts for the children of the
+        shared root are summed and the most visited location is moved to.
         The search continues until the target is reached or max_steps is exceeded.
+
+        With a time budget the search stops once it is spent, and the rest of
+        the route is completed by exact_route from the last committed cell.
+        The part of the path each engine produced is recorded in
+        report['segments'].
         
         Args:
             cost_surface (np.ndarray): The cost surface for calculating move costs.
@@ -811,74 +4436,229 @@ class MCAgent:
             max_steps (int, optional): Maximum number of steps to take. Defaults to 1000.
             show_viz (bool, optional): Whether to visualize the search progress.
                 Defaults to False.
+            time_budget (float, optional): Seconds the search may run before
+                the route is completed by the fallback. Defaults to None (no
+                deadline).
+            no_go (np.ndarray, optional): Boolean array of cells treated as
+                walls when looking for dead pockets. Defaults to None.
+            distance_field (np.ndarray, optional): The target's field for the
+                cost_to_go prior, see prior_field, when it is shared between
+                routes. Defaults to None, computed by route.
+            dead (np.ndarray, optional): Dead cells of skip_pockets already set
+                to -1 in cost_surface, see dead_pockets, when they are shared
+                between routes. Defaults to None, found by route.
                 
         Returns:
             list: A list of coordinates representing the optimal path from start to target.
+
+        Raises:
+            ValueError: If the cost_to_go prior or the fallback shows the target
+                cannot be reached, or time_budget is negative.
         """
+        if time_budget is not None and time_budget < 0:
+            raise ValueError('time_budget must not be negative, got {}'.format(time_budget))
+        deadline = None if time_budget is None else time.perf_counter() + time_budget
+
+        pockets = 0
+        if self.skip_pockets:
+            if dead is None:
+                dead = dead_pockets(cost_surface, start, target, walls=no_go)
+                cost_surface = np.where(dead, -1, cost_surface)
+            pockets = int(dead.sum())
+
+        if self.prior != 'cost_to_go':
+            distance_field = None
+        else:
+            if distance_field is None:
+                distance_field = self.prior_field(cost_surface, target)
+            if not np.isfinite(distance_field[start[0], start[1]]):
+                raise ValueError('Unable to find pipeline route')
+
         # Create multiple search trees ("forest") for parallel exploration with the same parameters
-        forest = [
-            MCTree(cost_surface, start, target, distance_factor=self.distance_factor) for _ in range(self.num_workers)
-            ]
+        forest = self._get_forest()
+        forest.reset(
+            cost_surface, start, target, self.distance_factor, self.backend, self.c,
+            prune=self.prune, max_nodes=self.max_nodes, distance_field=distance_field,
+            transposition=self.transposition
+            )
         path = [start]
+        width = cost_surface.shape[1]
+        target_cell = cell_index(target, width)
+        self.report = {'trajectories': [], 'committed': [], 'segments': [], 'pockets': pockets}
+        chunk = min(self.min_trajectories or self.trajectories, self.trajectories)
         
         for _ in range(max_steps):
-            # Prepare arguments for parallel search across all trees, each with different exploration parameter c
-            args = [(tree.root, target, self.trajectories, cost_surface, c) for tree,c in zip(forest, self.c)]
-            
-            # Execute MCTS search in parallel using multiprocessing
-            with Pool(self.num_workers) as pool:
-                results = pool.starmap(search, args)
-                votes = {}
+            if deadline is not None and time.perf_counter() >= deadline:
+                return self._complete_route(cost_surface, path, target)
+
+            # Execute MCTS search on every tree, each with a different exploration parameter c,
+            # and pool the statistics of their root's children
+            results = forest.search(chunk, self.backprop_batch)
+            next_cell, totals = aggregate_statistics(results, target_cell)
+            searched = chunk
+
+            # Keep searching until the budget is spent or more search cannot change the decision
+            while searched < self.trajectories and not decision_settled(
+                    results, totals, next_cell, (self.trajectories - searched)*len(results), self.confidence) \
+                    and (deadline is None or time.perf_counter() < deadline):
+                trajectories = min(chunk, self.trajectories - searched)
+                results = forest.search(trajectories, self.backprop_batch)
+                next_cell, totals = aggregate_statistics(results, target_cell)
+                searched += trajectories
+            self.report['trajectories'].append(searched)
+
+            # Determine if the root is invalid (all children are no-go)
+            if next_cell is None:
+                # If no valid path forward, set the root node of all trees to
+                # no-go and select its parent as the new root
+                forest.backtrack()
 
+                # Remove last entry from path (the invalid root)
+                path.pop()
+                continue
             
-            valid_root = True
+            # Move to the cell with the most visits across the forest, followed
+            # by the cells all trees agree on when committing several at once
+            cells = [next_cell]
+            if self.max_commit > 1 and next_cell != target_cell:
+                cells = consensus_prefix(forest.principal_variations(self.max_commit, self.consensus), next_cell)
+            self.report['committed'].append(len(cells))
 
-            # Collect votes from each tree for the next best location to move to
-            for (root, node), tree in zip(results, forest):
+            for cell in cells:
+                next_location_arr = np.array(cell_location(cell, width))
+                path.append(next_location_arr.tolist())
 
-                # Determine if the root is invalid (all children are no-go)
-                if root is None or node is None:
-                    valid_root = False
-                    break
+                if show_viz:
+                    obs = visualize(cost_surface, next_location_arr, target, path=path)
+                    plot_path(np.moveaxis(obs, 0, -1))
 
-                # Format the node location as a string key for voting
-                y = str(node.location[0]).zfill(3)
-                x = str(node.location[1]).zfill(3)
-                key = y + ',' + x
-                votes[key] = votes.get(key, 0) + 1
-                tree.root = root
-
-            if not valid_root:
-                # If no valid path forward, implement backtracking mechanism
-                for tree in forest:
-                    # Set root node of all trees to no-go
-                    tree.root.mark_as_no_go()
-                    # Select the parent node as the new root
-                    tree.root = tree.root.parent
+                # Check if we've reached the target
+                if cell == target_cell:
+                    self.report['segments'].append(('mcts', 0, len(path) - 1))
+                    return path
 
-                # Remove last entry from path (the invalid root)
-                path.pop()
-                continue
-            
-            # Select the location with the most votes as the next step
-            next_location_str = max(votes, key=votes.get)
-            next_location_arr = np.array([int(next_location_str.split(',')[0]), int(next_location_str.split(',')[1])])
-            path.append(next_location_arr.tolist())
+                # Update all trees to have the same new root node at the chosen location
+                forest.select_root(cell)
 
-            if show_viz:
-                obs = visualize(cost_surface, next_location_arr, target, path=path)
-                plot_path(np.moveaxis(obs, 0, -1))
+        if deadline is not None:
+            return self._complete_route(cost_surface, path, target)
 
-            # Check if we've reached the target
-            if np.array_equal(next_location_arr, target):
-                break
+        self.report['segments'].append(('mcts', 0, len(path) - 1))
+        return path
+
+    def route_hierarchical(self, levels, start, target, buffer=2, max_steps=1000, time_budget=None,
+                           exclusions=None):
+        """
+        Find a route by refining it from the coarsest to the finest cost surface.
+
+        The route is first searched on the coarsest level. On each finer level
+        the search is limited to the corridor of cells under the route found
+        on the level above, widened by buffer coarse cells on every side: the
+        surface is cropped to the corridor's bounding box and the cells
+        outside of it are made impassable. Exclusions are coarsened to every
+        level, see Overlay.coarsen, and applied to the coarsest level and the
+        corridors, so no level is copied whole.
 
-            # Update all trees to have the same new root node at the chosen location
-            for tree in forest:
-                tree.select_root(next_location_str)  # Use select_root instead of prune
+        Args:
+            levels (list): Cost surfaces from the coarsest to the finest, each
+                an integer number of times finer than the one before, see
+                CostSurface.build_levels.
+            start (list): The starting location [y, x] on the finest level.
+            target (list): The target location [y, x] on the finest level.
+            buffer (int, optional): Number of coarse cells the corridor extends
+                beyond the coarse route. Defaults to 2.
+            max_steps (int, optional): Maximum number of steps on each level.
+                Defaults to 1000.
+            time_budget (float, optional): Seconds all levels may search in
+                total, see route. Defaults to None (no deadline).
+            exclusions (Overlay, optional): Cost changes on the finest level,
+                see MLWrapper.route. Defaults to None.
+
+        Returns:
+            list: A list of coordinates of the route on the finest level. The
+                report of each level is kept in report['levels'].
 
+        Raises:
+            ValueError: If the route cannot be found on one of the levels.
+        """
+        deadline = None if time_budget is None else time.perf_counter() + time_budget
+        factors = [-(-fine.shape[0]//coarse.shape[0]) for coarse, fine in zip(levels, levels[1:])]
+        scales = [int(np.prod(factors[level:])) for level in range(len(levels))]
+
+        reports = []
+        path = None
+        for level, surface in enumerate(levels):
+            scale = scales[level]
+            level_start = [start[0]//scale, start[1]//scale]
+            level_target = [target[0]//scale, target[1]//scale]
+            top, left = 0, 0
+            level_exclusions = None
+            if exclusions is not None:
+                level_exclusions = exclusions if scale == 1 else exclusions.coarsen(scale, keep=(level_start, level_target))
+
+            if path is not None:
+                # Limit the search to the corridor under the route of the level above
+                factor = factors[level - 1]
+                corridor = np.zeros(levels[level - 1].shape, dtype=np.uint8)
+                corridor[tuple(np.array(path).T)] = 1
+                corridor = cv.dilate(corridor, np.ones((2*buffer + 1, 2*buffer + 1), dtype=np.uint8))
+                corridor = corridor.repeat(factor, axis=0).repeat(factor, axis=1)[:surface.shape[0], :surface.shape[1]]
+
+                rows, cols = np.flatnonzero(corridor.any(axis=1)), np.flatnonzero(corridor.any(axis=0))
+                top, bottom, left, right = int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+                surface = surface[top:bottom, left:right].copy()
+                surface[corridor[top:bottom, left:right] == 0] = -1
+                if level_exclusions is not None:
+                    surface[level_exclusions.cells_in(top, left, bottom, right)] = level_exclusions.cost
+            elif level_exclusions is not None:
+                surface = level_exclusions.apply(surface)
+
+            remaining = None if deadline is None else max(deadline - time.perf_counter(), 0)
+            path = self.route(
+                surface,
+                [level_start[0] - top, level_start[1] - left],
+                [level_target[0] - top, level_target[1] - left],
+                max_steps=max_steps,
+                time_budget=remaining
+                )
+            path = [[y + top, x + left] for y, x in path]
+            reports.append(self.report)
+            if path[-1] != level_target:
+                raise ValueError('Unable to find pipeline route')
+
+        self.report = dict(reports[-1], levels=reports)
         return path
 
+    def _complete_route(self, cost_surface, path, target):
+        """
+        Complete a route the search ran out of time on with exact_route.
+
+        The fallback avoids the cells already committed to the path, unless
+        that leaves no way to the target.
+
+        Args:
+            cost_surface (np.ndarray): The cost surface of the route.
+            path (list): The [y, x] locations committed by the search.
+            target (list): The target destination coordinates [y, x].
+
+        Returns:
+            list: The committed path followed by the fallback route.
+
+        Raises:
+            ValueError: If the target cannot be reached from the end of the path.
+        """
+        cost_weight = 2/self.distance_factor if self.distance_factor > 0 else 1.0
+        remaining = exact_route(cost_surface, path[-1], target, cost_weight=cost_weight, blocked=path[:-1])
+        if remaining is None:
+            remaining = exact_route(cost_surface, path[-1], target, cost_weight=cost_weight)
+        if remaining is None:
+            raise ValueError('Unable to find pipeline route')
+
+        if len(path) > 1:
+            self.report['segments'].append(('mcts', 0, len(path) - 1))
+        self.report['segments'].append(('exact', len(path) - 1, len(path) + len(remaining) - 2))
+        return path + remaining[1:]
+
 class MLWrapper:
     """
     High-level wrapper for Monte Carlo Tree Search pipeline routing.
@@ -890,8 +4670,16 @@ class MLWrapper:
     for each mode.
     
     Attributes:
-        cost_surface (CostSurface): The cost surface used for routing.
+        cost_surface (CostSurface or TiledSurface): The cost surface used for routing.
         agent (MCAgent): The Monte Carlo agent that performs the actual routing.
+        hierarchical (bool): Whether routes are refined from coarser copies of
+            the cost surface.
+        corridor_buffer (int): Coarse cells each corridor extends beyond the
+            coarse route in hierarchical routing.
+        window_margin (int or None): Initial margin of the search window
+            around start and target, None to search the whole surface.
+        max_window_cells (int or None): Most cells of a search window, None
+            for no limit.
     """
 
     def __init__(
@@ -900,7 +4688,23 @@ class MLWrapper:
             trajectories=100, 
             num_workers=1, 
             cost_degree=2,
-            distance_factor=1.0
+            distance_factor=1.0,
+            backend='object',
+            backprop_batch=1,
+            prune=False,
+            max_nodes=None,
+            prior='euclidean',
+            min_trajectories=None,
+            confidence=0.5,
+            max_commit=1,
+            consensus=0.5,
+            skip_pockets=False,
+            transposition=False,
+            hierarchical=False,
+            corridor_buffer=2,
+            window_margin=None,
+            tile_size=None,
+            max_window_cells=None
             ):
         """
         Initialize the ML routing wrapper.
@@ -916,46 +4720,125 @@ class MLWrapper:
                 in the cost surface. Defaults to 2.
             distance_factor (float, optional): Weight for euclidean distance in reward
                 calculation. Defaults to 1.0.
+            backend (str, optional): Tree representation used by the agent, one
+                of 'object', 'pool' or 'jit' (compiled with Numba when it is
+                installed). Defaults to 'object'.
+            backprop_batch (int, optional): Number of trajectories the agent
+                accumulates before backpropagating them. Defaults to 1.
+            prune (bool, optional): Release abandoned sibling subtrees after each
+                committed step. Defaults to False.
+            max_nodes (int, optional): Node budget of each search tree. Defaults
+                to None (unbounded).
+            prior (str, optional): Distance used to reward progress toward the
+                target, 'euclidean' or 'cost_to_go'. Defaults to 'euclidean'.
+            min_trajectories (int, optional): Smallest number of trajectories
+                per step of the adaptive budget, see MCAgent. Defaults to None
+                (fixed budget of trajectories).
+            confidence (float, optional): Visit share needed to end a step
+                early, see MCAgent. Defaults to 0.5.
+            max_commit (int, optional): Most cells committed after each search
+                round, see MCAgent. Defaults to 1.
+            consensus (float, optional): Visit share needed to commit a cell of
+                the trees' principal variations, see MCAgent. Defaults to 0.5.
+            skip_pockets (bool, optional): Keep the search out of dead pockets,
+                with the no-go areas as walls, see dead_pockets. Defaults to
+                False.
+            transposition (bool, optional): Pool the statistics of tree nodes
+                reaching the same cell, see MCAgent. Defaults to False.
+            hierarchical (bool, optional): Route on national (6x coarser) and
+                regional (2x coarser) copies of the cost surface first and
+                refine the route inside their corridors, see
+                MCAgent.route_hierarchical. Defaults to False.
+            corridor_buffer (int, optional): Number of coarse cells each
+                corridor extends beyond the coarse route. Defaults to 2.
+            window_margin (int, optional): Search only the window spanned by
+                start and target, widened by this many cells, and double the
+                margin until a route is found or the window covers the whole
+                surface. Defaults to None (whole surface).
+            tile_size (int, optional): Read the cost surface lazily in tiles
+                of this many cells a side, so only the tiles the search windows
+                touch are processed, see TiledSurface. Requires window_margin
+                and can't be combined with hierarchical. Defaults to None
+                (whole surface in memory).
+            max_window_cells (int, optional): Most cells of a search window.
+                Routes that would need a larger window fail instead of
+                building it. Defaults to None, TILED_WINDOW_CELLS with
+                tile_size and no limit otherwise.
                 
         Raises:
-            KeyError: If an invalid mode is specified.
+            KeyError: If an invalid mode or backend is specified.
             FileNotFoundError: If required cost surface files are not found.
+            ValueError: If window_margin or max_window_cells is smaller than
+                1, or tile_size is given without window_margin or with
+                hierarchical.
         """
-        self.cost_surface = CostSurface()
-        # self.cost_surface.load_rasters(raster_dir)
-
-        if (mode == 'route'):
-            raster_path=resource_path('cost_surfaces/raw_cost_10km_aea/cost_10km_aea.tif')
-            cost_degree = 2
-            distance_factor = 0.2
-            print("Route Mode")
-
-        elif (mode == 'rail'):
-            raster_path=resource_path('cost_surfaces/10km_RAIL/cost_10km_aea_RAIL_ready.tif')    
-            cost_degree = 1
-            distance_factor = 0.5
-            print("Rail Mode")
-
-        else:
+        # Keep the arguments to build the wrappers of route_many's workers
+        self._config = {name: value for name, value in locals().items() if name != 'self'}
+
+        if window_margin is not None and window_margin < 1:
+            raise ValueError('window_margin must be at least 1, got {}'.format(window_margin))
+        if max_window_cells is not None and max_window_cells < 1:
+            raise ValueError('max_window_cells must be at least 1, got {}'.format(max_window_cells))
+        if tile_size is not None and (window_margin is None or hierarchical):
+            raise ValueError('tile_size requires window_margin and no hierarchical routing')
+        if mode not in ROUTING_MODES:
             raise KeyError("Neither normal nor rail mode selected")
-
-        # Use degree to increase the weighting of high cost areas
-        self.cost_surface.process_raster(raster_path, degree=cost_degree)
-        self.agent = MCAgent(trajectories=trajectories, num_workers=num_workers, distance_factor=distance_factor)
-
-    def route(self, start, target, show_viz=False):
+        raster_path, cost_degree, distance_factor = ROUTING_MODES[mode]
+        print("{} Mode".format(mode.capitalize()))
+
+        # Use degree to increase the weighting of high cost areas, processing
+        # each raster only once per process
+        self.cost_surface = load_surface(resource_path(raster_path), degree=cost_degree, tile_size=tile_size,
+                                         levels=hierarchical)
+        self.hierarchical = hierarchical
+        self.corridor_buffer = corridor_buffer
+        self.window_margin = window_margin
+        self.max_window_cells = TILED_WINDOW_CELLS if tile_size is not None and max_window_cells is None \
+            else max_window_cells
+        self.route_pool = None
+        self._targets = OrderedDict()
+        self.agent = MCAgent(
+            trajectories=trajectories,
+            num_workers=num_workers,
+            distance_factor=distance_factor,
+            backend=backend,
+            backprop_batch=backprop_batch,
+            prune=prune,
+            max_nodes=max_nodes,
+            prior=prior,
+            min_trajectories=min_trajectories,
+            confidence=confidence,
+            max_commit=max_commit,
+            consensus=consensus,
+            skip_pockets=skip_pockets,
+            transposition=transposition
+            )
+
+    def route(self, start, target, show_viz=False, time_budget=None, exclusions=None):
         """
         Find an optimal route from start to target location.
         
         This method checks that start and target points are in the same region 
-        (either both in Alabama or both in the rest of the US) and then uses the 
-        Monte Carlo agent to find the best path between them.
+        (for example both in Alaska or both in the contiguous US) and then uses
+        the Monte Carlo agent to find the best path between them.
         
         Args:
             start (tuple): Starting location coordinates (y, x).
             target (tuple): Target location coordinates (y, x).
             show_viz (bool, optional): Whether to visualize the routing process.
                 Defaults to False.
+            time_budget (float, optional): Seconds the search may run before
+                the route is completed by the exact fallback. The engine of
+                each segment is recorded in agent.report['segments']. Defaults
+                to None (no deadline).
+            exclusions (Overlay, optional): Cost changes of this request, such
+                as areas to avoid from polygon_overlay. Routes with exclusions
+                always search a window, starting with a margin of
+                EXCLUSION_WINDOW_MARGIN without window_margin, so only the
+                searched window is copied to apply them. Hierarchical routes
+                apply them to the corridors of every level instead, and search
+                windows when the coarsened exclusions block the way. Defaults
+                to None.
                 
         Returns:
             tuple: A tuple containing (optimized_path, raw_path) where:
@@ -963,26 +4846,47 @@ class MLWrapper:
                 - raw_path: The raw path data for debugging.
                 
         Raises:
-            AssertionError: If start and target are not in the same region.
+            ValueError: If start or target is outside every region, see
+                CostSurface.label_regions, or in an excluded area, or they are
+                not in the same region.
         """
 
         surface = self.cost_surface.cost
-        no_go = self.cost_surface.no_go
 
-        if start[0]<275:
-            assert target[0]<275 , 'Start location in AL but target location is not'
-            region = 'al'
+        # Reject infeasible requests before spending any search on them
+        self._check_endpoints(start, target, exclusions)
+        
+        if self.hierarchical:
+            started = time.perf_counter()
+            try:
+                path = self.agent.route_hierarchical(
+                    self.cost_surface.levels,
+                    list(start),
+                    list(target),
+                    buffer=self.corridor_buffer,
+                    time_budget=time_budget,
+                    exclusions=exclusions
+                )
+            except ValueError:
+                if exclusions is None:
+                    raise
+                # The coarsened exclusions can close gaps the finest level
+                # routes through, search windows of the finest level instead
+                remaining = None if time_budget is None else max(time_budget - (time.perf_counter() - started), 0)
+                path = self._route_window(list(start), list(target), show_viz, remaining, exclusions)
+
+        elif self.window_margin is not None or exclusions is not None:
+            path = self._route_window(list(start), list(target), show_viz, time_budget, exclusions)
 
         else:
-            assert target[0]>275 , 'Start location in US but target location is not'
-            region = 'us'
-        
-        path = self.agent.route(
-            surface,
-            list(start),
-            list(target),
-            show_viz=show_viz
-        )
+            path = self.agent.route(
+                surface,
+                list(start),
+                list(target),
+                show_viz=show_viz,
+                time_budget=time_budget,
+                no_go=self.cost_surface.no_go
+            )
 
         lucy_path = path
 
@@ -991,3 +4895,486 @@ class MLWrapper:
         else:
             print("Error with lucy_path in mc_agent")
         return lucy_path, path
+
+    def _check_endpoints(self, start, target, exclusions=None):
+        """
+        Check that a route can join start and target, see route.
+
+        Args:
+            start (tuple): Starting location coordinates (y, x).
+            target (tuple): Target location coordinates (y, x).
+            exclusions (Overlay, optional): See route. Defaults to None.
+
+        Raises:
+            ValueError: If start or target is outside every region or in an
+                excluded area, or they are not in the same region.
+        """
+        for name, location in (('Start', start), ('Target', target)):
+            if not self.cost_surface.region(location):
+                raise ValueError('{} location {} is outside the routable area'.format(name, list(location)))
+            if exclusions is not None and exclusions.excludes(location):
+                raise ValueError('{} location {} is in an excluded area'.format(name, list(location)))
+        if not self.cost_surface.reachable(start, target):
+            raise ValueError('Start location {} and target location {} are in different regions'.format(
+                list(start), list(target)))
+
+    def _route_window(self, start, target, show_viz=False, time_budget=None, exclusions=None):
+        """
+        Route inside a window of the cost surface that grows until it succeeds.
+
+        The search runs in window-local coordinates and the route is
+        translated back to indices of the whole surface. When no route to the
+        target is found inside a window, the margin doubles and the search is
+        repeated, ending with the whole surface. Routing fails instead once
+        the window would hold more than max_window_cells. The first margin is
+        window_margin, or EXCLUSION_WINDOW_MARGIN for routes with exclusions
+        on a wrapper without one.
+
+        Args:
+            start (list): Starting location [y, x] on the whole surface.
+            target (list): Target location [y, x] on the whole surface.
+            show_viz (bool, optional): Whether to visualize the routing process.
+                Defaults to False.
+            time_budget (float, optional): Seconds all attempts may search in
+                total. Defaults to None (no deadline).
+            exclusions (Overlay, optional): Applied to each window. Defaults
+                to None.
+
+        Returns:
+            list: The route on the whole surface, ending at the target unless
+                the search ran out of steps on the whole surface. The window
+                it was found in is kept in agent.report['window'].
+
+        Raises:
+            ValueError: If the target cannot be reached on the whole surface,
+                or in the windows of at most max_window_cells.
+        """
+        surface = self.cost_surface.cost
+        deadline = None if time_budget is None else time.perf_counter() + time_budget
+        margin = self.window_margin or EXCLUSION_WINDOW_MARGIN
+        while True:
+            top, left, bottom, right = search_window(surface.shape, start, target, margin)
+            whole = (bottom - top, right - left) == surface.shape
+            if self.max_window_cells is not None and (bottom - top)*(right - left) > self.max_window_cells:
+                raise ValueError('No route from {} to {} in a search window of at most {} cells'.format(
+                    start, target, self.max_window_cells))
+            remaining = None if deadline is None else max(deadline - time.perf_counter(), 0)
+            window = surface[top:bottom, left:right]
+            if exclusions is not None:
+                window = exclusions.apply(window, top, left)
+            try:
+                path = self.agent.route(
+                    window,
+                    [start[0] - top, start[1] - left],
+                    [target[0] - top, target[1] - left],
+                    show_viz=show_viz,
+                    time_budget=remaining,
+                    no_go=self.cost_surface.no_go[top:bottom, left:right]
+                )
+            except ValueError:
+                if whole:
+                    raise
+                path = []
+
+            path = [[y + top, x + left] for y, x in path]
+            if whole or (path and path[-1] == target):
+                self.agent.report['window'] = (top, left, bottom, right)
+                return path
+            margin *= 2
+
+    def route_many(self, pairs, processes=None, time_budget=None, exclusions=None):
+        """
+        Route many start/target pairs at once on a persistent pool of workers.
+
+        Each worker process routes whole pairs with a single search tree and
+        the wrapper's other settings, so throughput grows with the number of
+        processes rather than with the trees searching each pair. The pool is
+        kept for later calls until close. Pairs sharing a target are routed
+        in chunks by the same worker, which prepares the target's search
+        window, exclusions, dead pockets and cost_to_go field once per chunk,
+        see _route_chunk, so routes searched in windows may differ from
+        those of route. Calling route_many again before the iterator of an
+        earlier call is exhausted cancels the earlier call.
+
+        Args:
+            pairs (list): The (start, target) locations (y, x) to route.
+            processes (int, optional): Number of worker processes. Defaults to
+                None, one per CPU.
+            time_budget (float, optional): Seconds each pair may search, see
+                route. Defaults to None (no deadline).
+            exclusions (Overlay, optional): Applied to every pair, see route.
+                Defaults to None.
+
+        Returns:
+            iterator: Yields (index, route, report) for each pair as soon as
+                it is routed, where index is the pair's position in pairs and
+                report is the agent's report of the route. The route is None
+                and the report holds an 'error' message for pairs route
+                rejects.
+
+        Raises:
+            ValueError: If processes is smaller than 1.
+        """
+        processes = mp.cpu_count() if processes is None else processes
+        if processes < 1:
+            raise ValueError('processes must be at least 1, got {}'.format(processes))
+        if self.route_pool is None or self.route_pool.closed or self.route_pool.processes != processes:
+            if self.route_pool is not None:
+                self.route_pool.close()
+            self.route_pool = RoutePool(self._config, processes)
+
+        return self.route_pool.route(pairs, time_budget=time_budget, exclusions=exclusions)
+
+    def _route_pair(self, index, start, target, time_budget=None, exclusions=None):
+        """
+        Route one pair of route_many on its own.
+
+        Args:
+            index (int): The position of the pair in route_many's pairs.
+            start (list): Starting location [y, x].
+            target (list): Target location [y, x].
+            time_budget (float, optional): See route. Defaults to None.
+            exclusions (Overlay, optional): See route. Defaults to None.
+
+        Returns:
+            tuple: The (index, route, report) of the pair, see route_many.
+        """
+        try:
+            return index, self.route(start, target, time_budget=time_budget, exclusions=exclusions)[0], self.agent.report
+        except ValueError as e:
+            return index, None, {'error': str(e)}
+
+    def _route_chunk(self, pairs, time_budget=None, exclusions=None):
+        """
+        Route pairs sharing a target, preparing the target's data once.
+
+        The pairs are searched in one window spanning every start and the
+        target, widened by window_margin like the first window of
+        _route_window, or on the whole surface without window_margin and
+        exclusions. The exclusions are applied to the window once, and the
+        dead pockets of skip_pockets, keeping every start open, and the
+        target's cost_to_go field are found once for all the pairs, see
+        _prepare_target. Pairs the window holds no route for are routed on
+        their own by route, as are all pairs of hierarchical wrappers and
+        windows larger than max_window_cells.
+
+        Args:
+            pairs (list): (index, start, target) tuples with the same target.
+            time_budget (float, optional): Seconds each pair may search, see
+                route. Defaults to None (no deadline).
+            exclusions (Overlay, optional): See route. Defaults to None.
+
+        Yields:
+            tuple: The (index, route, report) of each pair, see route_many.
+        """
+        valid = []
+        for index, start, target in pairs:
+            try:
+                self._check_endpoints(start, target, exclusions)
+                valid.append((index, list(start), list(target)))
+            except ValueError as e:
+                yield index, None, {'error': str(e)}
+        if not valid:
+            return
+
+        surface = self.cost_surface.cost
+        target = valid[0][2]
+        windowed = self.window_margin is not None or exclusions is not None
+        top, left, bottom, right = 0, 0, surface.shape[0], surface.shape[1]
+        if windowed:
+            corners = np.array([start for _, start, _ in valid] + [target])
+            top, left, bottom, right = search_window(surface.shape, corners.min(axis=0), corners.max(axis=0),
+                                                     self.window_margin or EXCLUSION_WINDOW_MARGIN)
+        if self.hierarchical or (windowed and self.max_window_cells is not None
+                                 and (bottom - top)*(right - left) > self.max_window_cells):
+            for index, start, target in valid:
+                yield self._route_pair(index, start, target, time_budget, exclusions)
+            return
+
+        local_target = [target[0] - top, target[1] - left]
+        starts = [[y - top, x - left] for _, (y, x), _ in valid]
+        window, no_go, dead, distance_field = self._prepare_target(
+            local_target, starts, (top, left, bottom, right), exclusions)
+
+        for index, start, _ in valid:
+            try:
+                path = self.agent.route(
+                    window,
+                    [start[0] - top, start[1] - left],
+                    local_target,
+                    time_budget=time_budget,
+                    no_go=no_go,
+                    distance_field=distance_field,
+                    dead=dead
+                )
+            except ValueError as e:
+                if not windowed:
+                    yield index, None, {'error': str(e)}
+                    continue
+                path = []
+
+            path = [[y + top, x + left] for y, x in path]
+            if not windowed:
+                yield index, path, self.agent.report
+            elif path and path[-1] == target:
+                self.agent.report['window'] = (top, left, bottom, right)
+                yield index, path, self.agent.report
+            else:
+                yield self._route_pair(index, start, target, time_budget, exclusions)
+
+    def _prepare_target(self, target, starts, bounds, exclusions=None):
+        """
+        Get the search data of routes to a target, shared by _route_chunk.
+
+        The data is kept for the TARGET_CACHE_SIZE most recent targets, keyed
+        by the target, the window, the exclusions' key and, with skip_pockets,
+        the starts kept open, so later chunks to the same target reuse it.
+
+        Args:
+            target (list): Target location [y, x] in the window.
+            starts (list): Starting locations [y, x] in the window.
+            bounds (tuple): The (top, left, bottom, right) of the window.
+            exclusions (Overlay, optional): See route. Defaults to None.
+
+        Returns:
+            tuple: The window of the cost surface with the exclusions and dead
+                pockets applied, the window of the no-go areas, the dead
+                pockets (None without skip_pockets) and the cost_to_go field
+                (None without the cost_to_go prior).
+        """
+        key = (tuple(target), bounds, None if exclusions is None else exclusions.key,
+               tuple(map(tuple, starts)) if self.agent.skip_pockets else None)
+        prepared = self._targets.get(key)
+        if prepared is not None:
+            self._targets.move_to_end(key)
+            return prepared
+
+        top, left, bottom, right = bounds
+        window = self.cost_surface.cost[top:bottom, left:right]
+        if exclusions is not None:
+            window = exclusions.apply(window, top, left)
+        no_go = self.cost_surface.no_go[top:bottom, left:right]
+        dead = distance_field = None
+        if self.agent.skip_pockets:
+            dead = dead_pockets(window, starts, target, walls=no_go)
+            window = np.where(dead, -1, window)
+        if self.agent.prior == 'cost_to_go':
+            distance_field = self.agent.prior_field(window, target)
+
+        prepared = self._targets[key] = (window, no_go, dead, distance_field)
+        while len(self._targets) > TARGET_CACHE_SIZE:
+            self._targets.popitem(last=False)
+        return prepared
+
+    def close(self):
+        """
+        Stop any worker processes started by the routing agent or route_many.
+        """
+        self.agent.close()
+        if self.route_pool is not None:
+            self.route_pool.close()
+            self.route_pool = None
+
+def _route_worker(connection, config):
+    """
+    Event loop of a RoutePool process.
+
+    The worker builds one MLWrapper for its lifetime and routes the chunks of
+    pairs it is sent with MLWrapper._route_chunk, sending each route back as
+    soon as it is found. A 'cancel' message between two routes drops the
+    rest of the chunk.
+
+    Args:
+        connection (multiprocessing.connection.Connection): The worker end of
+            the pipe to the coordinating process.
+        config (dict): Keyword arguments of the worker's MLWrapper.
+    """
+    wrapper = MLWrapper(**config)
+    try:
+        while True:
+            command, *args = connection.recv()
+            if command == 'close':
+                break
+            if command == 'cancel':
+                # Arrived after the chunk was done
+                continue
+
+            pairs, time_budget, exclusions = args
+            try:
+                for result in wrapper._route_chunk(pairs, time_budget=time_budget, exclusions=exclusions):
+                    connection.send(('result', *result))
+                    if connection.poll():
+                        # The batch was cancelled, or the pool is closing
+                        if connection.recv()[0] == 'close':
+                            return
+                        break
+                connection.send(('done',))
+            except Exception as e:
+                connection.send(('error', e))
+    finally:
+        wrapper.close()
+
+class RoutePool:
+    """
+    Long-lived worker processes that each route whole start/target pairs.
+
+    Every worker owns an MLWrapper with a single search tree, so the pool
+    routes as many pairs at once as it has workers. The workers get their
+    cost surface from load_surface, which forked workers inherit from the
+    process that started them and others memory map from a build_surfaces
+    build when there is one. Pairs are sent in chunks sharing a target,
+    so a worker prepares the target's window, exclusions, dead pockets and
+    cost_to_go field once per chunk, see MLWrapper._route_chunk. One batch
+    is routed at a time: starting a batch cancels the unfinished one.
+
+    Attributes:
+        processes (int): Number of worker processes.
+    """
+
+    def __init__(self, config, processes):
+        """
+        Start the worker processes.
+
+        Args:
+            config (dict): Keyword arguments of each worker's MLWrapper, whose
+                num_workers is set to 1.
+            processes (int): Number of worker processes to start.
+        """
+        self.processes = processes
+        self._connections = []
+        self._processes = []
+        config = dict(config, num_workers=1)
+
+        for _ in range(processes):
+            parent_connection, child_connection = mp.Pipe()
+            process = mp.Process(target=_route_worker, args=(child_connection, config), daemon=True)
+            process.start()
+            child_connection.close()
+            self._connections.append(parent_connection)
+            self._processes.append(process)
+
+        # Weak reference to the generator of the batch being routed, see route
+        self._batch = None
+
+        # Stop the workers even if close is never called
+        self._finalizer = weakref.finalize(
+            self, WorkerForest._shutdown, self._connections, self._processes, []
+            )
+
+    def chunks(self, pairs):
+        """
+        Split pairs into chunks of pairs with the same target.
+
+        Chunks hold at most an even share of the pairs per worker, so one
+        popular target can't keep a single worker busy while the others
+        idle, and the largest chunks come first.
+
+        Args:
+            pairs (list): The (start, target) pairs.
+
+        Returns:
+            list: Chunks of (index, start, target) tuples.
+        """
+        groups = {}
+        for index, (start, target) in enumerate(pairs):
+            groups.setdefault(tuple(target), []).append((index, list(start), list(target)))
+
+        share = max(-(-len(pairs) // self.processes), 1)
+        chunks = [group[i:i + share] for group in groups.values() for i in range(0, len(group), share)]
+        return sorted(chunks, key=len, reverse=True)
+
+    def route(self, pairs, time_budget=None, exclusions=None):
+        """
+        Route pairs on the workers, yielding each route as it is found.
+
+        The workers route one batch at a time, so an earlier batch that has
+        not been read to the end is cancelled first: its workers drop the
+        rest of their chunks and the routes they had found are discarded.
+
+        Args:
+            pairs (list): The (start, target) pairs to route.
+            time_budget (float, optional): Seconds each pair may search, see
+                MLWrapper.route. Defaults to None (no deadline).
+            exclusions (Overlay, optional): Applied to every pair, see
+                MLWrapper.route. Defaults to None.
+
+        Returns:
+            iterator: Yields the (index, route, report) of each pair as it
+                finishes, see MLWrapper.route_many, and re-raises an
+                unexpected exception raised by a worker.
+        """
+        batch = self._batch() if self._batch is not None else None
+        if batch is not None:
+            batch.close()
+        batch = self._stream(self.chunks(pairs), time_budget, exclusions)
+        self._batch = weakref.ref(batch)
+        return batch
+
+    def _stream(self, pending, time_budget, exclusions):
+        """
+        Send chunks to the workers as they become free and yield the results.
+
+        Args:
+            pending (list): The chunks to route, see chunks.
+            time_budget (float): See route.
+            exclusions (Overlay): See route.
+
+        Yields:
+            tuple: The (index, route, report) of each pair as it finishes.
+        """
+        busy = set()
+        try:
+            for connection in self._connections:
+                if pending:
+                    connection.send(('route', pending.pop(0), time_budget, exclusions))
+                    busy.add(connection)
+
+            while busy:
+                for connection in wait(list(busy)):
+                    status, *result = connection.recv()
+                    if status == 'result':
+                        yield tuple(result)
+                    elif status == 'error':
+                        busy.discard(connection)
+                        raise result[0]
+                    elif pending:
+                        connection.send(('route', pending.pop(0), time_budget, exclusions))
+                    else:
+                        busy.discard(connection)
+        finally:
+            # Workers still routing would send results nobody reads
+            if busy:
+                self._cancel(busy)
+
+    def _cancel(self, busy):
+        """
+        Stop the workers of an unfinished batch and discard their results.
+
+        Each worker stops after the route it is searching, so this waits for
+        at most one route per worker. The pool is closed if a worker can't be
+        reached.
+
+        Args:
+            busy (set): The connections of the workers still routing.
+        """
+        try:
+            for connection in busy:
+                connection.send(('cancel',))
+            for connection in busy:
+                while connection.recv()[0] not in ('done', 'error'):
+                    pass
+        except (EOFError, OSError):
+            self.close()
+
+    @property
+    def closed(self):
+        """
+        bool: True once the worker processes have been stopped.
+        """
+        return not self._finalizer.alive
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        self._finalizer()
@@ -0,0 +1,37 @@
+import sys
+sys.path.append("../Flask")
+
+import time
+import unittest
+import numpy as np
+from mc_agent import PoolTree, JitTree, JIT_AVAILABLE
+
+@unittest.skipUnless(JIT_AVAILABLE, 'Numba is not installed')
+class TestJitBenchmark(unittest.TestCase):
+    def setUp(self):
+        """Build a random surface to search and compile the kernel."""
+        rng = np.random.default_rng(0)
+        self.cost_surface = rng.random((200, 200))**2
+        self.cost_surface[[0, -1], :] = -1
+        self.cost_surface[:, [0, -1]] = -1
+        self.start = np.array([2, 2])
+        self.target = np.array([197, 197])
+        JitTree(self.cost_surface, self.start, self.target).search(1)
+
+    def test_jit_benchmark(self):
+        """Test that the compiled kernel builds the tree of search_pool and searches faster."""
+        num_trajectories = 2000
+        rates = {}
+        trees = {}
+        for name, tree_class in (('pool', PoolTree), ('jit', JitTree)):
+            trees[name] = tree_class(self.cost_surface, self.start, self.target, distance_factor=0.2)
+            start = time.perf_counter()
+            trees[name].search(num_trajectories, c=np.sqrt(2))
+            rates[name] = num_trajectories/(time.perf_counter() - start)
+
+        self.assertEqual(trees['pool'].traverse(trees['pool'].root), trees['jit'].traverse(trees['jit'].root))
+        self.assertGreater(rates['jit'], rates['pool'], 'Search of {} trajectories: pool {:.0f}/s, jit {:.0f}/s'.format(
+            num_trajectories, rates['pool'], rates['jit']))
+
+if __name__ == '__main__':
+    unittest.main()
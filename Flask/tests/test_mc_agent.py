@@ -1,13 +1,27 @@
+import os
 import sys
+import tempfile
+import threading
+import warnings
 sys.path.append("../Flask")
 print(sys.path)
 
 import unittest
 import numpy as np
+import rasterio
 from unittest.mock import patch, MagicMock
-from mc_agent import Node, MCTree, MCAgent, MLWrapper, CostSurface, normalize, exponential, draw_circle
+import mc_agent
+from mc_agent import Node, MCTree, MCAgent, MLWrapper, CostSurface, NodePool, Overlay, PoolTree, JitTree, JIT_AVAILABLE, TiledSurface, TranspositionTable, VisitedSet, aggregate_statistics, block_mean, build_surfaces, cell_index, cell_location, consensus_prefix, cost_to_go, dead_pockets, decision_settled, dequantize, exact_route, load_built_surface, load_surface, polygon_overlay, quantize, search, search_pool, valid_moves, normalize, exponential, draw_circle
 from pathlib import Path
 
+def bordered_surface():
+    """Build a small cost surface surrounded by impassable (-1) cells."""
+    cost_surface = np.zeros((10, 10))
+    cost_surface[5:7, 5:7] = 1
+    cost_surface[[0, -1], :] = -1
+    cost_surface[:, [0, -1]] = -1
+    return cost_surface
+
 class TestMCAgent(unittest.TestCase):
     def setUp(self):
         """Set up test fixtures before each test method."""
@@ -122,6 +136,357 @@ class TestMCAgent(unittest.TestCase):
         self.assertIsNotNone(wrapper.agent)
         self.assertEqual(wrapper.agent.trajectories, 100)
         
+    @patch('pathlib.Path.exists', return_value=True)
+    @patch('mc_agent.resource_path')
+    @patch('mc_agent.rasterio.open')
+    def test_mlwrapper_search_window(self, mock_rasterio, mock_resource_path, mock_exists):
+        """Test that the search window grows until it holds a route."""
+        mock_resource_path.return_value = 'dummy/path/to/raster.tif'
+        arr = np.zeros((10, 10))
+        arr[0:5, :] = -1
+        mock_rasterio.return_value.read.return_value = arr
+
+        wrapper = MLWrapper(mode='route', trajectories=50, num_workers=1, prior='cost_to_go', window_margin=1)
+        cost_surface = np.zeros((20, 20))
+        cost_surface[[0, -1], :] = -1
+        cost_surface[:, [0, -1]] = -1
+        cost_surface[:12, 5] = -1
+        wrapper.cost_surface.cost = cost_surface
+        wrapper.cost_surface.no_go = cost_surface == -1
+        wrapper.cost_surface.label_regions()
+
+        path, _ = wrapper.route((2, 2), (2, 8))
+        top, left, bottom, right = wrapper.agent.report['window']
+        self.assertEqual(path[0], [2, 2])
+        self.assertEqual(path[-1], [2, 8])
+        self.assertGreaterEqual(bottom, 13)
+        for y, x in path:
+            self.assertTrue(top <= y < bottom and left <= x < right)
+            self.assertNotEqual(cost_surface[y, x], -1)
+
+        # Windows larger than the limit are never built
+        wrapper.max_window_cells = 100
+        with patch.object(wrapper.agent, 'route', wraps=wrapper.agent.route) as route:
+            with self.assertRaises(ValueError):
+                wrapper.route((2, 2), (2, 8))
+            for call in route.call_args_list:
+                self.assertLessEqual(call.args[0].size, 100)
+
+        with self.assertRaises(ValueError):
+            MLWrapper(mode='route', window_margin=0)
+        with self.assertRaises(ValueError):
+            MLWrapper(mode='route', window_margin=1, max_window_cells=0)
+
+    @patch('pathlib.Path.exists', return_value=True)
+    @patch('mc_agent.resource_path')
+    @patch('mc_agent.rasterio.open')
+    @patch('mc_agent.EXCLUSION_WINDOW_MARGIN', 1)
+    def test_mlwrapper_exclusions(self, mock_rasterio, mock_resource_path, mock_exists):
+        """Test that exclusions are applied to search windows, not the surface."""
+        mock_resource_path.return_value = 'dummy/path/to/raster.tif'
+        arr = np.zeros((10, 10))
+        arr[0:5, :] = -1
+        mock_rasterio.return_value.read.return_value = arr
+
+        wrapper = MLWrapper(mode='route', trajectories=50, num_workers=1, prior='cost_to_go')
+        cost_surface = np.zeros((20, 20))
+        cost_surface[[0, -1], :] = -1
+        cost_surface[:, [0, -1]] = -1
+        wrapper.cost_surface.cost = cost_surface
+        wrapper.cost_surface.no_go = cost_surface == -1
+        wrapper.cost_surface.label_regions()
+        exclusions = Overlay((20, 20), np.arange(1, 12), np.full(11, 5))
+
+        with patch.object(wrapper.agent, 'route', wraps=wrapper.agent.route) as route:
+            path, _ = wrapper.route((2, 2), (2, 8), exclusions=exclusions)
+            self.assertLess(route.call_args_list[0].args[0].size, cost_surface.size)
+        self.assertEqual(path[-1], [2, 8])
+        self.assertFalse(any(exclusions.excludes(location) for location in path))
+        self.assertFalse((cost_surface == -1)[1:12, 5].any())
+
+        # Hierarchical routes search windows when the coarsened exclusions
+        # close the only gap
+        wrapper.hierarchical = True
+        wrapper.cost_surface.build_levels()
+        exclusions = Overlay((20, 20), np.delete(np.arange(1, 19), 9), np.full(17, 9))
+        with patch.object(wrapper.agent, 'route_hierarchical', wraps=wrapper.agent.route_hierarchical) as route:
+            path, _ = wrapper.route((2, 2), (2, 17), exclusions=exclusions)
+            route.assert_called_once()
+        self.assertEqual(path[-1], [2, 17])
+        self.assertIn([10, 9], path)
+        self.assertIn('window', wrapper.agent.report)
+
+    def test_region_labels(self):
+        """Test the constant time reachability checks of a cost surface."""
+        cost_surface = CostSurface()
+        cost_surface.no_go = np.zeros((10, 10), dtype=bool)
+        cost_surface.no_go[:, 5] = True
+        cost_surface.label_regions()
+
+        self.assertTrue(cost_surface.reachable([0, 0], [9, 4]))
+        self.assertFalse(cost_surface.reachable([0, 0], [0, 9]))
+        self.assertFalse(cost_surface.reachable([0, 5], [0, 5]))
+        self.assertEqual(cost_surface.region([3, 5]), 0)
+
+        # Routes cross enclosed no-go pockets and squeeze between diagonal
+        # no-go cells
+        cost_surface.no_go[2:4, 1:3] = True
+        cost_surface.no_go[6, 7] = cost_surface.no_go[7, 6] = True
+        cost_surface.no_go[5, 8] = cost_surface.no_go[5, 9] = True
+        cost_surface.label_regions()
+        self.assertTrue(cost_surface.reachable([0, 0], [2, 1]))
+        self.assertTrue(cost_surface.reachable([9, 9], [0, 9]))
+        self.assertTrue(cost_surface.reachable([9, 9], [6, 7]))
+        self.assertEqual(cost_surface.region([7, 6]), 0)
+
+    @patch('pathlib.Path.exists', return_value=True)
+    @patch('mc_agent.resource_path')
+    @patch('mc_agent.rasterio.open')
+    def test_mlwrapper_rejects_unreachable_target(self, mock_rasterio, mock_resource_path, mock_exists):
+        """Test that MLWrapper rejects infeasible requests before searching."""
+        mock_resource_path.return_value = 'dummy/path/to/raster.tif'
+        arr = np.zeros((10, 10))
+        arr[0:5, :] = -1
+        mock_rasterio.return_value.read.return_value = arr
+
+        wrapper = MLWrapper(mode='route', trajectories=10, num_workers=1)
+        wrapper.cost_surface.no_go = np.zeros((10, 10), dtype=bool)
+        wrapper.cost_surface.no_go[:, 5] = True
+        wrapper.cost_surface.no_go[0, 0] = True
+        wrapper.cost_surface.label_regions()
+        with patch.object(wrapper.agent, 'route') as route:
+            with self.assertRaises(ValueError):
+                wrapper.route((5, 1), (5, 8))
+            with self.assertRaises(ValueError):
+                wrapper.route((0, 0), (5, 1))
+            with self.assertRaises(ValueError):
+                wrapper.route((5, 1), (6, 3), exclusions=Overlay((10, 10), [6], [3]))
+            route.assert_not_called()
+
+    @patch('mc_agent.rasterio.open')
+    def test_load_surface_cache(self, mock_rasterio):
+        """Test that surfaces are processed once and shared until the raster changes."""
+        arr = np.zeros((10, 10))
+        arr[0:5, :] = -1
+        mock_rasterio.return_value.read.side_effect = lambda *args, **kwargs: arr.copy()
+
+        with tempfile.TemporaryDirectory() as tmp, patch.dict(mc_agent._surface_cache, clear=True):
+            path = Path(tmp) / 'cost.tif'
+            path.write_bytes(b'raster')
+            first = load_surface(path, degree=2)
+            second = load_surface(path, degree=2)
+            self.assertEqual(mock_rasterio.call_count, 1)
+            self.assertIsNot(first, second)
+            self.assertIs(first.cost, second.cost)
+            self.assertFalse(first.cost.flags.writeable)
+            with self.assertRaises(ValueError):
+                first.cost[0, 0] = 0
+
+            # Replacing an attribute doesn't leak into other callers
+            first.levels = []
+            self.assertIsNone(load_surface(path, degree=2).levels)
+
+            # Hierarchical levels are built once and shared read-only
+            with patch('mc_agent.block_mean', wraps=block_mean) as mean:
+                hierarchical = load_surface(path, degree=2, levels=True)
+                self.assertIs(load_surface(path, degree=2, levels=True).levels[0], hierarchical.levels[0])
+                self.assertEqual(mean.call_count, 2)
+            self.assertIs(hierarchical.levels[-1], first.cost)
+            self.assertFalse(any(level.flags.writeable for level in hierarchical.levels))
+            self.assertEqual(mock_rasterio.call_count, 1)
+
+            load_surface(path, degree=1)
+            self.assertEqual(mock_rasterio.call_count, 2)
+
+            stat = path.stat()
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            third = load_surface(path, degree=2)
+            self.assertEqual(mock_rasterio.call_count, 3)
+            self.assertIsNot(third.cost, first.cost)
+            self.assertEqual(len(mc_agent._surface_cache), 1)
+
+    @patch('mc_agent.rasterio.open')
+    def test_load_surface_locks(self, mock_rasterio):
+        """Test that a surface being processed only holds up callers asking for it."""
+        arr = np.zeros((10, 10))
+        arr[0:5, :] = -1
+        mock_rasterio.return_value.read.side_effect = lambda *args, **kwargs: arr.copy()
+        started, release = threading.Event(), threading.Event()
+
+        def load_built(path, **kwargs):
+            if path.name == 'slow.tif':
+                started.set()
+                release.wait(10)
+            return None
+
+        with tempfile.TemporaryDirectory() as tmp, patch.dict(mc_agent._surface_cache, clear=True), \
+                patch('mc_agent.load_built_surface', side_effect=load_built):
+            paths = [Path(tmp) / name for name in ('slow.tif', 'cached.tif', 'other.tif')]
+            for path in paths:
+                path.write_bytes(b'raster')
+            cached = load_surface(paths[1], degree=2)
+
+            slow = threading.Thread(target=load_surface, args=(paths[0],), kwargs={'degree': 2})
+            slow.start()
+            self.assertTrue(started.wait(10))
+            self.assertIs(load_surface(paths[1], degree=2).cost, cached.cost)
+            load_surface(paths[2], degree=2)
+            self.assertTrue(slow.is_alive())
+
+            release.set()
+            slow.join(10)
+            self.assertEqual(len(mc_agent._surface_cache), 3)
+
+    @patch('mc_agent.rasterio.open')
+    def test_build_surfaces(self, mock_rasterio):
+        """Test that built surfaces are memory mapped in place of processing the raster."""
+        arr = np.zeros((10, 10))
+        arr[0:5, :] = -1
+        mock_rasterio.return_value.read.side_effect = lambda *args, **kwargs: arr.copy()
+
+        with tempfile.TemporaryDirectory() as tmp, patch.dict(mc_agent._surface_cache, clear=True):
+            raster = Path(tmp) / 'cost.tif'
+            raster.write_bytes(b'raster')
+            out_dir = Path(tmp) / 'processed'
+            with patch.dict(mc_agent.ROUTING_MODES, {'test': (str(raster), 2, 0.2)}):
+                manifest = build_surfaces(out_dir, modes=('test',))
+            self.assertEqual(manifest['test']['shape'], [10, 10])
+            self.assertTrue((out_dir / manifest['test']['directory'] / 'labels.npy').exists())
+
+            surface = load_surface(raster, degree=2, surface_dir=out_dir)
+            self.assertEqual(mock_rasterio.call_count, 1)
+            self.assertIsInstance(surface.cost, np.memmap)
+            self.assertFalse(surface.cost.flags.writeable)
+            processed = CostSurface()
+            processed.process_raster(raster, degree=2)
+            np.testing.assert_array_equal(surface.cost, processed.cost)
+            np.testing.assert_array_equal(surface.labels, processed.labels)
+
+            # Other parameters or raster contents need their own build
+            self.assertIsNone(load_built_surface(raster, degree=1, surface_dir=out_dir))
+            raster.write_bytes(b'changed raster')
+            self.assertIsNone(load_built_surface(raster, degree=2, surface_dir=out_dir))
+
+    def test_quantize(self):
+        """Test that quantized arrays restore to within half a step with exact ends."""
+        arr = np.random.default_rng(0).random((50, 40))
+        arr[0, 0], arr[-1, -1] = 0, 1
+        quantized, value_range = quantize(arr, chunk=7)
+        self.assertEqual(quantized.dtype, np.uint16)
+        restored = dequantize(quantized, value_range)
+        self.assertEqual(restored.dtype, np.float32)
+        self.assertLessEqual(np.abs(restored - arr).max(), 0.5/65535 + 1e-7)
+        self.assertEqual(restored[0, 0], 0)
+        self.assertEqual(restored[-1, -1], 1)
+
+    @patch('mc_agent.rasterio.open')
+    def test_compact_rasters(self, mock_rasterio):
+        """Test processing to float32 and the compact encoding of saved surfaces."""
+        arr = np.random.default_rng(0).random((40, 37))
+        arr[:, 30:] = -1
+        mock_rasterio.return_value.read.side_effect = lambda band, out_dtype=None: arr.astype(out_dtype or arr.dtype)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            raster = Path(tmp) / 'cost.tif'
+            raster.write_bytes(b'raster')
+            surface = CostSurface()
+            surface.process_raster(raster, degree=2, dtype=np.float32)
+            full = CostSurface()
+            full.process_raster(raster, degree=2)
+            self.assertEqual(surface.cost.dtype, np.float32)
+            np.testing.assert_allclose(surface.cost, full.cost, atol=1e-6)
+            np.testing.assert_array_equal(surface.no_go, full.no_go)
+
+            surface.save_rasters(Path(tmp) / 'compact', compact=True)
+            self.assertFalse((Path(tmp) / 'compact' / 'cost.npy').exists())
+            loaded = CostSurface()
+            loaded.load_rasters(Path(tmp) / 'compact', mmap_mode='r')
+            np.testing.assert_allclose(loaded.cost, surface.cost, atol=1e-5)
+            np.testing.assert_array_equal(loaded.no_go, surface.no_go)
+            np.testing.assert_array_equal(loaded.labels, surface.labels)
+            self.assertEqual(loaded.labels.dtype, np.uint8)
+
+    def test_tiled_surface(self):
+        """Test that tiled surfaces match processing the whole raster."""
+        rng = np.random.default_rng(0)
+        arr = np.zeros((90, 100))
+        arr[3:-4, 5:-6] = -9999
+        arr[10:80, 12:90] = rng.random((70, 78))*5
+        arr[40:45, 20:70] = -1
+        arr[20:25, 30:35] = -np.inf
+        arr[60:64, 88:89] = -9999
+        arr[62, 85:88] = 3.5
+
+        with tempfile.TemporaryDirectory() as tmp:
+            raster = Path(tmp) / 'cost.tif'
+            with rasterio.open(raster, 'w', driver='GTiff', height=90, width=100, count=1, dtype='float64') as ds:
+                ds.write(arr, 1)
+            processed = CostSurface()
+            processed.process_raster(raster, degree=2)
+            tiled = TiledSurface(raster, degree=2, tile_size=16, cache_bytes=16*16*10*4)
+
+            self.assertEqual(tiled.shape, processed.cost.shape)
+            np.testing.assert_array_equal(np.asarray(tiled.cost), processed.cost)
+            np.testing.assert_array_equal(np.asarray(tiled.no_go), processed.no_go)
+            self.assertLessEqual(tiled._cached_bytes, tiled.cache_bytes)
+            self.assertLess(len(tiled._tiles), 36)
+
+            # The same regions, numbered differently
+            labels = np.asarray(tiled.labels)
+            np.testing.assert_array_equal(labels == 0, processed.labels == 0)
+            pairs = np.unique(np.stack((labels.ravel(), processed.labels.ravel())), axis=1)
+            self.assertEqual(len(np.unique(pairs[0])), pairs.shape[1])
+
+            np.testing.assert_array_equal(tiled.cost[20:37, 5:50], processed.cost[20:37, 5:50])
+            self.assertEqual(tiled.cost[30, 40], processed.cost[30, 40])
+            self.assertTrue(tiled.reachable((10, 10), (60, 70)))
+            # No-go pockets inside the land are routable, the edges are not
+            self.assertTrue(tiled.reachable((10, 10), (38, 20)))
+            self.assertFalse(tiled.reachable((10, 10), (2, 2)))
+
+            # Tiles smaller than the pockets and regions merge across corners
+            small = TiledSurface(raster, degree=2, tile_size=5)
+            pairs = np.unique(np.stack((np.asarray(small.labels).ravel(), processed.labels.ravel())), axis=1)
+            self.assertEqual(len(np.unique(pairs[0])), pairs.shape[1])
+            self.assertEqual(len(np.unique(pairs[1])), pairs.shape[1])
+
+    def test_overlay(self):
+        """Test that overlays change only copies of the windows they overlap."""
+        surface = np.zeros((20, 30))
+        surface.flags.writeable = False
+        mask = np.zeros((4, 5), dtype=bool)
+        mask[1:3, 2:4] = True
+        overlay = Overlay.from_mask(mask, top=10, left=20, shape=surface.shape)
+        self.assertEqual(len(overlay), 4)
+        self.assertTrue(overlay.excludes((11, 22)))
+        self.assertFalse(overlay.excludes((11, 21)))
+
+        applied = overlay.apply(surface)
+        self.assertEqual((applied == -1).sum(), 4)
+        self.assertEqual(applied[12, 23], -1)
+        self.assertTrue((surface == 0).all())
+
+        window = surface[11:15, 15:23]
+        applied = overlay.apply(window, 11, 15)
+        np.testing.assert_array_equal(np.argwhere(applied == -1), [[0, 7], [1, 7]])
+        untouched = surface[:10, :]
+        self.assertIs(overlay.apply(untouched), untouched)
+
+    def test_polygon_overlay(self):
+        """Test rasterizing and caching polygons by their geometry."""
+        with patch.dict(mc_agent._overlay_cache, clear=True):
+            square = [(2, 3), (2, 6), (5, 6), (5, 3)]
+            overlay = polygon_overlay((10, 10), [square])
+            self.assertEqual(len(overlay), 16)
+            self.assertTrue(overlay.excludes((2, 3)))
+            self.assertFalse(overlay.excludes((6, 3)))
+            self.assertIs(polygon_overlay((10, 10), [list(square)]), overlay)
+            self.assertIsNot(polygon_overlay((10, 10), [square], cost=0.5), overlay)
+
+            # Polygons are clipped to the surface
+            clipped = polygon_overlay((10, 10), [[(-5, -5), (-5, 2), (2, 2), (2, -5)]])
+            self.assertEqual(len(clipped), 9)
+
     def test_cost_surface_initialization(self):
         """Test CostSurface initialization."""
         cost_surface = CostSurface()
@@ -129,10 +494,728 @@ class TestMCAgent(unittest.TestCase):
         self.assertIsNone(cost_surface.cost)
         self.assertIsNone(cost_surface.no_go)
         
+    def test_visited_set(self):
+        """Test that trajectory cells are forgotten while committed cells persist."""
+        visited = VisitedSet((10, 10))
+        visited.commit(0)
+        visited.begin_trajectory()
+        visited.add(11)
+
+        self.assertIn(0, visited)
+        self.assertIn(11, visited)
+        self.assertNotIn(22, visited)
+
+        visited.begin_trajectory()
+        self.assertIn(0, visited)
+        self.assertNotIn(11, visited)
+
+        visited.release(0)
+        self.assertNotIn(0, visited)
+
+    def test_cell_index(self):
+        """Test that flat cell indices round-trip on surfaces wider than 999 cells."""
+        self.assertEqual(cell_index([3, 1204], 1500), 3*1500 + 1204)
+        self.assertEqual(cell_location(cell_index([1203, 1499], 1500), 1500), (1203, 1499))
+
+    def test_select_root_large_surface(self):
+        """Test that roots can be selected on surfaces wider than 999 cells."""
+        cost_surface = np.zeros((4, 1200))
+        start, target = np.array([1, 1100]), np.array([2, 1110])
+        for tree in (MCTree(cost_surface, start, target), PoolTree(cost_surface, start, target)):
+            tree.search(10, c=np.sqrt(2))
+            cells, _, _ = tree.root_statistics()
+            self.assertIn(cell_index([1, 1101], 1200), cells)
+            tree.select_root(cell_index([1, 1101], 1200))
+            self.assertEqual(list(tree.traverse(tree.root)[0]), [1, 1101])
+
+    def test_expand_shares_visited_set(self):
+        """Test that expansion skips visited cells without copying the path."""
+        tree = MCTree(bordered_surface(), np.array([2, 2]), self.target - 1)
+        tree.root.path.begin_trajectory()
+        tree.root.path.add(cell_index([1, 2], 10))
+        tree.root.expand(tree.cost_surface, tree.target)
+
+        locations = [child.location.tolist() for child in tree.root.children]
+        self.assertNotIn([1, 2], locations)
+        self.assertEqual(len(locations), 7)
+        self.assertTrue(all(child.path is tree.root.path for child in tree.root.children))
+
+    def test_valid_moves(self):
+        """Test the batched expansion kernel against the per-move reward formula."""
+        visited = VisitedSet(self.cost_surface.shape)
+        visited.commit(cell_index(self.start, visited.width))
+        locations, rewards = valid_moves(self.start, self.cost_surface, self.target, visited, 0.5)
+
+        # Only the right, down/right and down moves stay in bounds from the corner
+        np.testing.assert_array_equal(locations, [[0, 1], [1, 1], [1, 0]])
+
+        node = Node(self.start, None, None, visited, distance_factor=0.5)
+        for location, reward in zip(locations, rewards):
+            expected = node.calculate_euclidean_reward(location, self.target) - self.cost_surface[tuple(location)]*2
+            self.assertEqual(reward, expected)
+
+        # Impassable cells and the target are handled in the same batch
+        cost_surface = self.cost_surface.copy()
+        cost_surface[1, 1] = -1
+        locations, rewards = valid_moves(self.start, cost_surface, [1, 0], visited, 0.5)
+        np.testing.assert_array_equal(locations, [[0, 1], [1, 0]])
+        self.assertEqual(rewards[1], 100)
+
+    def test_node_pool_growth(self):
+        """Test that NodePool grows while preserving stored nodes."""
+        pool = NodePool(capacity=2)
+        first = pool.allocate(2)
+        pool.location[first:first + 2] = [[1, 2], [3, 4]]
+        pool.allocate(5)
+
+        self.assertGreaterEqual(pool.capacity, 7)
+        self.assertEqual(pool.size, 7)
+        np.testing.assert_array_equal(pool.location[:2], [[1, 2], [3, 4]])
+        self.assertTrue(np.all(pool.parent[:pool.capacity] == -1))
+
+    def test_search_pool_matches_search(self):
+        """Test that the pool-backed tree produces the same statistics as the object tree."""
+        cost_surface = bordered_surface()
+        tree = MCTree(cost_surface, self.start + 1, self.target - 1)
+        pool_tree = PoolTree(cost_surface, self.start + 1, self.target - 1)
+
+        root, node = search(tree.root, tree.target, 50, cost_surface, c=1.0)
+        _, pool_node = search_pool(pool_tree, 50, c=1.0)
+
+        pool = pool_tree.pool
+        children = list(pool.children(pool_tree.root))
+        self.assertEqual([child.selections for child in root.children], pool.selections[children].tolist())
+        self.assertEqual([child.value for child in root.children], pool.value[children].tolist())
+        np.testing.assert_array_equal(node.location, pool.location[pool_node])
+        self.assertEqual(tree.traverse(tree.root), pool_tree.traverse(pool_tree.root))
+
+    def test_backpropagate_stops_at_search_root(self):
+        """Test that backpropagation is iterative and leaves ancestors of the search root untouched."""
+        visited = VisitedSet((10, 10))
+        nodes = [Node(np.array([0, 0]), None, 0, visited)]
+        for _ in range(5000):
+            nodes.append(Node(np.array([0, 0]), nodes[-1], 0, visited))
+        for node in nodes:
+            node.selections = 1
+        nodes[-1].value = 1.0
+
+        nodes[-1].backpropagate(root=nodes[1])
+        self.assertEqual(nodes[0].value, 0)
+        self.assertEqual(nodes[0].selections, 1)
+        self.assertAlmostEqual(nodes[1].value/0.98**4999, 1)
+        self.assertEqual(nodes[2].selections, 2)
+
+    def test_batched_backpropagation(self):
+        """Test that batched backpropagation gives the same statistics on both backends."""
+        cost_surface = bordered_surface()
+        for backprop_batch in (1, 8):
+            tree = MCTree(cost_surface, self.start + 1, self.target - 1)
+            pool_tree = PoolTree(cost_surface, self.start + 1, self.target - 1)
+            search(tree.root, tree.target, 50, cost_surface, c=1.0, backprop_batch=backprop_batch)
+            search_pool(pool_tree, 50, c=1.0, backprop_batch=backprop_batch)
+
+            pool = pool_tree.pool
+            children = list(pool.children(pool_tree.root))
+            self.assertEqual([child.selections for child in tree.root.children], pool.selections[children].tolist())
+            self.assertEqual([child.value for child in tree.root.children], pool.value[children].tolist())
+
+    def test_prune_and_node_budget(self):
+        """Test that pruning and the node budget bound the trees and agree between backends."""
+        cost_surface = bordered_surface()
+        cost_surface[2:7, 4] = -1
+        start, target = [2, 2], [7, 7]
+        unbounded = MCAgent(trajectories=20, num_workers=1, backend='pool')
+        unbounded_path = unbounded.route(cost_surface, start, target)
+        for kwargs in ({'prune': True}, {'max_nodes': 60}):
+            trees = []
+            paths = []
+            for backend in ('object', 'pool'):
+                agent = MCAgent(trajectories=20, num_workers=1, backend=backend, **kwargs)
+                paths.append(agent.route(cost_surface, start, target))
+                trees.append(agent.forest.trees[0])
+
+            self.assertEqual(paths[0], paths[1])
+            self.assertEqual(paths[0][-1], target)
+            if 'prune' in kwargs:
+                self.assertEqual(paths[0], unbounded_path)
+
+            tree, pool_tree = trees
+            top = tree.root
+            while top.parent is not None:
+                top = top.parent
+            subtrees = [tree.traverse(child) for child in top.children]
+            self.assertEqual(subtrees, [pool_tree.traverse(child) for child in pool_tree.pool.children(0)])
+            self.assertLess(sum(map(len, subtrees)) + 1, unbounded.forest.trees[0].pool.size)
+
+            # The running node counts match the trees
+            self.assertEqual(tree.num_nodes, sum(map(len, subtrees)) + 1)
+            self.assertEqual(pool_tree.num_nodes, tree.num_nodes)
+            if 'max_nodes' in kwargs:
+                self.assertLessEqual(tree.num_nodes, kwargs['max_nodes'])
+
+    def test_pruned_pool_compacts_when_sparse(self):
+        """Test that pruning only compacts the pool once released nodes fill enough of it."""
+        rng = np.random.default_rng(0)
+        cost_surface = rng.random((40, 40))**2
+        cost_surface[[0, -1], :] = -1
+        cost_surface[:, [0, -1]] = -1
+        tree = PoolTree(cost_surface, np.array([2, 2]), np.array([37, 37]), distance_factor=0.2, prune=True)
+        steps = 20
+        with patch.object(tree, 'compact', wraps=tree.compact) as compact:
+            for _ in range(steps):
+                cells, selections, _ = tree.search(20)
+                tree.select_root(int(cells[selections.argmax()]))
+                self.assertEqual(tree.num_nodes, len(tree.traverse(0)))
+                self.assertLessEqual(tree.pool.size - tree.num_nodes, mc_agent.COMPACT_FRACTION*tree.pool.size)
+        self.assertGreater(compact.call_count, 0)
+        self.assertLess(compact.call_count, steps)
+
+    def test_pool_compaction(self):
+        """Test that compacting a pool releases pruned nodes and keeps the rest of the tree."""
+        tree = PoolTree(bordered_surface(), self.start + 1, self.target - 1)
+        tree.search(50)
+        locations = tree.traverse(tree.root)
+        tree.pool.first_child[tree.pool.first_child[0] + 1] = -1
+        tree.pool.num_children[tree.pool.first_child[0] + 1] = 0
+        pruned = tree.traverse(tree.root)
+
+        tree.compact()
+        self.assertEqual(tree.pool.size, len(pruned))
+        self.assertEqual(tree.traverse(tree.root), pruned)
+        self.assertLess(len(pruned), len(locations))
+
+    @unittest.skipUnless(JIT_AVAILABLE, 'Numba is not installed')
+    def test_jit_search_matches_search(self):
+        """Test that the compiled kernel builds the same tree as search on small surfaces."""
+        rng = np.random.default_rng(0)
+        random_surface = rng.random((20, 20))**2
+        random_surface[[0, -1], :] = -1
+        random_surface[:, [0, -1]] = -1
+        for cost_surface in (bordered_surface(), random_surface, random_surface.astype(np.float32)):
+            target = np.array(cost_surface.shape) - 2
+            tree = MCTree(cost_surface, self.start + 1, target, distance_factor=0.2)
+            jit_tree = JitTree(cost_surface, self.start + 1, target, distance_factor=0.2)
+            for _ in range(3):
+                statistics = tree.search(100, c=1.0)
+                jit_statistics = jit_tree.search(100, c=1.0)
+                for expected, result in zip(statistics, jit_statistics):
+                    np.testing.assert_array_equal(expected, result)
+                self.assertEqual(tree.traverse(tree.root), jit_tree.traverse(jit_tree.root))
+
+                next_cell = statistics[0][statistics[1].argmax()]
+                tree.select_root(next_cell)
+                jit_tree.select_root(next_cell)
+
+    @unittest.skipUnless(JIT_AVAILABLE, 'Numba is not installed')
+    def test_jit_kernel_compiled_lazily(self):
+        """Test that the kernel is compiled on first search, without a cache when frozen."""
+        cost_surface = bordered_surface()
+        target = np.array([8, 8])
+        with patch('mc_agent._search_kernel', None), patch.object(sys, 'frozen', True, create=True), \
+                patch('mc_agent.numba.njit', wraps=mc_agent.numba.njit) as njit:
+            tree = JitTree(cost_surface, self.start + 1, target)
+            njit.assert_not_called()
+            tree.search(10)
+            tree.search(10)
+            njit.assert_called_once_with(cache=False)
+
+    @unittest.skipUnless(JIT_AVAILABLE, 'Numba is not installed')
+    def test_jit_kernel_compile_failure(self):
+        """Test that a kernel failing to compile falls back to search_pool."""
+        cost_surface = bordered_surface()
+        target = np.array([8, 8])
+        kernel = MagicMock(side_effect=mc_agent.numba.core.errors.TypingError('unsupported'))
+        with patch('mc_agent._search_kernel', kernel), patch('mc_agent._kernel_failed', False):
+            tree = JitTree(cost_surface, self.start + 1, target, distance_factor=0.2)
+            pool_tree = PoolTree(cost_surface, self.start + 1, target, distance_factor=0.2)
+            with self.assertWarns(UserWarning):
+                statistics = tree.search(50)
+            for expected, result in zip(pool_tree.search(50), statistics):
+                np.testing.assert_array_equal(expected, result)
+
+            tree.search(50)
+            kernel.assert_called_once()
+            self.assertIsNone(mc_agent._search_kernel)
+
+    def test_mcagent_jit_backend_route(self):
+        """Test that the jit backend, compiled or not, finds the same route as the object backend."""
+        cost_surface = bordered_surface()
+        start, target = [1, 1], [8, 8]
+        paths = [
+            MCAgent(trajectories=20, num_workers=1, backend=backend).route(cost_surface, start, target)
+            for backend in ('object', 'jit')
+            ]
+
+        self.assertEqual(paths[0], paths[1])
+
+    def test_cost_to_go(self):
+        """Test that the cost-to-go field follows detours and marks unreachable cells."""
+        cost_surface = bordered_surface()
+        cost_surface[1:8, 4] = -1
+        field = cost_to_go(cost_surface, [2, 2])
+
+        self.assertEqual(field[2, 2], 0)
+        self.assertEqual(field[2, 3], 1)
+        self.assertTrue(np.isinf(field[0, 0]))
+        self.assertTrue(np.isinf(field[1, 4]))
+
+        # Cells behind the wall are reached around its end, further than in a straight line
+        self.assertGreater(field[2, 6], np.hypot(0, 4) + 4)
+
+        # Impassable cells and cells cut off from the target are not valid moves
+        visited = VisitedSet(cost_surface.shape)
+        locations, _ = valid_moves(np.array([7, 5]), cost_surface, [2, 2], visited, 0.2, field)
+        self.assertEqual(len(locations), 6)
+
+        cost_surface[8, 4] = -1
+        field = cost_to_go(cost_surface, [2, 2])
+        self.assertTrue(np.isinf(field[1:9, 5:9]).all())
+        locations, _ = valid_moves(np.array([7, 5]), cost_surface, [2, 2], visited, 0.2, field)
+        self.assertEqual(len(locations), 0)
+
+    def test_cost_to_go_unreachable_cell(self):
+        """Test that cells the target can't be reached from have no moves rather than NaN rewards."""
+        cost_surface = bordered_surface()
+        cost_surface[1:9, 4] = -1
+        field = cost_to_go(cost_surface, [2, 2])
+        visited = VisitedSet(cost_surface.shape)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            locations, rewards = valid_moves(np.array([7, 5]), cost_surface, [2, 2], visited, 0.2, field)
+        self.assertEqual(len(locations), 0)
+        self.assertEqual(len(rewards), 0)
+
+        # Moves from reachable cells into the unreachable side are dropped
+        tree = PoolTree(cost_surface, np.array([7, 3]), np.array([2, 2]), distance_field=field)
+        tree.search(200)
+        pool = tree.pool
+        self.assertFalse(np.isnan(pool.reward[:pool.size]).any())
+        self.assertFalse(np.isnan(pool.value[:pool.size][pool.num_children[:pool.size] > 0]).any())
+        self.assertFalse(any(location[1] > 4 for location in tree.traverse(0)))
+
+    def test_cost_to_go_prior(self):
+        """Test that every backend finds the same route with the cost-to-go prior."""
+        cost_surface = bordered_surface()
+        cost_surface[1:7, 4] = -1
+        start, target = [2, 2], [2, 7]
+        paths = [
+            MCAgent(trajectories=20, num_workers=1, distance_factor=0.2, backend=backend, prior='cost_to_go')
+            .route(cost_surface, start, target)
+            for backend in ('object', 'pool', 'jit')
+            ]
+
+        self.assertEqual(paths[0], paths[1])
+        self.assertEqual(paths[0], paths[2])
+        self.assertEqual(paths[0][-1], target)
+
+        with self.assertRaises(KeyError):
+            MCAgent(trajectories=20, num_workers=1, prior='invalid_prior')
+
+    def test_mcagent_pool_backend_route(self):
+        """Test that both tree backends find the same route."""
+        cost_surface = bordered_surface()
+        start, target = [1, 1], [8, 8]
+        paths = [
+            MCAgent(trajectories=20, num_workers=1, backend=backend).route(cost_surface, start, target)
+            for backend in ('object', 'pool')
+            ]
+
+        self.assertEqual(paths[0], paths[1])
+        self.assertEqual(paths[1][-1], target)
+
+    def test_mcagent_reuses_worker_forest(self):
+        """Test that worker processes persist between routes until closed."""
+        cost_surface = bordered_surface()
+        agent = MCAgent(trajectories=20, num_workers=2, backend='pool')
+        try:
+            path = agent.route(cost_surface, [1, 1], [8, 8])
+            processes = list(agent.forest._processes)
+            agent.route(cost_surface, [1, 1], [8, 2])
+
+            self.assertEqual(path[-1], [8, 8])
+            self.assertEqual(agent.forest._processes, processes)
+            self.assertTrue(all(process.is_alive() for process in processes))
+        finally:
+            agent.close()
+
+        self.assertIsNone(agent.forest)
+        self.assertFalse(any(process.is_alive() for process in processes))
+
+    def test_aggregate_statistics(self):
+        """Test that root statistics are pooled by summing visits per cell."""
+        first = (np.array([11, 12]), np.array([5, 3]), np.array([-1.0, -2.0]))
+        second = (np.array([12, 22]), np.array([4, 6]), np.array([-3.0, 0.0]))
+
+        next_cell, totals = aggregate_statistics([first, second], 99)
+        self.assertEqual(next_cell, 12)
+        self.assertEqual(totals[12][0], 7)
+        self.assertAlmostEqual(totals[12][1], (3*-2.0 + 4*-3.0)/7)
+
+        # The target is always chosen when it is a valid child
+        next_cell, _ = aggregate_statistics([first, second], 22)
+        self.assertEqual(next_cell, 22)
+
+        # A single dead-end tree invalidates the root
+        next_cell, _ = aggregate_statistics([first, None], 99)
+        self.assertIsNone(next_cell)
+
+    def test_decision_settled(self):
+        """Test the early stopping rules of the adaptive trajectory budget."""
+        first = (np.array([11, 12]), np.array([6, 2]), np.array([0.0, 0.0]))
+        second = (np.array([11, 12]), np.array([5, 3]), np.array([0.0, 0.0]))
+        next_cell, totals = aggregate_statistics([first, second], 99)
+
+        # The lead of 6 visits is unassailable with at most 6 trajectories left
+        self.assertTrue(decision_settled([first, second], totals, next_cell, 5, 1.0))
+        self.assertFalse(decision_settled([first, second], totals, next_cell, 6, 1.0))
+
+        # Otherwise the trees must agree on a child holding enough of the visits
+        self.assertTrue(decision_settled([first, second], totals, next_cell, 100, 0.5))
+        self.assertFalse(decision_settled([first, second], totals, next_cell, 100, 0.75))
+        second = (np.array([11, 12]), np.array([3, 5]), np.array([0.0, 0.0]))
+        next_cell, totals = aggregate_statistics([first, second], 99)
+        self.assertFalse(decision_settled([first, second], totals, next_cell, 100, 0.5))
+
+        # Dead ends and a reachable target end the step straight away
+        self.assertTrue(decision_settled([first, None], {}, None, 100, 0.5))
+        next_cell, totals = aggregate_statistics([first, second], 12)
+        self.assertTrue(decision_settled([first, second], totals, next_cell, 100, 1.0))
+
+    def test_adaptive_trajectory_budget(self):
+        """Test that the adaptive budget reports per-step counts within its bounds."""
+        cost_surface = bordered_surface()
+        agent = MCAgent(trajectories=40, num_workers=1, backend='pool', min_trajectories=10)
+        path = agent.route(cost_surface, [1, 1], [8, 8])
+
+        counts = agent.report['trajectories']
+        self.assertEqual(path[-1], [8, 8])
+        self.assertEqual(len(counts), len(path) - 1)
+        self.assertTrue(all(10 <= count <= 40 and count % 10 == 0 for count in counts))
+        self.assertLess(sum(counts), 40*len(counts))
+
+        with self.assertRaises(ValueError):
+            MCAgent(trajectories=40, num_workers=1, confidence=0)
+
+    def test_principal_variation(self):
+        """Test that both tree backends follow the same principal variation."""
+        cost_surface = bordered_surface()
+        start, target = np.array([1, 1]), np.array([8, 8])
+        tree = MCTree(cost_surface, start, target)
+        search(tree.root, target, 200, cost_surface, c=np.sqrt(2))
+        pool_tree = PoolTree(cost_surface, start, target)
+        search_pool(pool_tree, 200, c=np.sqrt(2))
+
+        variation = tree.principal_variation(5, 0.0)
+        self.assertEqual(len(variation), 5)
+        self.assertEqual(variation, pool_tree.principal_variation(5, 0.0))
+        self.assertEqual(tree.principal_variation(5, 1.0), [])
+
+        cells, selections, _ = tree.root_statistics()
+        self.assertEqual(variation[0], cells[selections.argmax()])
+
+    def test_consensus_prefix(self):
+        """Test the shared prefix of several principal variations."""
+        self.assertEqual(consensus_prefix([[1, 2, 3], [1, 2, 4]], 1), [1, 2])
+        self.assertEqual(consensus_prefix([[1, 2, 3], [1, 2]], 1), [1, 2])
+        self.assertEqual(consensus_prefix([[1, 2, 3], [5, 2, 3]], 1), [1])
+        self.assertEqual(consensus_prefix([[], [1, 2]], 1), [1])
+
+    def test_multi_step_commit(self):
+        """Test that routes committing several cells per round reach the target."""
+        cost_surface = bordered_surface()
+        agent = MCAgent(trajectories=40, num_workers=2, backend='pool', max_commit=4)
+        path = agent.route(cost_surface, [1, 1], [8, 8])
+
+        committed = agent.report['committed']
+        self.assertEqual(path[-1], [8, 8])
+        self.assertEqual(sum(committed), len(path) - 1)
+        self.assertEqual(len(committed), len(agent.report['trajectories']))
+        self.assertTrue(all(1 <= count <= 4 for count in committed))
+        for a, b in zip(path, path[1:]):
+            self.assertLessEqual(max(abs(a[0] - b[0]), abs(a[1] - b[1])), 1)
+
+        with self.assertRaises(ValueError):
+            MCAgent(trajectories=40, num_workers=1, max_commit=0)
+        with self.assertRaises(ValueError):
+            MCAgent(trajectories=40, num_workers=1, consensus=1.5)
+
+    def test_exact_route(self):
+        """Test the deterministic fallback solver inside and beyond its corridor."""
+        cost_surface = bordered_surface()
+        cost_surface[1:8, 5] = -1
+        route = exact_route(cost_surface, [1, 1], [1, 8], margin=1)
+        self.assertEqual(route[0], [1, 1])
+        self.assertEqual(route[-1], [1, 8])
+        self.assertIn([8, 5], route)
+        for y, x in route:
+            self.assertNotEqual(cost_surface[y, x], -1)
+
+        self.assertIsNone(exact_route(cost_surface, [1, 1], [1, 8], blocked=[[8, 5]]))
+
+    def test_route_time_budget(self):
+        """Test that a spent time budget completes the route with the fallback."""
+        cost_surface = bordered_surface()
+        agent = MCAgent(trajectories=40, num_workers=1, backend='pool')
+        path = agent.route(cost_surface, [1, 1], [8, 8], time_budget=0)
+        self.assertEqual(agent.report['segments'], [('exact', 0, len(path) - 1)])
+        self.assertEqual(path[0], [1, 1])
+        self.assertEqual(path[-1], [8, 8])
+
+        path = agent.route(cost_surface, [1, 1], [8, 8], max_steps=3, time_budget=60)
+        segments = agent.report['segments']
+        self.assertEqual([engine for engine, _, _ in segments], ['mcts', 'exact'])
+        self.assertEqual(segments[0][1], 0)
+        self.assertEqual(segments[0][2], segments[1][1])
+        self.assertEqual(segments[1][2], len(path) - 1)
+        self.assertEqual(path[-1], [8, 8])
+        self.assertEqual(len(set(map(tuple, path))), len(path))
+
+        path = agent.route(cost_surface, [1, 1], [8, 8], time_budget=60)
+        self.assertEqual(agent.report['segments'], [('mcts', 0, len(path) - 1)])
+
+        with self.assertRaises(ValueError):
+            agent.route(cost_surface, [1, 1], [8, 8], time_budget=-1)
+
+    def test_build_levels(self):
+        """Test the coarser copies of a cost surface built for hierarchical routing."""
+        np.testing.assert_array_equal(block_mean(np.arange(8.0).reshape(2, 4), 2), [[2.5, 4.5]])
+        np.testing.assert_array_equal(block_mean(np.zeros((3, 3)), 2), [[0, 0.5], [0.5, 0.75]])
+
+        cost_surface = CostSurface()
+        cost_surface.cost = np.random.default_rng(0).random((61, 72))
+        cost_surface.build_levels()
+        self.assertEqual([level.shape for level in cost_surface.levels], [(11, 12), (31, 36), (61, 72)])
+        self.assertIs(cost_surface.levels[-1], cost_surface.cost)
+
+    def test_route_hierarchical(self):
+        """Test that a hierarchical route stays inside the corridors of the coarse routes."""
+        rng = np.random.default_rng(0)
+        cost_surface = CostSurface()
+        cost_surface.cost = rng.random((60, 60))**2
+        cost_surface.cost[[0, -1], :] = -1
+        cost_surface.cost[:, [0, -1]] = -1
+        cost_surface.build_levels()
+
+        agent = MCAgent(trajectories=50, num_workers=1, distance_factor=0.2, backend='pool', prior='cost_to_go')
+        path = agent.route_hierarchical(cost_surface.levels, [3, 3], [55, 50], buffer=1)
+
+        self.assertEqual(path[0], [3, 3])
+        self.assertEqual(path[-1], [55, 50])
+        for a, b in zip(path, path[1:]):
+            self.assertLessEqual(max(abs(a[0] - b[0]), abs(a[1] - b[1])), 1)
+
+        levels = agent.report['levels']
+        self.assertEqual(len(levels), 3)
+        self.assertEqual(agent.report['segments'], levels[-1]['segments'])
+        self.assertTrue(all(isinstance(value, int) for location in path for value in location))
+
+        # Exclusions are kept out of the coarse routes too
+        exclusions = Overlay((60, 60), np.arange(1, 45), np.full(44, 25))
+        coarse = exclusions.coarsen(6, keep=([0, 0],))
+        self.assertEqual(coarse.shape, (10, 10))
+        np.testing.assert_array_equal(coarse.rows, np.arange(8))
+        np.testing.assert_array_equal(coarse.cols, np.full(8, 4))
+        path = agent.route_hierarchical(cost_surface.levels, [3, 3], [3, 50], buffer=1, exclusions=exclusions)
+        self.assertEqual(path[-1], [3, 50])
+        self.assertFalse(any(exclusions.excludes(location) for location in path))
+        self.assertFalse((cost_surface.cost[1:45, 25] == -1).any())
+
+    def test_dead_pockets(self):
+        """Test finding unreachable cells, enclosed pockets and dead-end spurs."""
+        cost_surface = np.zeros((12, 12))
+        cost_surface[[0, -1], :] = -1
+        cost_surface[:, [0, -1]] = -1
+        cost_surface[3:9, [3, 7]] = -1
+        cost_surface[[3, 8], 3:8] = -1
+        cost_surface[3, 5] = 0
+        dead = dead_pockets(cost_surface, [1, 1], [10, 10])
+        expected = np.zeros((12, 12), dtype=bool)
+        expected[4:8, 4:7] = True
+        np.testing.assert_array_equal(dead, expected)
+
+        # A pocket holding the start is left open
+        self.assertFalse(dead_pockets(cost_surface, [5, 5], [10, 10]).any())
+
+        cost_surface = np.full((9, 9), -1.0)
+        cost_surface[1:8, 1:4] = 0
+        cost_surface[4, 4:8] = 0
+        walls = np.zeros((9, 9), dtype=bool)
+        walls[1, 1:4] = True
+        dead = dead_pockets(cost_surface, [2, 1], [7, 1], walls=walls)
+        self.assertTrue(dead[4, 5:8].all())
+        self.assertEqual(dead.sum(), 3)
+
+    def test_skip_pockets_route(self):
+        """Test that routes avoid the dead pockets made impassable."""
+        cost_surface = bordered_surface()
+        cost_surface[2:6, [3, 6]] = -1
+        cost_surface[5, 3:7] = -1
+        cost_surface[2, 3:7] = -1
+        cost_surface[2, 4] = 0
+        agent = MCAgent(trajectories=40, num_workers=1, backend='pool', skip_pockets=True)
+        path = agent.route(cost_surface, [1, 1], [8, 8])
+
+        self.assertEqual(path[-1], [8, 8])
+        self.assertEqual(agent.report['pockets'], 4)
+        self.assertFalse(any(2 < y < 5 and 3 < x < 6 for y, x in path))
+
+    def test_transposition_table(self):
+        """Test pooling and invalidating the statistics of a cell."""
+        table = TranspositionTable((4, 4))
+        selections, values = table.lookup(np.array([1, 2]), np.array([3, 4]), np.array([0.5, 1.5]))
+        np.testing.assert_array_equal(selections, [3, 4])
+        np.testing.assert_array_equal(values, [0.5, 1.5])
+
+        self.assertEqual(table.record(1, 3, 1.0), 1.0)
+        self.assertEqual(table.record(1, 1, 3.0), 1.5)
+        selections, values = table.lookup(1, 0, 0.0)
+        self.assertEqual((selections, values), (4, 1.5))
+
+        table.new_root()
+        self.assertEqual(table.lookup(1, 2, 0.25), (2, 0.25))
+
+    def test_transposition_backends_match(self):
+        """Test that both tree backends pool identical statistics per cell."""
+        cost_surface = bordered_surface()
+        start, target = np.array([1, 1]), np.array([8, 8])
+        tree = MCTree(cost_surface, start, target, transposition=True)
+        pool_tree = PoolTree(cost_surface, start, target, transposition=True)
+        for _ in range(3):
+            cells, selections, values = tree.search(100)
+            pool_cells, pool_selections, pool_values = pool_tree.search(100)
+            np.testing.assert_array_equal(cells, pool_cells)
+            np.testing.assert_array_equal(selections, pool_selections)
+            np.testing.assert_array_equal(values, pool_values)
+
+            next_cell = int(cells[selections.argmax()])
+            tree.select_root(next_cell)
+            pool_tree.select_root(next_cell)
+
+    def test_transposition_route(self):
+        """Test routing with transposition tables on every backend."""
+        cost_surface = bordered_surface()
+        for backend in ('object', 'pool', 'jit'):
+            agent = MCAgent(trajectories=40, num_workers=2, backend=backend, transposition=True)
+            path = agent.route(cost_surface, [1, 1], [8, 8])
+            self.assertEqual(path[-1], [8, 8])
+
+        with self.assertRaises(ValueError):
+            MCAgent(trajectories=40, num_workers=1, backprop_batch=4, transposition=True)
+
+    def test_invalid_mcagent_backend(self):
+        """Test MCAgent initialization with invalid backend."""
+        with self.assertRaises(KeyError):
+            MCAgent(trajectories=100, num_workers=1, backend='invalid_backend')
+
+    @patch('pathlib.Path.exists', return_value=True)
+    @patch('mc_agent.resource_path')
+    @patch('mc_agent.rasterio.open')
+    def test_route_chunk_shares_target(self, mock_rasterio, mock_resource_path, mock_exists):
+        """Test that pairs with the same target share its window, pockets and field."""
+        mock_resource_path.return_value = 'dummy/path/to/raster.tif'
+        arr = np.random.default_rng(0).random((40, 40))
+        arr[[0, -1], :] = -1
+        arr[:, [0, -1]] = -1
+        mock_rasterio.return_value.read.side_effect = lambda *args, **kwargs: arr.copy()
+
+        wrapper = MLWrapper(mode='route', trajectories=10, num_workers=1, prior='cost_to_go',
+                            skip_pockets=True, window_margin=4)
+        chunk = [(0, [5, 5], [20, 20]), (1, [8, 3], [20, 20]), (2, [0, 0], [20, 20]), (3, [25, 12], [20, 20])]
+        exclusions = Overlay((40, 40), [10, 10, 10], [10, 11, 12])
+        with patch('mc_agent.cost_to_go', wraps=cost_to_go) as field, \
+                patch('mc_agent.dead_pockets', wraps=dead_pockets) as pockets, \
+                patch.object(wrapper.agent, 'route', wraps=wrapper.agent.route) as route:
+            results = list(wrapper._route_chunk(chunk, exclusions=exclusions))
+            self.assertEqual(field.call_count, 1)
+            self.assertEqual(pockets.call_count, 1)
+
+            # Later chunks to the target reuse the data, also with an equal
+            # copy of the exclusions
+            same = Overlay((40, 40), [10, 10, 10], [10, 11, 12])
+            self.assertEqual(same.key, exclusions.key)
+            self.assertEqual(len(list(wrapper._route_chunk(chunk, exclusions=same))), 4)
+            self.assertEqual(field.call_count, 1)
+            self.assertEqual(pockets.call_count, 1)
+            self.assertEqual(len({id(call.args[0]) for call in route.call_args_list}), 1)
+            self.assertEqual(len({id(call.kwargs['distance_field']) for call in route.call_args_list}), 1)
+        wrapper.close()
+
+        self.assertEqual(sorted(index for index, _, _ in results), [0, 1, 2, 3])
+        for index, path, report in results:
+            if index == 2:
+                self.assertIsNone(path)
+                self.assertIn('error', report)
+            else:
+                self.assertEqual(path[0], chunk[index][1])
+                self.assertEqual(path[-1], [20, 20])
+                self.assertFalse(any(exclusions.excludes(location) for location in path))
+
+    @patch('pathlib.Path.exists', return_value=True)
+    @patch('mc_agent.resource_path')
+    @patch('mc_agent.rasterio.open')
+    def test_route_many(self, mock_rasterio, mock_resource_path, mock_exists):
+        """Test that route_many streams the routes of every pair from a persistent pool."""
+        mock_resource_path.return_value = 'dummy/path/to/raster.tif'
+        arr = np.random.default_rng(0).random((40, 40))
+        arr[[0, -1], :] = -1
+        arr[:, [0, -1]] = -1
+        mock_rasterio.return_value.read.side_effect = lambda *args, **kwargs: arr.copy()
+
+        wrapper = MLWrapper(mode='route', trajectories=10, num_workers=1, prior='cost_to_go')
+        pairs = [((5, 5), (30, 30)), ((8, 3), (30, 30)), ((0, 0), (30, 30)), ((20, 5), (5, 30))]
+        try:
+            results = {index: (route, report) for index, route, report in wrapper.route_many(pairs, processes=2)}
+            self.assertEqual(sorted(results), [0, 1, 2, 3])
+            for index in (0, 1, 3):
+                self.assertEqual(results[index][0], wrapper.route(*pairs[index])[0])
+            self.assertIsNone(results[2][0])
+            self.assertIn('outside', results[2][1]['error'])
+
+            pool = wrapper.route_pool
+            self.assertEqual(len(list(wrapper.route_many(pairs[:1], processes=2))), 1)
+            self.assertIs(wrapper.route_pool, pool)
+
+            # A second batch cancels the unfinished first one
+            first = wrapper.route_many(pairs, processes=2)
+            next(first)
+            second = {index: route for index, route, _ in wrapper.route_many(pairs, processes=2)}
+            self.assertEqual(second, {index: results[index][0] for index in results})
+            self.assertEqual(list(first), [])
+            self.assertIs(wrapper.route_pool, pool)
+            self.assertFalse(pool.closed)
+            with self.assertRaises(ValueError):
+                wrapper.route_many(pairs, processes=0)
+        finally:
+            wrapper.close()
+        self.assertTrue(pool.closed)
+
     def test_invalid_mlwrapper_mode(self):
         """Test MLWrapper initialization with invalid mode."""
         with self.assertRaises(KeyError):
             MLWrapper(mode='invalid_mode')
 
+    @patch('mc_agent.MLWrapper', side_effect=FileNotFoundError('missing raster'))
+    def test_least_cost_path_missing_raster(self, mock_wrapper):
+        """Test that a missing raster is raised instead of hidden by cleanup."""
+        with self.assertRaises(FileNotFoundError):
+            mc_agent.least_cost_path_ml((0, 0), (1, 1), 'route')
+
+    def test_tiled_mlwrapper_requires_window(self):
+        """Test that tiled surfaces are only used with limited window search."""
+        with self.assertRaises(ValueError):
+            MLWrapper(mode='route', tile_size=64)
+        with self.assertRaises(ValueError):
+            MLWrapper(mode='route', tile_size=64, window_margin=16, hierarchical=True)
+        self.assertEqual(MLWrapper(mode='route', tile_size=64, window_margin=16).max_window_cells,
+                         mc_agent.TILED_WINDOW_CELLS)
+
+        # Routes needing a larger window than the limit fail instead of
+        # assembling it from the tiles
+        wrapper = MLWrapper(mode='route', tile_size=64, window_margin=16, max_window_cells=1000)
+        with patch.object(wrapper.agent, 'route') as route:
+            with self.assertRaises(ValueError):
+                wrapper.route((350, 400), (450, 600))
+            route.assert_not_called()
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
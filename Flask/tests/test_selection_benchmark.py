@@ -0,0 +1,75 @@
+import sys
+sys.path.append("../Flask")
+
+import time
+import unittest
+import numpy as np
+from mc_agent import PoolTree, search_pool
+
+def scalar_select(tree, node, c):
+    """Reference UCB selection that scores one child at a time."""
+    pool = tree.pool
+    high_score = -np.inf
+    selected_child = -1
+    for child in pool.children(node):
+        if pool.is_no_go[child]:
+            continue
+
+        ucb = pool.reward[child] + pool.value[child] \
+            + c*np.sqrt(np.log(pool.selections[node])/(pool.selections[child] + 0.001))
+
+        if ucb > high_score:
+            high_score = ucb
+            selected_child = child
+
+    return selected_child
+
+def select_trajectory(tree, select, c):
+    """Follow UCB selection from the root down to a leaf and return the visited nodes."""
+    pool = tree.pool
+    node = tree.root
+    trajectory = [node]
+    while pool.num_children[node]:
+        node = select(tree, node, c)
+        if node == -1:
+            break
+        trajectory.append(node)
+    return trajectory
+
+class TestSelectionBenchmark(unittest.TestCase):
+    def setUp(self):
+        """Grow a searched tree on a random surface to select trajectories from."""
+        rng = np.random.default_rng(0)
+        cost_surface = rng.random((60, 60))**2
+        cost_surface[[0, -1], :] = -1
+        cost_surface[:, [0, -1]] = -1
+        self.c = np.sqrt(2)
+        self.tree = PoolTree(cost_surface, np.array([2, 2]), np.array([57, 57]), distance_factor=0.2)
+        search_pool(self.tree, 2000, c=self.c)
+
+    def test_vectorized_selection_matches_scalar(self):
+        """Test that vectorized selection picks the same child at every expanded node."""
+        pool = self.tree.pool
+        for node in np.flatnonzero(pool.num_children[:pool.size]):
+            self.assertEqual(self.tree.select(node, c=self.c), scalar_select(self.tree, node, self.c))
+
+    def test_selection_benchmark(self):
+        """Test that vectorized selection follows the scalar reference and is faster than it."""
+        repeats = 200
+        vectorized = lambda tree, node, c: tree.select(node, c=c)
+        trajectory = select_trajectory(self.tree, vectorized, self.c)
+        self.assertEqual(trajectory, select_trajectory(self.tree, scalar_select, self.c))
+
+        timings = {}
+        for name, select in (('scalar', scalar_select), ('vectorized', vectorized)):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                select_trajectory(self.tree, select, self.c)
+            timings[name] = (time.perf_counter() - start)/repeats
+
+        self.assertLess(timings['vectorized'], timings['scalar'],
+                        'Selection of a {}-node trajectory: scalar {:.1f} us, vectorized {:.1f} us'.format(
+                            len(trajectory), timings['scalar']*1e6, timings['vectorized']*1e6))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+"""
+build_surfaces
+Preprocess the cost surface of each routing mode so the server can memory map it instead of processing the raw raster.
+Example:
+    python build_surfaces.py
+    python build_surfaces.py -modes rail
+    python build_surfaces.py -float32 -compact
+Writes:
+    Flask/cost_surfaces/processed/manifest.json
+    Flask/cost_surfaces/processed/<mode>-<version>/cost.npy, no_go.npy, labels.npy
+Rebuild after changing a raster; the server falls back to processing rasters with no matching build.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from Flask.extra_utils import resource_path
+from Flask.mc_agent import ROUTING_MODES, SURFACE_DIR, build_surfaces
+
+parser = argparse.ArgumentParser(description="Script to preprocess the routing cost surfaces into memory-mappable arrays")
+parser.add_argument('-modes', nargs='+', choices=list(ROUTING_MODES), default=list(ROUTING_MODES), help='The routing modes to build, all of them by default')
+parser.add_argument('-out', default=resource_path(SURFACE_DIR), help='The directory to write the surfaces and manifest to')
+parser.add_argument('-float32', action='store_true', help='Process and store the cost as float32, halving its size')
+parser.add_argument('-compact', action='store_true', help='Store the cost as uint16 and the no-go mask bit-packed. The files are decoded on load instead of memory mapped')
+args = parser.parse_args()
+
+start = time.time()
+manifest = build_surfaces(args.out, modes=args.modes, dtype=np.float32 if args.float32 else None, compact=args.compact)
+for mode in args.modes:
+    entry = manifest[mode]
+    print(f"{mode}: {entry['raster']} -> {entry['directory']} {tuple(entry['shape'])} {entry['dtype']}{' compact' if entry['compact'] else ''}")
+print(f"Built {len(args.modes)} surfaces in {time.time() - start:.1f}s, manifest in {args.out}")